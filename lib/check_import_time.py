@@ -0,0 +1,75 @@
+"""Check that importing the notebook helper modules stays cheap.
+
+Each module is imported in a fresh interpreter with `python -X importtime`, after
+numpy and pandas (which every notebook imports anyway, and which would otherwise
+dominate the time), and the check fails if the import time it adds over them
+exceeds the budget below, or if it pulls in any of the heavy dependencies that
+should only be loaded on first use (matplotlib, plotly, pyodbc, IPython, duckdb).
+
+Usage: python lib/check_import_time.py
+"""
+import os
+import subprocess
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module name: (directory to import from, budget in milliseconds over the baseline imports)
+budgets = {
+    "functions": ("lib", 150),
+    "sense_checking": ("notebooks", 150),
+    "utilities": ("notebooks", 150),
+    "utilities2": ("notebooks", 150),
+}
+
+# imported before each module, and not counted against its budget
+baseline_modules = ["numpy", "pandas"]
+
+heavy_modules = ["matplotlib", "plotly", "pyodbc", "IPython", "duckdb"]
+
+
+def import_times(module, directory):
+    """Import the baseline modules and then `module` from `directory` in a new interpreter, and
+    return a dict of {imported module name: cumulative import time in microseconds}
+    """
+    completed_process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(baseline_modules + [module])}"],
+        cwd=os.path.join(root, directory),
+        env={**os.environ, "PYTHONPATH": os.path.join(root, "lib")},
+        check=True,
+        capture_output=True,
+        universal_newlines=True,
+    )
+    times = {}
+    # lines look like "import time:       412 |       1093 |   pandas.core"
+    for line in completed_process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    failures = []
+    for module, (directory, budget) in budgets.items():
+        times = import_times(module, directory)
+        # the baseline modules are already imported, so the module's cumulative time is only what it adds
+        elapsed = times[module] / 1000
+        baseline = sum(times[m] for m in baseline_modules) / 1000
+        print(f"{module}: {elapsed:.0f}ms over {'/'.join(baseline_modules)} ({baseline:.0f}ms) (budget {budget}ms)")
+        if elapsed > budget:
+            failures.append(f"importing {module} took {elapsed:.0f}ms more than {'/'.join(baseline_modules)}, "
+                            f"over its budget of {budget}ms")
+        for heavy in heavy_modules:
+            if heavy in times:
+                failures.append(f"importing {module} also imports {heavy}")
+
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
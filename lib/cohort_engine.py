@@ -0,0 +1,267 @@
+import re
+
+import pandas as pd
+import numpy as np
+
+from eventcounts import eventcountseries
+from cohort_index import Mask
+
+
+# Summaries of the cohort (output/input.feather) through a common interface, so that
+# notebooks can switch between an in-memory pandas dataframe and out-of-core DuckDB
+# queries over the feather/parquet file with a flag, e.g.
+#
+#     cohort = open_cohort("../output/input.feather", engine="duckdb")
+#     cohort.count(["a_date", "b_date"], where=[("a_date", "<=", maxdate)], by="region")
+#
+# Filters are lists of (column, op, value) tuples which are ANDed together. `op` is one of
+# "<", "<=", ">", ">=", "==", "!=", "contains", or any of these prefixed with "not "
+# (missing values never satisfy a comparison, so they do satisfy its negation).
+# `value` is a literal, or Column("name") to compare two columns.
+# Filters which recur can be computed once as masks (see cohort_index.CohortIndex) and given
+# in place of a list of filters.
+
+
+class Column:
+    ''' Refers to another column as the value in a filter '''
+    def __init__(self, name):
+        self.name = name
+
+
+comparisons = {"<": "<", "<=": "<=", ">": ">", ">=": ">=", "==": "=", "!=": "<>"}
+
+
+def _split_op(op):
+    negate = op.startswith("not ")
+    return negate, op[4:] if negate else op
+
+
+def quote(name):
+    ''' Double-quote an identifier, as DuckDB, SQLite and SQL Server (QUOTED_IDENTIFIER is on for ODBC connections) accept '''
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_condition(filters, params):
+    ''' SQL for `filters` ANDed together ("" if there are none), appending the values to bind to `params`.
+    It runs on DuckDB, SQLite and SQL Server alike, so "contains" is a LIKE with the value's wildcards
+    escaped, and negations test the comparison in a case expression rather than as a boolean.
+    '''
+    conditions = []
+    for column, op, value in filters or []:
+        negate, op = _split_op(op)
+        if op == "contains":
+            condition = f"cast({quote(column)} as varchar(8000)) like ? escape '\\'"
+            params.append("%" + re.sub(r"([%_\[\\])", r"\\\1", str(value)) + "%")
+        elif isinstance(value, Column):
+            condition = f"{quote(column)} {comparisons[op]} {quote(value.name)}"
+        else:
+            condition = f"{quote(column)} {comparisons[op]} ?"
+            params.append(value.to_pydatetime() if isinstance(value, pd.Timestamp) else value)
+        # missing values never satisfy a comparison, so they do satisfy its negation
+        conditions.append(f"case when {condition} then 0 else 1 end = 1" if negate else condition)
+    return " and ".join(conditions)
+
+
+class PandasCohort:
+    ''' Cohort summaries computed on an in-memory dataframe '''
+
+    def __init__(self, df):
+        self.df = df
+
+    def _mask(self, filters):
+        if isinstance(filters, Mask):
+            return pd.Series(filters.to_numpy(), index=self.df.index)
+        mask = pd.Series(True, index=self.df.index)
+        for column, op, value in filters or []:
+            negate, op = _split_op(op)
+            left = self.df[column]
+            right = self.df[value.name] if isinstance(value, Column) else value
+            if op == "contains":
+                result = left.astype(str).str.contains(right, regex=False)
+            else:
+                result = {
+                    "<": left.lt, "<=": left.le, ">": left.gt, ">=": left.ge, "==": left.eq, "!=": left.ne,
+                }[op](right) & left.notna()
+                if isinstance(value, Column):
+                    result &= right.notna()
+            mask &= ~result if negate else result
+        return mask
+
+    def mask(self, filters):
+        ''' Boolean array of the rows matching `filters` '''
+        return self._mask(filters).to_numpy()
+
+    def max(self, column):
+        return self.df[column].max()
+
+    def unique(self, column):
+        return self.df[column].unique().tolist()
+
+    def select(self, columns, where=None):
+        ''' Return the given columns for rows matching `where` as a dataframe '''
+        return self.df.loc[self._mask(where), columns]
+
+    def events_near(self, key, columns, date, width, where=None):
+        ''' The dates in `columns` which are within `width` days of the `date` column in the same row, for rows
+        matching `where`, as a long dataframe of (key, event_date), e.g. the SUS events which could match a
+        treatment for window_matching.window_match_rates. Rows are only unpivoted after filtering.
+        '''
+        df = self.df.loc[self._mask(where), [key, date] + columns]
+        anchor = pd.to_datetime(df[date])
+        events = []
+        for c in columns:
+            near = (pd.to_datetime(df[c]) - anchor).abs() <= pd.Timedelta(days=width)
+            events.append(pd.DataFrame({key: df.loc[near, key], "event_date": pd.to_datetime(df.loc[near, c])}))
+        return pd.concat(events, ignore_index=True)
+
+    def count(self, columns, where=None, by=None, column_where=None):
+        ''' Count non-missing values in each of `columns` for rows matching `where`, optionally
+        grouped `by` a column. `column_where` is a dict of extra filters for individual columns.
+        Returns a Series indexed by column (or a DataFrame indexed by group if `by` is given).
+        '''
+        mask = self._mask(where)
+        df = self.df.loc[mask, columns + ([by] if by else [])].copy()
+        for column, filters in (column_where or {}).items():
+            df.loc[~self._mask(filters).loc[mask], column] = np.nan
+        if by:
+            return df.groupby(by)[columns].count()
+        return df[columns].count()
+
+    def event_counts(self, column, date_range, rule="D", where=None):
+        ''' Daily (or resampled) counts of the dates in `column`, as eventcountseries '''
+        return eventcountseries(self.df.loc[self._mask(where), column], date_range, rule=rule)
+
+
+class DuckDBCohort:
+    ''' Cohort summaries computed by DuckDB directly over a feather or parquet file.
+
+    The file is scanned in a streaming, multi-threaded way and only the (small) results are
+    returned to pandas. Set memory_limit (e.g. "4GB") and temp_directory to let large
+    aggregations spill to disk rather than exhausting memory.
+
+    binary_fields (list): columns in which zero is treated as missing, so `count` counts ones
+    month_fields (dict): {new column: date column} of "YYYY-MM" month columns to derive
+    '''
+
+    def __init__(self, path, binary_fields=(), month_fields=None, memory_limit=None, temp_directory=None, threads=None):
+        import duckdb
+
+        self.con = duckdb.connect()
+        if memory_limit:
+            self.con.execute(f"SET memory_limit = '{memory_limit}'")
+        if temp_directory:
+            self.con.execute(f"SET temp_directory = '{temp_directory}'")
+        if threads:
+            self.con.execute(f"SET threads = {int(threads)}")
+
+        if path.endswith(".parquet"):
+            source = f"read_parquet('{path}')"
+        else:
+            # feather (Arrow IPC) files are scanned through a pyarrow dataset, which DuckDB
+            # reads batch by batch with projection and filter pushdown
+            import pyarrow.dataset as ds
+            self.dataset = ds.dataset(path, format="feather")
+            self.con.register("cohort_file", self.dataset)
+            source = "cohort_file"
+
+        replace = ", ".join(f"nullif({self.quote(c)}, 0) as {self.quote(c)}" for c in binary_fields)
+        derived = "".join(
+            f", strftime(cast({self.quote(d)} as timestamp), '%Y-%m') as {self.quote(m)}" for m, d in (month_fields or {}).items()
+        )
+        self.con.execute(f"create view cohort as select * {f'replace ({replace})' if replace else ''}{derived} from {source}")
+
+    quote = staticmethod(quote)
+
+    def _day(self, column):
+        # (via timestamp, as feather timestamps are nanosecond precision and older DuckDB can't cast those to date)
+        return f"cast(cast({self.quote(column)} as timestamp) as date)"
+
+    def _condition(self, filters, params):
+        if isinstance(filters, Mask):
+            filters = filters.filters
+        return sql_condition(filters, params) or "true"
+
+    def query(self, sql, params=None):
+        return self.con.execute(sql, params or []).df()
+
+    def max(self, column):
+        return self.query(f"select max({self.quote(column)}) as m from cohort")["m"][0]
+
+    def unique(self, column):
+        return self.query(f"select distinct {self.quote(column)} as v from cohort")["v"].tolist()
+
+    def select(self, columns, where=None):
+        ''' As PandasCohort.select '''
+        params = []
+        condition = self._condition(where, params)
+        return self.query(f"select {', '.join(self.quote(c) for c in columns)} from cohort where {condition}", params)
+
+    def events_near(self, key, columns, date, width, where=None):
+        ''' As PandasCohort.events_near, filtering and unpivoting in DuckDB '''
+        params = []
+        selects = []
+        for c in columns:
+            condition = self._condition(where, params)
+            selects.append(
+                f"select {self.quote(key)}, cast({self.quote(c)} as timestamp) as event_date from cohort "
+                f"where {condition} and {self._day(c)} between {self._day(date)} - {int(width)} and {self._day(date)} + {int(width)}"
+            )
+        return self.query(" union all ".join(selects), params)
+
+    def count(self, columns, where=None, by=None, column_where=None):
+        ''' As PandasCohort.count '''
+        params = []
+        counts = []
+        for c in columns:
+            if c in (column_where or {}):
+                counts.append(f"count(case when {self._condition(column_where[c], params)} then {self.quote(c)} end) as {self.quote(c)}")
+            else:
+                counts.append(f"count({self.quote(c)}) as {self.quote(c)}")
+        condition = self._condition(where, params)
+
+        if by:
+            out = self.query(
+                f"select {self.quote(by)}, {', '.join(counts)} from cohort "
+                f"where {condition} and {self.quote(by)} is not null group by {self.quote(by)}",
+                params,
+            )
+            # sorted by group (DuckDB returns categoricals as strings, so these sort alphabetically
+            # rather than in category order)
+            return out.set_index(by).sort_index()
+        return self.query(f"select {', '.join(counts)} from cohort where {condition}", params).iloc[0]
+
+    def event_counts(self, column, date_range, rule="D", where=None):
+        ''' As PandasCohort.event_counts, aggregating by day in DuckDB '''
+        params = []
+        condition = self._condition(where, params)
+        out = self.query(
+            f"select {self._day(column)} as day, count(*) as n from cohort "
+            f"where {condition} and {self.quote(column)} is not null group by 1",
+            params,
+        )
+        counts = pd.Series(out["n"].to_numpy(), index=pd.to_datetime(out["day"]), name=column)
+        counts = counts.reindex(date_range.index, fill_value=0)
+        if rule != "D":
+            counts = counts.resample(rule).sum()
+        return counts
+
+
+def open_cohort(path, engine="pandas", binary_fields=(), month_fields=None, **kwargs):
+    ''' Open the cohort file at `path` with the given engine ("pandas" or "duckdb").
+
+    binary_fields (list): columns in which zero is treated as missing, so `count` counts ones
+    month_fields (dict): {new column: date column} of "YYYY-MM" month columns to derive
+    Other keyword arguments are passed to DuckDBCohort (memory_limit, temp_directory, threads).
+    '''
+    if engine == "duckdb":
+        return DuckDBCohort(path, binary_fields=binary_fields, month_fields=month_fields, **kwargs)
+    elif engine != "pandas":
+        raise ValueError(f"Unknown engine: {engine}")
+
+    df = pd.read_parquet(path) if path.endswith(".parquet") else pd.read_feather(path)
+    for f in binary_fields:
+        df[f] = df[f].astype('int64').replace(0, np.nan)
+    for m, d in (month_fields or {}).items():
+        # (dates may have been loaded as strings)
+        df[m] = pd.to_datetime(df[d]).dt.strftime('%Y-%m')
+    return PandasCohort(df)
@@ -0,0 +1,155 @@
+import numpy as np
+
+
+# Named row masks over a cohort, computed once and stored as packed bitsets, so that filters
+# which recur across a notebook's loops (treatment setting, MABs vs antivirals, within the SUS
+# date range, ...) cost a bitwise operation on n/8 bytes rather than another scan of the columns.
+#
+#     index = CohortIndex(cohort)
+#     index.define("in_range", [("outpatient_covid_therapeutic_date", "<=", maxdate)])
+#     index.define("mab", [("outpatient_covid_therapeutic_name", "contains", "mab")])
+#     cohort.count(columns, where=index["in_range"] & index["mab"])
+#
+# Masks combine with &, | and ~, and can be given to the cohort wherever it takes a list of
+# filters (`where`, and the values of `column_where`). On the duckdb engine there is nothing
+# in memory to index, so masks keep their filters instead, and only & can be used to combine them.
+
+
+class Mask:
+    ''' Rows of a cohort, as a packed bitset (or the filters which select them, for the duckdb engine) '''
+
+    def __init__(self, bits=None, n=0, filters=None):
+        self.bits = bits
+        self.n = n
+        self.filters = filters
+
+    @classmethod
+    def from_bool(cls, values, filters=None):
+        values = np.asarray(values, dtype=bool)
+        return cls(np.packbits(values), len(values), filters)
+
+    def to_numpy(self):
+        ''' The mask as a boolean array, one value per row '''
+        if self.bits is None:
+            raise ValueError("This mask only has filters (duckdb engine); use it as a `where` filter instead")
+        return np.unpackbits(self.bits, count=self.n).view(bool)
+
+    def sum(self):
+        ''' Number of rows selected '''
+        return int(_popcount[self.bits].sum())
+
+    def _combine(self, other, op):
+        if self.bits is None or other.bits is None:
+            raise ValueError("Masks on the duckdb engine can only be combined with &")
+        return Mask(op(self.bits, other.bits), self.n)
+
+    def __and__(self, other):
+        filters = self.filters + other.filters if self.filters is not None and other.filters is not None else None
+        if self.bits is None and other.bits is None:
+            return Mask(filters=filters)
+        mask = self._combine(other, np.bitwise_and)
+        mask.filters = filters
+        return mask
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or)
+
+    def __invert__(self):
+        if self.bits is None:
+            raise ValueError("Masks on the duckdb engine can't be negated; define the negated filters instead")
+        bits = np.invert(self.bits)
+        # clear the padding bits after the last row
+        if self.n % 8:
+            bits[-1] &= np.uint8(0xFF << (8 - self.n % 8) & 0xFF)
+        return Mask(bits, self.n)
+
+
+# number of bits set in each byte value
+_popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+class CohortIndex:
+    ''' Named masks over the rows of a cohort (from cohort_engine.open_cohort) '''
+
+    def __init__(self, cohort):
+        self.cohort = cohort
+        self.masks = {}
+
+    def define(self, name, filters):
+        ''' Compute the mask of rows matching `filters` (a list of (column, op, value) tuples, as for the
+        cohort's `where`) and store it as `name`. Returns the mask.
+        '''
+        if hasattr(self.cohort, "mask"):
+            self.masks[name] = Mask.from_bool(self.cohort.mask(filters), filters=list(filters))
+        else:
+            self.masks[name] = Mask(filters=list(filters))
+        return self.masks[name]
+
+    def __getitem__(self, name):
+        return self.masks[name]
+
+    def __contains__(self, name):
+        return name in self.masks
+
+    def all(self, *names):
+        ''' Rows in all of the named masks '''
+        mask = self.masks[names[0]]
+        for name in names[1:]:
+            mask = mask & self.masks[name]
+        return mask
+
+    def any(self, *names):
+        ''' Rows in any of the named masks '''
+        mask = self.masks[names[0]]
+        for name in names[1:]:
+            mask = mask | self.masks[name]
+        return mask
+
+
+
+if __name__ == "__main__":
+    # Compare re-evaluating the filters in a loop with combining precomputed masks
+    import time
+    import pandas as pd
+    from cohort_engine import PandasCohort
+    # (the classes as cohort_engine sees them, rather than this script's copies)
+    from cohort_index import CohortIndex
+
+    rng = np.random.default_rng(0)
+    n = 1_000_000
+    df = pd.DataFrame({
+        "name": rng.choice(["Sotrovimab", "Molnupiravir", "Paxlovid", "Casirivimab"], n),
+        "treatment_date": pd.Timestamp("2022-01-01") + pd.to_timedelta(rng.integers(0, 200, n), unit="D"),
+        "region": rng.choice(["East", "London", "North"], n),
+    })
+    cohort = PandasCohort(df)
+    maxdate = pd.Timestamp("2022-06-01")
+    in_range = [("treatment_date", "<=", maxdate)]
+    treatments = {"MABs": [("name", "contains", "mab")], "Antivirals": [("name", "not contains", "mab")]}
+    repeats = 10
+
+    start = time.perf_counter()
+    expected = [cohort.count(["treatment_date"], where=in_range + treatments[t], by="region")
+                for _ in range(repeats) for t in treatments]
+    filter_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = CohortIndex(cohort)
+    index.define("in_range", in_range)
+    for t in treatments:
+        index.define(t, treatments[t])
+    got = [cohort.count(["treatment_date"], where=index["in_range"] & index[t], by="region")
+           for _ in range(repeats) for t in treatments]
+    index_seconds = time.perf_counter() - start
+
+    for a, b in zip(expected, got):
+        pd.testing.assert_frame_equal(a, b)
+    print(f"{len(expected)} counts, filters evaluated each time: {filter_seconds:.2f}s")
+    print(f"{len(got)} counts, combining precomputed masks: {index_seconds:.2f}s")
+
+    # combinations agree with the boolean arrays they are packed from
+    a, b = index["MABs"], index["in_range"]
+    assert ((a | b).to_numpy() == (a.to_numpy() | b.to_numpy())).all()
+    assert ((~a).to_numpy() == index["Antivirals"].to_numpy()).all() and (~a).sum() + a.sum() == n
+    assert (a & b).filters == treatments["MABs"] + in_range
+    print("OK")
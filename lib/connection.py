@@ -0,0 +1,35 @@
+# pyodbc is imported when a connection is first opened rather than at import time,
+# so notebooks which only need the counting functions don't pay for it
+from contextlib import contextmanager
+
+
+
+# use this to open connection
+@contextmanager
+def closing_connection_old(server, database, username, password):
+    dsn = (
+        "DRIVER={ODBC Driver 17 for SQL Server};SERVER="
+        + server
+        + ";DATABASE="
+        + database
+        + ";UID="
+        + username
+        + ";PWD="
+        + password
+    )
+    import pyodbc
+    cnxn = pyodbc.connect(dsn)
+    try:
+        yield cnxn
+    finally:
+        cnxn.close()
+
+# use this to open connection
+@contextmanager
+def closing_connection(dbconn): 
+    import pyodbc
+    cnxn = pyodbc.connect(dbconn)
+    try: 
+        yield cnxn 
+    finally: 
+        cnxn.close()
@@ -0,0 +1,97 @@
+import pandas as pd
+import numpy as np
+
+from profiling import instrument
+
+
+def lttb_indices(x, y, n_out):
+    # positions of the points kept by largest-triangle-three-buckets downsampling
+    # x and y are numeric arrays of equal length, x sorted ascending
+    # the first and last points are always kept, plus one point per bucket in between
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    kept = np.empty(n_out, dtype=int)
+    kept[0] = 0
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+
+        # average of the next bucket (or the final point) is the third corner of the triangle
+        if i < n_out - 3:
+            nxt_start, nxt_end = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+            avg_x, avg_y = x[nxt_start:nxt_end].mean(), y[nxt_start:nxt_end].mean()
+        else:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        kept[i + 1] = a
+    kept[-1] = n - 1
+    return kept
+
+
+def minmax_indices(y, n_out):
+    # positions of the minimum and maximum point in each of n_out/2 equal buckets
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+
+    buckets = np.array_split(np.arange(n), n_out // 2)
+    kept = [0, n - 1]
+    for b in buckets:
+        kept.append(b[np.argmin(y[b])])
+        kept.append(b[np.argmax(y[b])])
+    return np.unique(kept)
+
+
+@instrument
+def downsample_counts(counts, n_out, method="lttb", keep=None):
+    # reduce a daily (or other regular) series/dataframe of counts to roughly n_out points before plotting
+    # method is "lttb" (largest-triangle-three-buckets) or "minmax" (min and max per bucket)
+    # overall peaks are always retained, as are any points flagged True in `keep` (e.g. redacted values)
+    # for a dataframe, the union of the points chosen for each column is kept so columns still share an index
+    if n_out is None or len(counts) <= n_out:
+        return counts
+
+    frame = counts.to_frame() if isinstance(counts, pd.Series) else counts
+    x = np.asarray(frame.index, dtype="datetime64[ns]").astype("int64").astype(float)
+
+    kept = set()
+    for col in frame.columns:
+        y = frame[col].to_numpy(dtype=float)
+        if method == "lttb":
+            idx = lttb_indices(x, y, n_out)
+        elif method == "minmax":
+            idx = minmax_indices(y, n_out)
+        else:
+            raise ValueError(f"Unknown downsampling method: {method}")
+        kept.update(idx.tolist())
+        kept.update([int(np.argmax(y)), int(np.argmin(y))])
+
+    if keep is not None:
+        kept.update(np.flatnonzero(np.asarray(keep, dtype=bool)).tolist())
+
+    return counts.iloc[sorted(kept)]
+
+
+
+if __name__ == "__main__":
+    # A quick check of downsample_counts on a multi-year daily series
+    rng = np.random.default_rng(0)
+    days = pd.date_range("2018-01-01", "2022-12-31", freq="D")
+    series = pd.Series(rng.poisson(50, len(days)).astype(float), index=days)
+    series.iloc[1000] = 5000
+    redact = pd.Series(False, index=days)
+    redact.iloc[[10, 500]] = True
+
+    for method in ["lttb", "minmax"]:
+        small = downsample_counts(series, 300, method=method, keep=redact)
+        assert len(small) <= 310
+        assert small.max() == 5000
+        assert small.index[0] == days[0] and small.index[-1] == days[-1]
+        assert days[10] in small.index and days[500] in small.index
+
+    print("OK")
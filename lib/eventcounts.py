@@ -0,0 +1,172 @@
+import pandas as pd
+import numpy as np
+
+from profiling import instrument
+
+
+@instrument
+def eventcountdf(event_dates, date_range, rule='D', popadjust=False):
+    # to calculate the daily count for events recorded in a dataframe
+    # where event_dates is a dataframe of date columns
+    # set popadjust = 1000, say, to report counts per 1000 population
+    
+    # initialise dataset
+    counts = date_range
+    
+    
+    for col in event_dates:
+
+        # Creates a series of the entry date of the index event
+        in_date = event_dates.loc[:, col]
+
+        counts = counts.join(
+            pd.DataFrame(in_date, columns=[col]).groupby(col)[col].count().to_frame()
+        )
+
+    # convert nan to zero
+    counts = counts.fillna(0)
+    
+    if rule != "D":
+        counts = counts.resample(rule).sum()
+    
+    if popadjust is not False:
+        pop = event_dates.shape[0]
+        poppern = pop/popadjust
+        counts = counts.transform(lambda x: x/poppern)
+    
+    return(counts)
+
+    
+
+
+@instrument
+def eventcountseries(event_dates, date_range, rule='D', popadjust=False):
+    # to calculate the daily count for events recorded in a series
+    # where event_dates is a series
+    # set popadjust = 1000, say, to report counts per 1000 population
+    
+    pop = event_dates.size
+    
+    counts = event_dates.value_counts().reindex(date_range.index, fill_value=0)
+    
+    
+    if rule != "D":
+        counts = counts.resample(rule).sum()
+    
+    if popadjust is not False:
+        pop = event_dates.size
+        poppern= pop/popadjust
+        counts = counts.transform(lambda x: x/poppern)
+    
+    return(counts)
+
+
+
+@instrument
+def dailycountseries(daily_counts, date_range, rule='D'):
+    # as eventcountseries, for events already counted by day (e.g. by sqlcounts.daily_counts)
+    # where daily_counts is a series of counts indexed by day
+
+    counts = daily_counts.reindex(date_range.index, fill_value=0)
+
+    if rule != "D":
+        counts = counts.resample(rule).sum()
+
+    return(counts)
+
+
+
+@instrument
+def firsteventcountdf(event_dates, date_range,  rule='D', popadjust=False):
+
+    # to calculate the daily number of events in a dataframe, taking first events only
+    # subsequent events are excluded, for instance if a patient is admitted to ICU twice only the first admission is observed). 
+
+    # initialise datasets
+    counts = date_range
+
+    for idx, col in enumerate(event_dates):
+
+        # Creates a series of the entry date of the index event
+        in_date = event_dates.iloc[:, idx]
+
+        counts = counts.join(
+            pd.DataFrame(in_date, columns=[col]).groupby(col)[col].count().to_frame()
+        )
+
+    # convert nan to zero
+    counts = counts.fillna(0)
+
+    if rule != "D":
+        counts = counts.resample(rule).sum()
+    
+    if popadjust is not False:
+        pop = event_dates.shape[0]
+        poppern= pop/popadjust
+        counts = counts.transform(lambda x: x/poppern)
+
+    return(counts)
+
+
+
+@instrument
+def eventcountcmldf(event_dates, date_range, rule = "D", popadjust=False):
+
+    # this plots the total number of people on each date who:
+    # have experienced a covid-related event on or before that date;
+    # have not experienced a 'more advanced' event on or before that date
+    # "more advanced" is based on the order Series appear in the event_dates data.frame
+
+    # interpreted as "the most advanced covid-related event you have experienced to date" summed over all patients in the dataset.
+
+    # initialise datasets
+    in_counts = date_range
+    out_counts = date_range
+   
+
+    for idx, col in enumerate(event_dates):
+
+        # Creates a series of the entry date of the index event
+        in_date = event_dates.iloc[:, idx]
+
+        # Creates a series of the earliest event date occurring _after_ the index event
+        if idx == len(event_dates.columns) - 1:
+            # or maximum date + 1 day if on the final column
+            out_date = [max(date_range.index) + pd.Timedelta(1, unit='D')] * len(event_dates.index)
+        else:
+            out_date = np.where(np.isnan(in_date), np.datetime64('NaT'), event_dates.iloc[:, idx + 1:].min(axis=1))
+
+        # removes in dates and out dates where a more advanced event occurs at an earlier date (ie ignores the later event if it is "less advanced")
+        in_date2 = np.where(((in_date > out_date) | np.isnan(in_date)), np.datetime64('NaT'), in_date)
+        out_date2 = np.where(((in_date > out_date) | np.isnan(in_date)), np.datetime64('NaT'), out_date)
+
+        in_counts = in_counts.join(
+            pd.DataFrame(in_date2, columns=[col]).groupby(col)[col].count().to_frame()
+        )
+        out_counts = out_counts.join(
+            pd.DataFrame(out_date2, columns=[col]).groupby(col)[col].count().to_frame()
+        )
+
+    # convert nan to zero
+    in_counts = in_counts.fillna(0)
+    out_counts = out_counts.fillna(0)
+
+    # count total entries/exits up to index date
+    in_counts_cml = in_counts.cumsum()
+    out_counts_cml = out_counts.cumsum()
+
+    # subtract numbers out from numbers in
+    net_counts = in_counts_cml.add(-out_counts_cml)
+
+    if rule != "D":
+        net_counts = net_counts.resample(rule).sum()
+    
+    if popadjust is not False:
+        pop = event_dates.shape[0]
+        poppern = pop/popadjust
+        net_counts = net_counts.transform(lambda x: x/poppern)
+
+    # remove "_date" from column name for better legend
+    #net_counts.columns = net_counts.columns.str.replace("_date", "", regex=False)
+
+    return(net_counts)
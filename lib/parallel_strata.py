@@ -0,0 +1,137 @@
+import pandas as pd
+import numpy as np
+from multiprocessing import Pool, shared_memory
+
+from profiling import instrument
+
+
+# Cumulative event curves per stratum (as eventcountcmldf) computed in a process pool.
+# The event dates are sorted by stratum and copied once into shared memory as integer day
+# offsets; each worker attaches to the same buffer and reads its stratum's rows as a
+# contiguous slice, so the dataframe is never pickled or copied per worker, and each task
+# only returns its (days x columns) curve.
+
+# view onto the shared buffer, set up in each worker by _attach
+_shared = {}
+
+# day offset used for missing dates
+missing = np.iinfo(np.int64).min
+
+
+def _attach(name, shape):
+    shm = shared_memory.SharedMemory(name=name)
+    # keep a reference to the SharedMemory object so the buffer stays mapped
+    _shared["buffer"] = shm
+    _shared["dates"] = np.ndarray(shape, dtype=np.int64, buffer=shm.buf)
+
+
+def cumulative_counts(dates, n_days, popadjust=False):
+    ''' Net cumulative counts as eventcountcmldf, for an array of day offsets from the start of
+    the date range (shape rows x columns, with missing dates as `missing`) and a range of n_days days.
+    Returns an array of shape (n_days, columns).
+    '''
+    n_rows, n_cols = dates.shape
+    net = np.zeros((n_days, n_cols))
+    for idx in range(n_cols):
+        in_date = dates[:, idx]
+        has_in = in_date != missing
+
+        if idx == n_cols - 1:
+            # maximum date + 1 day if on the final column
+            out_date = np.full(n_rows, n_days)
+        else:
+            # earliest more advanced event, or missing if there isn't one
+            later = np.where(dates[:, idx + 1:] == missing, np.iinfo(np.int64).max, dates[:, idx + 1:])
+            out_date = later.min(axis=1)
+            out_date[(out_date == np.iinfo(np.int64).max) | ~has_in] = missing
+        has_out = out_date != missing
+
+        # ignore the event if a more advanced event occurs at an earlier date
+        keep = has_in & ~(has_out & (in_date > out_date))
+
+        in_days = in_date[keep & (in_date >= 0) & (in_date < n_days)]
+        out_days = out_date[keep & has_out & (out_date >= 0) & (out_date < n_days)]
+        net[:, idx] = np.cumsum(np.bincount(in_days, minlength=n_days)) - np.cumsum(np.bincount(out_days, minlength=n_days))
+
+    if popadjust is not False:
+        net = net / (n_rows / popadjust)
+    return net
+
+
+def _stratum_task(args):
+    start, stop, n_days, popadjust = args
+    return cumulative_counts(_shared["dates"][start:stop], n_days, popadjust=popadjust)
+
+
+@instrument
+def eventcountcml_strata(df, date_cols, var, date_range, popadjust=False, processes=None):
+    ''' Compute eventcountcmldf(events, date_range) for the rows of each stratum of `var`, in parallel.
+
+    Inputs:
+    df (DataFrame): one row per patient, with the date columns and the stratifying variable
+    date_cols (list): date columns, in order of how "advanced" the event is
+    var (str): stratifying variable
+    date_range (DataFrame): empty dataframe indexed by day, as used by eventcountcmldf
+    popadjust (int or False): report counts per `popadjust` population of the stratum
+    processes (int): number of worker processes (default: number of cores)
+
+    Returns: dict of {stratum: DataFrame of net cumulative counts indexed by date_range.index}
+    '''
+    strata = sorted(df[var].dropna().unique())
+    codes = pd.Categorical(df[var], categories=strata).codes
+
+    # sort rows by stratum (dropping missing strata) so each stratum is a contiguous slice
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]
+    bounds = np.searchsorted(codes[order], np.arange(len(strata) + 1))
+
+    start = date_range.index.min()
+    n_days = len(date_range.index)
+    days = np.column_stack([
+        (pd.to_datetime(df[c].iloc[order]) - start).dt.days.fillna(missing).to_numpy(dtype=np.int64) for c in date_cols
+    ])
+
+    shm = shared_memory.SharedMemory(create=True, size=max(days.nbytes, 1))
+    try:
+        np.ndarray(days.shape, dtype=np.int64, buffer=shm.buf)[:] = days
+        shape = days.shape
+        del days
+
+        tasks = [(bounds[i], bounds[i + 1], n_days, popadjust) for i in range(len(strata))]
+        with Pool(processes, initializer=_attach, initargs=(shm.name, shape)) as pool:
+            curves = pool.map(_stratum_task, tasks)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return {
+        strat: pd.DataFrame(curve, index=date_range.index, columns=date_cols)
+        for strat, curve in zip(strata, curves)
+    }
+
+
+
+if __name__ == "__main__":
+    # A quick check of eventcountcml_strata against eventcountcmldf on each stratum in turn
+    from eventcounts import eventcountcmldf
+
+    rng = np.random.default_rng(0)
+    n = 5000
+    start = np.datetime64("2021-01-01")
+    date_cols = ["positive_test_date", "admitted_date", "died_date"]
+    df = pd.DataFrame({
+        c: pd.Series(start + rng.integers(0, 120, n).astype("timedelta64[D]")).where(rng.random(n) < p)
+        for c, p in zip(date_cols, [0.6, 0.3, 0.1])
+    })
+    df["region"] = pd.Series(rng.choice(["East", "London", "North"], n)).where(rng.random(n) < 0.95)
+    date_range = pd.DataFrame(index=pd.date_range("2021-01-01", "2021-04-30", freq="D"))
+
+    for popadjust in [False, 1000]:
+        curves = eventcountcml_strata(df, date_cols, "region", date_range, popadjust=popadjust, processes=2)
+        # rows with a missing region are in no stratum
+        assert sorted(curves) == ["East", "London", "North"]
+        for strat, curve in curves.items():
+            expected = eventcountcmldf(df.loc[df["region"] == strat, date_cols], date_range, popadjust=popadjust)
+            assert np.allclose(curve.to_numpy(), expected.to_numpy()), (strat, popadjust)
+
+    print("OK")
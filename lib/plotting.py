@@ -0,0 +1,359 @@
+# matplotlib is imported inside each plotting function rather than at import time,
+# so it is only loaded once a notebook actually draws a figure
+import pandas as pd
+import numpy as np
+
+from eventcounts import eventcountdf, eventcountseries, dailycountseries, eventcountcmldf
+from downsampling import downsample_counts
+from count_pyramid import CountPyramid, levels
+from parallel_strata import eventcountcml_strata
+from profiling import instrument
+
+
+@instrument
+def eventcounts_strata_plot(df, date_range, date_cols, var, panelheight=5, panelwidth=5, gridcols=1, rule = "D", popadjust=False,
+                            downsample=None, downsample_method="lttb"):
+    #### Plot event counts stratified by a categorical variable
+    # set downsample = 500, say, to plot at most ~500 points per line (see downsample_counts)
+    import matplotlib.pyplot as plt
+
+    event_dates = df.filter(items=date_cols + [var])
+    strata = sorted(event_dates[var].unique())
+    
+    gridrows = int(np.ceil(len(strata)/gridcols))
+    
+    figsize = (panelwidth*gridcols, panelheight*gridrows)
+
+    fig, axs = plt.subplots(gridrows, gridcols, figsize=figsize, sharey='all', sharex='all')
+     
+    for i, strat in enumerate(strata):
+          
+        col=i % gridcols
+        row=np.floor(i / gridcols).astype("int")
+            
+        events_cat = (event_dates[event_dates[var] == strat]).drop(var, 1)
+        count_cat = eventcountdf(events_cat, date_range, rule = "D", popadjust=popadjust)
+        count_cat = downsample_counts(count_cat, downsample, method=downsample_method)
+       
+       # axs[row, col] = plt.subplot(gs[i % gridrows, np.floor(i / gridrows).astype("int")])
+        for l in date_cols:
+            axs[row, col].plot(count_cat.index, count_cat[l], label=l)
+            
+        axs[row, col].set_title(strat, size=12)
+        #axs[row, col].set_ylim([0, maxy])  # set ymax across all subplots 
+        if i==0:
+            axs[row, col].legend(loc='upper left')
+    
+    for n, ax in enumerate(axs.flatten()):
+        
+        ax.xaxis.set_tick_params(labelbottom=True, labelrotation=70)
+        ax.yaxis.set_tick_params(labelleft=True)
+        if n>=len(strata):
+            ax.axis('off')
+    plt.subplots_adjust(wspace = 0.2,hspace = 0.5)
+    plt.show()
+
+
+@instrument
+def cmlinc_strata_plot(df, date_cols, var, date_range, panelheight=5, panelwidth=5, gridcols=1, popadjust=False,
+                       downsample=None, downsample_method="lttb", processes=1):
+    
+    #### Plot cumulative event counts stratified by a categorical variable
+    # set downsample = 500, say, to plot at most ~500 points per stratum (see downsample_counts)
+    # set processes = 4, say (or None for all cores), to compute the strata in parallel (see eventcountcml_strata)
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
+
+    event_dates = df.filter(items=date_cols + [var])
+    # (rows with a missing stratum are left out, as in eventcountcml_strata)
+    strata = sorted(event_dates[var].dropna().unique())
+    
+    gridrows = int(np.ceil(len(strata)/gridcols))
+    
+    figsize = (panelwidth*gridcols, panelheight*gridrows)
+
+    
+    fig = plt.figure(figsize=figsize)
+    gs = gridspec.GridSpec(gridrows,gridcols)  # grid layout for subplots (rows, cols)
+
+        
+    if popadjust==False:
+        maxy = event_dates.filter(items=date_cols).notna().any(axis=1).groupby(event_dates[var]).sum().max() * 1.05
+    else:
+        maxy = event_dates.filter(items=date_cols).notna().any(axis=1).groupby(event_dates[var]).mean().max() * 1.05 * popadjust
+        
+    if processes != 1:
+        curves = eventcountcml_strata(event_dates, [c for c in event_dates.columns if c != var], var, date_range,
+                                      popadjust=popadjust, processes=processes)
+
+    for i, strat in enumerate(strata):
+        if processes != 1:
+            cmlinc_cat = curves[strat]
+        else:
+            events_cat = (event_dates[event_dates[var] == strat]).drop(var, 1)            
+            cmlinc_cat = eventcountcmldf(events_cat, date_range, popadjust=popadjust)
+        cmlinc_cat = downsample_counts(cmlinc_cat, downsample, method=downsample_method)
+       
+        ax = plt.subplot(gs[np.floor(i / gridcols).astype("int"), i % gridcols])
+        ax.stackplot(cmlinc_cat.index, cmlinc_cat.to_numpy().transpose(), labels=cmlinc_cat.columns)
+        ax.set_title(strat, size=12)
+        ax.set_ylim([0, maxy])  # set ymax across all subplots 
+        ax.xaxis.set_tick_params(labelrotation=70)
+        if i==0:
+            ax.legend(loc='upper left')
+
+    plt.subplots_adjust(wspace = 0.2,hspace = 0.5)
+    plt.show()
+
+
+    
+@instrument
+def plotcounts(date_range, events=None, title="", lookback=30, downsample=None, downsample_method="lttb", counts=None):
+    # This function plots event counts over time both overall and for the last X days up to the most recent extracted event.  
+    # set downsample = 500, say, to plot at most ~500 points in the overall panel (the last X days are always plotted in full)
+    # pass counts (a series of daily counts, e.g. from sqlcounts.daily_counts) instead of events to plot events already counted by day
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    import matplotlib.patches as patches
+    startdate = date_range.index.min()
+    enddate = date_range.index.max()
+    if counts is not None:
+        lastdate = counts.index[counts > 0].max()
+        name = counts.name
+    else:
+        lastdate = events.max()
+        name = events.name
+    
+    
+    startdatestring = startdate.strftime('%Y-%m-%d')
+    enddatestring = enddate.strftime('%Y-%m-%d')
+    lastdatestring = lastdate.strftime('%Y-%m-%d')
+        
+    def createcounts(date_range, events, lastdate):
+        if counts is not None:
+            daily = dailycountseries(counts, date_range, rule="D")
+        else:
+            daily = eventcountseries(events, date_range, rule="D")
+
+        lastdaterecent = lastdate - pd.to_timedelta(lookback, unit="D")
+        
+        lastcounts = daily.loc[(daily.index >= lastdaterecent) & (daily.index <= lastdate)]
+
+        redact = (lastcounts <6) & (lastcounts>0)
+        lastcounts = lastcounts.where(~redact, 2.5) #redact small numbers
+        
+        return daily, lastcounts, redact
+    
+    daily, lastcounts, redact = createcounts(date_range, events, lastdate)
+    
+   # xlimlower = mdates.date2num(lastcounts.index[0]+pd.DateOffset(days=-1))
+   # xlimupper = mdates.date2num(lastcounts.index[-1]+pd.DateOffset(days=+1))
+    
+    fig, axs = plt.subplots(1, 2, figsize=(15,5))
+    
+    axs[1].plot(lastcounts.index, lastcounts, label=name, marker='o', markersize=5, color='darkblue', zorder=1)
+    axs[1].plot(lastcounts[redact].index, lastcounts[redact], 'o', linestyle = 'None', color='tomato', zorder=2)
+    axs[1].xaxis.set_tick_params(labelrotation=70)
+    axs[1].xaxis.set_major_locator(ticker.MultipleLocator(2))
+    axs[1].set_ylim(bottom=0)
+    xlimlower1, xlimupper1 = axs[1].get_xlim()
+    ylimlower1, ylimupper1 = axs[1].get_ylim()
+    axs[1].set_ylim(bottom=0, top=max([ylimupper1, 7]))
+    axs[1].add_patch(patches.Rectangle((xlimlower1,0) ,xlimupper1-xlimlower1, 5.5, linewidth=1,edgecolor='none',facecolor='mistyrose', zorder=3))
+    axs[1].grid(True)
+    axs[1].spines["left"].set_visible(False)
+    axs[1].spines["right"].set_visible(False)
+    axs[1].set_title(f"""\n\n Last {str(lookback)} days up to {lastdatestring}""")
+    axs[1].set_facecolor('floralwhite')
+    
+    daily = downsample_counts(daily, downsample, method=downsample_method)
+    axs[0].plot(daily.index, daily, color='darkblue', zorder=2)
+    axs[0].set_ylabel('event counts')
+    axs[0].xaxis.set_tick_params(labelrotation=70)
+    axs[0].set_ylim(bottom=0)
+    axs[0].grid(True)
+    axs[0].spines["left"].set_visible(False)
+    axs[0].spines["right"].set_visible(False)
+    axs[0].set_title(f"""\n\n From {startdatestring} to {enddatestring}""")
+    xlimlower0, xlimupper0 = axs[0].get_xlim()
+    ylimlower0, ylimupper0 = axs[0].get_ylim()
+    axs[0].add_patch(patches.Rectangle((xlimlower1,0), xlimupper1-xlimlower1, max([ylimupper1, 7]), linewidth=1, edgecolor='orange', linestyle='--', facecolor='floralwhite', zorder=1))
+    axs[0].add_patch(patches.Rectangle((xlimlower0,0) ,xlimupper0-xlimlower0, 5, linewidth=1, edgecolor='none', facecolor='mistyrose', zorder=3))
+    
+    axs[0].annotate("Disclaimer: counts are based on raw event data and should not be used for clinical or epidemiological inference", xy=(0, -0.1), xycords='axes fraction', ha='left')
+    
+    
+    plt.subplots_adjust(top=0.8, wspace = 0.2, hspace = 0.9)
+    plt.tight_layout()
+    fig.suptitle("\n"+title, y=1, fontsize='x-large')
+    plt.show()
+
+    
+@instrument
+def plotcounts_history(events=None, title="", downsample=None, downsample_method="lttb", counts=None):
+    # This function plots event counts over time both overall and for the last X days up to the most recent extracted event.  
+    # set downsample = 500, say, to plot at most ~500 daily points; peaks and redacted days are always kept
+    # pass counts (a series of daily counts, e.g. from sqlcounts.daily_counts) instead of events to plot events already counted by day
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+    if counts is not None:
+        startdate = counts.index[counts > 0].min()
+        enddate = counts.index[counts > 0].max()
+    else:
+        startdate = events.min()
+        enddate = events.max()
+    
+    date_range = pd.DataFrame(
+        index = pd.date_range(start=startdate, end=enddate, freq="D")
+    )
+    
+    startdatestring = startdate.strftime('%Y-%m-%d')
+    enddatestring = enddate.strftime('%Y-%m-%d')
+    
+
+    # day and week counts from one pass over the events (weeks labelled by their Monday)
+    if counts is not None:
+        pyramid = CountPyramid.from_daily(dailycountseries(counts, date_range, rule="D"))
+    else:
+        pyramid = CountPyramid.from_events(events, start=startdate, end=enddate)
+    counts_day = pyramid.counts("D").iloc[:, 0]
+    counts_week = pyramid.counts("W").iloc[:, 0]
+    redact_day = (counts_day <6) & (counts_day>0)
+    counts_day = counts_day.where(~redact_day, 2.5) #redact small numbers
+    
+    redact_week = (counts_week <6) & (counts_week>0)
+    counts_week = counts_week.where(~redact_week, 2.5) #redact small numbers
+
+    counts_day = downsample_counts(counts_day, downsample, method=downsample_method, keep=redact_day)
+    counts_week = downsample_counts(counts_week, downsample, method=downsample_method, keep=redact_week)
+       
+    fig, axs = plt.subplots(1, 1, figsize=(15,5))
+    
+    axs.plot(counts_day.index, counts_day, color='darkblue', zorder=2)
+    axs.plot(counts_week.index + pd.DateOffset(3), counts_week/7, color='orange', zorder=3)
+    axs.set_ylabel('event counts')
+    axs.xaxis.set_tick_params(labelrotation=70)
+    axs.set_ylim(bottom=0)
+    axs.grid(True)
+    axs.spines["left"].set_visible(False)
+    axs.spines["right"].set_visible(False)
+    axs.set_title(f"""\n\n From {startdatestring} to {enddatestring}""")
+    xlimlower, xlimupper = axs.get_xlim()
+    ylimlower, ylimupper = axs.get_ylim()
+    axs.add_patch(patches.Rectangle((xlimlower,0) ,xlimupper-xlimlower, 5, linewidth=1, edgecolor='none', facecolor='mistyrose', zorder=4))
+       
+    plt.subplots_adjust(top=0.8, wspace = 0.2, hspace = 0.9)
+    plt.tight_layout()
+    fig.suptitle("\n"+title, y=1, fontsize='x-large')
+    plt.show()
+
+
+
+@instrument
+def plotcounts_interactive(pyramid, title="", max_points=1000, series=None, widget=None):
+    # This function plots counts from a CountPyramid (see count_pyramid) with plotly, at the finest resolution
+    # (day, week, month or quarter) with at most max_points periods in view, so multi-year series can be panned and zoomed.
+    # The buttons above the plot choose the resolution. As a widget (widget=True, or by default when running in a
+    # notebook kernel) the resolution also follows the zoom, switching between counts already in the pyramid rather
+    # than counting again; widgets need the kernel, so use widget=False for figures to be saved or exported.
+    # Counts are shown per day (each period's total over the days it covers) so the resolutions share a scale,
+    # and totals of 1-5 are shown as 2.5, as in plotcounts_history.
+    # series: names of the series to plot (default all). Returns the figure, to display.
+    import plotly.graph_objects as go
+    names = pyramid.names if series is None else series
+    initial = pyramid.level_for(max_points=max_points)
+    labels = {"D": "day", "W": "week", "M": "month", "Q": "quarter"}
+
+    fig = go.Figure()
+    trace_levels = []
+    for level in levels:
+        totals = pyramid.counts(level)
+        for name in names:
+            total = totals[name].astype(float)
+            redact = (total < 6) & (total > 0)
+            fig.add_trace(go.Scatter(
+                x=totals.index, y=total.where(~redact, 2.5) / pyramid.lengths[level],
+                customdata=np.where(redact, "1-5", total.astype(int).astype(str)),
+                name=f"{', '.join(map(str, name)) if isinstance(name, tuple) else name} ({labels[level]})", mode="lines", line_shape="hv" if level != "D" else "linear",
+                visible=level == initial,
+                hovertemplate=f"%{{x|%Y-%m-%d}}: %{{customdata}} events in the {labels[level]}<extra></extra>",
+            ))
+            trace_levels.append(level)
+
+    buttons = [dict(label=f"by {labels[level]}", method="restyle", args=[{"visible": [l == level for l in trace_levels]}])
+               for level in levels]
+    fig.update_layout(
+        title=title, yaxis_title="event counts per day", xaxis_rangeslider_visible=True,
+        updatemenus=[dict(type="buttons", direction="right", buttons=buttons, x=0, y=1.15, xanchor="left")],
+        shapes=[dict(type="rect", xref="paper", x0=0, x1=1, y0=0, y1=5, fillcolor="mistyrose", line_width=0, layer="below")],
+    )
+
+    if widget is None:
+        widget = _in_kernel()
+    if not widget:
+        return fig
+    fig = go.FigureWidget(fig)
+
+    def zoomed(layout, xrange):
+        level = pyramid.level_for(*(xrange or (None, None)), max_points=max_points)
+        with fig.batch_update():
+            for trace, trace_level in zip(fig.data, trace_levels):
+                trace.visible = trace_level == level
+
+    fig.layout.on_change(zoomed, "xaxis.range")
+    return fig
+
+
+def _in_kernel():
+    # whether we are running in an IPython kernel (e.g. a notebook), which widgets need
+    try:
+        from IPython import get_ipython
+    except ImportError:
+        return False
+    return getattr(get_ipython(), "kernel", None) is not None
+
+
+
+if __name__ == "__main__":
+    # A benchmark of plotcounts_history for a long daily series, with and without downsampling.
+    # matplotlib already simplifies long lines as it renders them, so downsampling doesn't make drawing
+    # quicker; what it saves is the size of vector output (svg/pdf, e.g. figures saved or exported from
+    # notebooks), which otherwise keeps every point. It is off unless `downsample` is given.
+    import io
+    import time
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    rng = np.random.default_rng(0)
+    days = pd.date_range("2003-01-01", "2022-12-31", freq="D")
+    events = pd.Series(days.repeat(rng.poisson(20, len(days))), name="event_date")
+
+    sizes = []
+    def save_and_close():
+        # force a full render as svg, as plt.show() does nothing with the Agg backend
+        buffer = io.BytesIO()
+        plt.gcf().savefig(buffer, format="svg")
+        sizes.append(len(buffer.getvalue()))
+        plt.close("all")
+    plt.show = save_and_close
+
+    for downsample in [None, 500]:
+        start = time.perf_counter()
+        for _ in range(3):
+            plotcounts_history(events, title="benchmark", downsample=downsample)
+        print(f"plotcounts_history, {len(days)} days, downsample={downsample}: "
+              f"{(time.perf_counter() - start) / 3:.3f}s and {sizes[-1] / 1e3:.0f}kB of svg per figure")
+
+    # the interactive plot starts at the finest resolution showing at most max_points periods, with every
+    # resolution already in the figure
+    pyramid = CountPyramid.from_events(events)
+    start = time.perf_counter()
+    fig = plotcounts_interactive(pyramid, title="benchmark")
+    print(f"plotcounts_interactive: {time.perf_counter() - start:.3f}s per figure")
+    assert [trace.name for trace in fig.data if trace.visible] == ["event_date (month)"]
+    assert len(fig.data) == len(levels) and pyramid.level_for("2021-01-01", "2021-12-31") == "D"
+    # outside a kernel it is a plain figure, whose buttons choose the resolution
+    import plotly.graph_objects as go
+    assert type(fig) is go.Figure and len(fig.layout.updatemenus[0].buttons) == len(levels)
+    print("OK")
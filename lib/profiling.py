@@ -0,0 +1,140 @@
+import functools
+import json
+import os
+import time
+import tracemalloc
+
+
+# Opt-in instrumentation for the notebook helpers, to find out which helper is
+# responsible when a notebook runs out of memory. Decorate a function with
+# @instrument, then either set NOTEBOOK_PROFILE=1 in the environment or call
+# enable_profiling() at the top of the notebook. For every call to an instrumented
+# function this records:
+#   - wall time
+#   - peak memory traced by tracemalloc during the call
+#   - the largest allocations still held at the end of the call (by source line)
+#   - the size of any dataframes/series returned
+# and profile_summary() / save_profile() report the results. When profiling is
+# disabled the only overhead is checking a flag.
+#
+# e.g. in a notebook:
+#     from profiling import enable_profiling, profile_summary, save_profile
+#     enable_profiling()
+#     ...
+#     display(profile_summary())
+#     save_profile("profile_data_summary.json")
+
+_enabled = os.environ.get("NOTEBOOK_PROFILE", "") not in ("", "0")
+_top_allocations = 3
+_records = []
+# running peak memory of each instrumented call in progress, outermost first
+_peaks = []
+
+
+def enable_profiling(top_allocations=3):
+    ''' Start recording calls to instrumented functions.
+    top_allocations (int): number of allocation sites to record per call (0 to skip the snapshot, which is slower)
+    '''
+    global _enabled, _top_allocations
+    _enabled = True
+    _top_allocations = top_allocations
+
+
+def disable_profiling():
+    global _enabled
+    _enabled = False
+
+
+def reset_profile():
+    _records.clear()
+
+
+def _frame_sizes(result):
+    # memory used by any dataframes/series returned, directly or in a tuple
+    items = result if isinstance(result, tuple) else (result,)
+    sizes = []
+    for item in items:
+        if hasattr(item, "memory_usage") and hasattr(item, "shape"):
+            usage = item.memory_usage(deep=True)
+            total = usage.sum() if hasattr(usage, "sum") else usage
+            sizes.append({"shape": list(item.shape), "bytes": int(total)})
+    return sizes
+
+
+def instrument(func):
+    ''' Decorator recording time and memory use of each call when profiling is enabled '''
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, "reset_peak"):
+            # pass the caller's peak so far up before resetting it for this call
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        # without reset_peak (python < 3.9), the peak for a nested call may include
+        # memory allocated by its caller before the call started
+        start_memory, _ = tracemalloc.get_traced_memory()
+
+        _peaks.append(0)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = max(_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+
+            allocations = []
+            if _top_allocations:
+                snapshot = tracemalloc.take_snapshot()
+                for stat in snapshot.statistics("lineno")[:_top_allocations]:
+                    frame = stat.traceback[0]
+                    allocations.append({"location": f"{frame.filename}:{frame.lineno}", "bytes": stat.size})
+            if started_tracing:
+                tracemalloc.stop()
+
+            _records.append({
+                "function": f"{func.__module__}.{func.__qualname__}",
+                "depth": len(_peaks),
+                "seconds": round(elapsed, 4),
+                "peak_bytes": max(peak - start_memory, 0),
+                "largest_allocations": allocations,
+            })
+        _records[-1]["returned"] = _frame_sizes(result)
+        return result
+
+    return wrapper
+
+
+def profile_records():
+    ''' All recorded calls, in the order they finished '''
+    return list(_records)
+
+
+def profile_summary(by_call=False):
+    ''' Summarise recorded calls as a dataframe, either one row per call or (by default) one row per
+    function with the number of calls, total and max seconds, and max peak memory in MB
+    '''
+    import pandas as pd
+
+    df = pd.DataFrame(_records, columns=["function", "depth", "seconds", "peak_bytes", "largest_allocations", "returned"])
+    df["peak_mb"] = (df["peak_bytes"] / 2**20).round(1)
+    if by_call:
+        return df.drop(columns=["peak_bytes"])
+    summary = df.groupby("function").agg(
+        calls=("seconds", "size"), total_seconds=("seconds", "sum"), max_seconds=("seconds", "max"), max_peak_mb=("peak_mb", "max")
+    )
+    return summary.sort_values("max_peak_mb", ascending=False)
+
+
+def save_profile(path):
+    ''' Write all recorded calls to a JSON file '''
+    with open(path, "w") as f:
+        json.dump(_records, f, indent=1)
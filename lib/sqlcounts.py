@@ -0,0 +1,105 @@
+import pandas as pd
+
+from cohort_engine import quote, sql_condition
+from profiling import instrument
+
+
+# Daily event counts aggregated in the database, for event tables too large to fetch every
+# event date: only one row per day (per stratum) is transferred, however many events there are.
+# The counts can be passed straight to the plotting functions in place of the event dates, e.g.
+#
+#     with closing_connection(dbconn) as cnxn:
+#         counts = daily_counts(cnxn, "Therapeutics", "TreatmentStartDate",
+#                               where=[("Intervention", "==", "Sotrovimab")])
+#     plotcounts_history(counts=counts, title="Sotrovimab")
+#
+# Filters are (column, op, value) tuples as for cohort_engine, bound as query parameters, and
+# the SQL is built with cohort_engine's quote and sql_condition, which DuckDB, SQLite and SQL
+# Server all accept.
+
+
+def daily_counts_query(table, date_column, where=None, by=None):
+    ''' SQL (and its parameters) counting the events in `table` on each day of `date_column`,
+    optionally by the stratum in column `by`
+    '''
+    params = []
+    day = f"cast({quote(date_column)} as date)"
+    condition = sql_condition(where, params)
+    keys = [day] + ([quote(by)] if by else [])
+    sql = (
+        f"select {', '.join(keys)}, count(*) from {quote(table)} "
+        f"where {quote(date_column)} is not null{f' and {condition}' if condition else ''} "
+        f"group by {', '.join(keys)}"
+    )
+    return sql, params
+
+
+@instrument
+def daily_counts(cnxn, table, date_column, where=None, by=None, date_range=None):
+    ''' Count the events in `table` on each day of `date_column` in the database.
+
+    cnxn: open DB-API connection (e.g. from closing_connection)
+    where (list): filters, as (column, op, value) tuples
+    by (str): column to stratify by
+    date_range (DataFrame): if given, counts are reindexed to its (daily) index, with zero for days without events
+
+    Returns a Series of counts indexed by day and named `date_column`, as the value_counts of the
+    event dates would be (or, if `by` is given, a DataFrame with a column for each stratum).
+    '''
+    sql, params = daily_counts_query(table, date_column, where=where, by=by)
+    cursor = cnxn.cursor()
+    try:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    columns = ["day"] + (["stratum"] if by else []) + ["n"]
+    out = pd.DataFrame.from_records([tuple(r) for r in rows], columns=columns)
+    out["day"] = pd.to_datetime(out["day"])
+    if by:
+        counts = out.pivot_table(index="day", columns="stratum", values="n", aggfunc="sum", fill_value=0)
+        counts.columns.name = by
+    else:
+        counts = out.set_index("day")["n"].rename(date_column)
+    counts = counts.sort_index().rename_axis(None)
+    if date_range is not None:
+        counts = counts.reindex(date_range.index, fill_value=0)
+    return counts
+
+
+
+if __name__ == "__main__":
+    # Compare fetching every event date and counting in pandas with counting in the database,
+    # using an in-memory DuckDB table of events
+    import time
+    import duckdb
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    days = pd.date_range("2020-01-01", "2022-12-31", freq="D")
+    n = 5_000_000
+    events = pd.DataFrame({
+        "event_date": days[rng.integers(0, len(days), n)] + pd.to_timedelta(rng.integers(0, 86400, n), unit="s"),
+        "region": rng.choice(["East", "London", "North"], n),
+    })
+    con = duckdb.connect()
+    con.register("events_df", events)
+    con.execute("create table events as select * from events_df")
+
+    start = time.perf_counter()
+    fetched = pd.Series([r[0] for r in con.execute("select event_date from events where region = 'East'").fetchall()])
+    expected = fetched.dt.normalize().value_counts().sort_index()
+    print(f"fetch {len(fetched)} events and count: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    counts = daily_counts(con, "events", "event_date", where=[("region", "==", "East")])
+    print(f"daily_counts ({len(counts)} rows transferred): {time.perf_counter() - start:.2f}s")
+    assert (counts.to_numpy() == expected.to_numpy()).all() and (counts.index == expected.index).all()
+
+    strata = daily_counts(con, "events", "event_date", by="region")
+    assert (strata["East"] == counts).all() and strata.to_numpy().sum() == n
+    assert (daily_counts(con, "events", "event_date", where=[("region", "contains", "ast")]) == counts).all()
+    others = daily_counts(con, "events", "event_date", where=[("region", "not ==", "East")])
+    assert others.sum() + counts.sum() == n
+    print("OK")
@@ -0,0 +1,299 @@
+"""Generate a large synthetic cohort from the return_expectations in the study definition.
+
+This is for load testing the notebooks locally with far more rows than the dummy
+data produced by cohortextractor. The study definition is parsed (not run, so
+cohortextractor isn't needed) and each variable is sampled with vectorised NumPy
+in chunks of rows, which are streamed to a feather or parquet file, so memory use
+is bounded by the chunk size rather than the number of rows.
+
+Dates which are defined relative to another variable (e.g. `between` the
+outpatient treatment date +/- 3 days, or `on_or_before` the inpatient treatment
+date) are sampled within that window, and are missing where the variable they
+depend on is missing. In that case the incidence applies to the rows where the
+other variable is present.
+
+Usage: python lib/synthetic_cohort.py --rows 10000000 --output output/input.feather
+"""
+import argparse
+import ast
+import datetime
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+date_returning = ["date", "date_admitted", "date_discharged"]
+
+# e.g. "outpatient_covid_therapeutic_date - 3 days"
+date_expression = re.compile(r"^\s*([\w-]+)\s*(?:([+-])\s*(\d+)\s*days?)?\s*$")
+
+
+def _literal(node, constants):
+    # evaluate a literal node, substituting names assigned to constants at module level
+    if isinstance(node, ast.Name):
+        return constants[node.id]
+    return ast.literal_eval(node)
+
+
+def parse_study_definition(path):
+    ''' Read the variables from a study definition without running it.
+
+    Returns (index_date, default_expectations, variables) where variables is a dict of
+    {name: {"function": ..., "args": [...], **keyword arguments}} in definition order.
+    Only literal keyword arguments are kept; codelists and nested variables are ignored.
+    '''
+    with open(path) as f:
+        tree = ast.parse(f.read())
+
+    # module-level constants, e.g. campaign_start = "2021-12-16"
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+
+    study = next(
+        node for node in ast.walk(tree)
+        if isinstance(node, ast.Call) and getattr(node.func, "id", None) == "StudyDefinition"
+    )
+
+    index_date = None
+    default_expectations = {}
+    variables = {}
+    for keyword in study.keywords:
+        if keyword.arg == "index_date":
+            index_date = _literal(keyword.value, constants)
+        elif keyword.arg == "default_expectations":
+            default_expectations = _literal(keyword.value, constants)
+        elif keyword.arg == "population":
+            continue
+        elif isinstance(keyword.value, ast.Call) and isinstance(keyword.value.func, ast.Attribute):
+            variable = {"function": keyword.value.func.attr, "args": []}
+            for arg in keyword.value.args:
+                try:
+                    variable["args"].append(_literal(arg, constants))
+                except (ValueError, KeyError):
+                    pass
+            for kw in keyword.value.keywords:
+                try:
+                    variable[kw.arg] = _literal(kw.value, constants)
+                except (ValueError, KeyError):
+                    pass
+            variables[keyword.arg] = variable
+
+    return index_date, default_expectations, variables
+
+
+class CohortGenerator:
+    ''' Samples chunks of a cohort from the parsed study definition.
+
+    Inputs:
+    index_date (str): study index date, substituted for "index_date" in expectations
+    default_expectations (dict): defaults applied to every variable's return_expectations
+    variables (dict): as returned by parse_study_definition
+    seed (int): seed for the random number generator
+    '''
+
+    def __init__(self, index_date, default_expectations, variables, seed=0):
+        self.index_date = index_date
+        self.default_expectations = default_expectations
+        self.variables = variables
+        self.seed = seed
+
+    @classmethod
+    def from_study_definition(cls, path=None, seed=0):
+        if path is None:
+            path = os.path.join(root, "analysis", "study_definition.py")
+        return cls(*parse_study_definition(path), seed=seed)
+
+    def _to_day(self, value):
+        # days since the epoch for a date string, "today" or "index_date"
+        if value == "today":
+            value = datetime.date.today().isoformat()
+        elif value == "index_date":
+            value = self.index_date
+        return int(np.datetime64(value, "D").astype(np.int64))
+
+    def expectations(self, name):
+        variable = self.variables[name]
+        expectations = {k: v for k, v in self.default_expectations.items()}
+        own = variable.get("return_expectations", {})
+        for key, value in own.items():
+            if isinstance(value, dict) and isinstance(expectations.get(key), dict):
+                expectations[key] = {**expectations[key], **value}
+            else:
+                expectations[key] = value
+        if "incidence" not in own and own.get("rate") == "universal":
+            expectations["incidence"] = 1
+        return expectations
+
+    def kind(self, name):
+        variable = self.variables[name]
+        expectations = variable.get("return_expectations", {})
+        if "category" in expectations:
+            return "category"
+        if variable["function"] in ["minimum_of", "maximum_of"]:
+            return "date_aggregate"
+        if variable.get("returning") in date_returning or "date_format" in variable:
+            return "date"
+        if "int" in expectations or variable.get("returning") in ["total_bed_days_in_period", "number_of_matches_in_period"]:
+            return "int"
+        return "binary"
+
+    def _window(self, name):
+        # return (reference variable, lower offset, upper offset) for dates defined relative
+        # to another variable, or None if the date isn't relative to another variable
+        variable = self.variables[name]
+        if "between" in variable:
+            bounds = [date_expression.match(b) for b in variable["between"]]
+            if all(bounds) and bounds[0].group(1) == bounds[1].group(1) and bounds[0].group(1) in self.variables:
+                offsets = [int(f"{b.group(2) or '+'}{b.group(3) or 0}") for b in bounds]
+                if variable.get("returning") == "date_discharged":
+                    # discharge follows the admission matched by the window
+                    offsets[1] += 14
+                return bounds[0].group(1), offsets[0], offsets[1]
+        for key in ["on_or_before", "on_or_after"]:
+            if variable.get(key) in self.variables:
+                return variable[key], key, None
+        return None
+
+    def _dates(self, name, n, rng, columns):
+        expectations = self.expectations(name)
+        variable = self.variables[name]
+        earliest = self._to_day(expectations["date"].get("earliest", "index_date"))
+        latest = self._to_day(expectations["date"].get("latest", "today"))
+        for key, bound in [("on_or_after", "earliest"), ("on_or_before", "latest")]:
+            value = variable.get(key)
+            if value and value not in self.variables:
+                if bound == "earliest":
+                    earliest = max(earliest, self._to_day(value))
+                else:
+                    latest = min(latest, self._to_day(value))
+
+        u = rng.random(n)
+        present = rng.random(n) < expectations.get("incidence", 1)
+        window = self._window(name)
+
+        if window is None:
+            span = max(latest - earliest, 0) + 1
+            if expectations.get("rate") == "exponential_increase":
+                u = np.log1p(u * (np.e ** 3 - 1)) / 3
+            days = earliest + np.floor(u * span)
+        else:
+            reference, lower, upper = window
+            ref_dates = self.column(reference, n, rng, columns)
+            ref = ref_dates.to_numpy(dtype="datetime64[D]").astype(np.int64).astype(float)
+            ref[ref_dates.isna().to_numpy()] = np.nan
+            if lower == "on_or_before":
+                start = np.minimum(earliest, ref)
+                days = start + np.floor(u * (ref - start + 1))
+            elif lower == "on_or_after":
+                end = np.maximum(latest, ref)
+                days = ref + np.floor(u * (end - ref + 1))
+            else:
+                days = ref + lower + np.floor(u * (upper - lower + 1))
+            present &= ~np.isnan(ref)
+
+        # built with numpy: pd.to_datetime(unit="D") converts a float array one element at a time
+        missing = ~present | np.isnan(days)
+        values = np.datetime64("1970-01-01", "D") + np.where(missing, 0, days).astype(np.int64).astype("timedelta64[D]")
+        values[missing] = np.datetime64("NaT")
+        return pd.Series(values.astype("datetime64[ns]"), name=name)
+
+    def column(self, name, n, rng, columns):
+        ''' Return the column for `name` in the current chunk, generating it (and any
+        columns it depends on) if it hasn't been generated yet
+        '''
+        if name in columns:
+            return columns[name]
+
+        variable = self.variables[name]
+        expectations = self.expectations(name)
+        kind = self.kind(name)
+
+        if kind == "category":
+            ratios = expectations["category"]["ratios"]
+            categories = list(ratios.keys())
+            p = np.array(list(ratios.values()), dtype=float)
+            codes = rng.choice(len(categories), size=n, p=p / p.sum())
+            codes[rng.random(n) >= expectations.get("incidence", 1)] = -1
+            values = pd.Series(pd.Categorical.from_codes(codes, categories=categories), name=name)
+        elif kind == "date":
+            values = self._dates(name, n, rng, columns)
+        elif kind == "date_aggregate":
+            others = pd.concat([self.column(arg, n, rng, columns) for arg in variable["args"]], axis=1)
+            values = others.min(axis=1) if variable["function"] == "minimum_of" else others.max(axis=1)
+            values.name = name
+        elif kind == "int":
+            distribution = expectations.get("int", {"distribution": "normal", "mean": 5, "stddev": 2})
+            values = pd.Series(
+                np.maximum(np.round(rng.normal(distribution.get("mean", 5), distribution.get("stddev", 2), n)), 0).astype(np.int64),
+                name=name,
+            )
+        else:
+            values = pd.Series((rng.random(n) < expectations.get("incidence", 1)).astype(np.int64), name=name)
+
+        columns[name] = values
+        return values
+
+    def chunk(self, start, n):
+        ''' Generate rows start to start+n as a dataframe '''
+        rng = np.random.default_rng([self.seed, start])
+        columns = {}
+        for name in self.variables:
+            self.column(name, n, rng, columns)
+        df = pd.DataFrame({"patient_id": np.arange(start + 1, start + n + 1, dtype=np.int64)})
+        for name in self.variables:
+            df[name] = columns[name]
+        return df
+
+    def chunks(self, rows, chunk_size=1_000_000):
+        for start in range(0, rows, chunk_size):
+            yield self.chunk(start, min(chunk_size, rows - start))
+
+
+def write_cohort(generator, rows, output, chunk_size=1_000_000):
+    ''' Stream `rows` rows from `generator` to a feather (.feather) or parquet (.parquet) file '''
+    import pyarrow as pa
+
+    writer = None
+    try:
+        for df in generator.chunks(rows, chunk_size=chunk_size):
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                if output.endswith(".parquet"):
+                    import pyarrow.parquet as pq
+                    writer = pq.ParquetWriter(output, table.schema)
+                else:
+                    writer = pa.ipc.new_file(output, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--output", default=os.path.join(root, "output", "input.feather"))
+    parser.add_argument("--chunk-size", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--study-definition", default=None)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    generator = CohortGenerator.from_study_definition(args.study_definition, seed=args.seed)
+
+    start = time.perf_counter()
+    write_cohort(generator, args.rows, args.output, chunk_size=args.chunk_size)
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {args.rows} rows to {args.output} in {elapsed:.1f}s ({args.rows / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
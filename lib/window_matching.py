@@ -0,0 +1,114 @@
+import pandas as pd
+import numpy as np
+
+from profiling import instrument
+
+
+@instrument
+def first_event_in_window(treatments, events, widths=range(15), treatment_date="treatment_date",
+                          event_date="event_date", key_field="patient_id", chunk_size=1_000_000):
+    ''' For each treatment, find the first event for the same patient within +/- w days of the
+    treatment date, for every window width w in `widths` at once.
+
+    Events are sorted once by (patient, date), and each treatment/width pair is matched with a
+    binary search into the sorted events, so there is no cross join of treatments and events.
+
+    Inputs:
+    treatments (DataFrame): one row per treatment, with key_field and treatment_date columns
+    events (DataFrame): one row per event (e.g. SUS admission/appointment), with key_field and event_date columns
+    widths (list): window widths in days
+    chunk_size (int): number of treatments to match at a time, to bound memory
+
+    Returns: DataFrame with the same index as `treatments` and one column per width ("window_0", "window_1", ...)
+    holding the date of the first event in that window, or NaT if there was none.
+    '''
+    widths = np.asarray(list(widths), dtype=np.int64)
+    max_width = int(widths.max())
+
+    events = events.loc[events[event_date].notna(), [key_field, event_date]]
+    treatment_days = treatments[treatment_date].to_numpy(dtype="datetime64[D]")
+    event_days = events[event_date].to_numpy(dtype="datetime64[D]")
+    valid = ~np.isnat(treatment_days)
+
+    out = pd.DataFrame(index=treatments.index, columns=[f"window_{w}" for w in widths], dtype="datetime64[ns]")
+    if len(events) == 0 or not valid.any():
+        return out
+
+    # map patients in both tables to the same integer codes
+    codes, _ = pd.factorize(pd.concat([treatments[key_field], events[key_field]], ignore_index=True))
+    treatment_codes = codes[:len(treatments)].astype(np.int64)
+    event_codes = codes[len(treatments):].astype(np.int64)
+
+    # combine patient and (offset) day into one sortable key, leaving room for the widest window
+    # either side so that a window never spills into a neighbouring patient's events
+    first_day = min(treatment_days[valid].min(), event_days.min()).astype(np.int64)
+    last_day = max(treatment_days[valid].max(), event_days.max()).astype(np.int64)
+    span = int(last_day - first_day) + 2 * max_width + 1
+
+    event_keys = np.sort(event_codes * span + (event_days.astype(np.int64) - first_day + max_width))
+    event_offsets = event_keys % span
+
+    rows = np.flatnonzero(valid)
+    result = np.full((len(treatments), len(widths)), np.datetime64("NaT"), dtype="datetime64[D]")
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        keys = treatment_codes[chunk] * span + (treatment_days[chunk].astype(np.int64) - first_day + max_width)
+
+        # first event on or after the start of each window...
+        pos = np.searchsorted(event_keys, keys[:, None] - widths[None, :], side="left")
+        found = pos < len(event_keys)
+        candidate = event_keys[np.minimum(pos, len(event_keys) - 1)]
+        # ...is a match if it is no later than the end of the window
+        matched = found & (candidate <= keys[:, None] + widths[None, :])
+
+        days = (event_offsets[np.minimum(pos, len(event_keys) - 1)] - max_width + first_day).astype("datetime64[D]")
+        result[chunk] = np.where(matched, days, np.datetime64("NaT"))
+
+    for i, w in enumerate(widths):
+        out[f"window_{w}"] = result[:, i].astype("datetime64[ns]")
+    return out
+
+
+@instrument
+def window_match_rates(treatments, events, widths=range(15), treatment_date="treatment_date",
+                       event_date="event_date", key_field="patient_id"):
+    ''' Count how many treatments have a matching event within +/- w days, for each window width w.
+
+    Returns: DataFrame indexed by window width, with the number of treatments, the number matched and
+    the percentage matched. Counts are not rounded or redacted.
+    '''
+    matches = first_event_in_window(treatments, events, widths=widths, treatment_date=treatment_date,
+                                    event_date=event_date, key_field=key_field)
+    total = int(treatments[treatment_date].notna().sum())
+    rates = pd.DataFrame({"window_days": list(widths), "treatments": total, "matched": matches.notna().sum().to_numpy()})
+    rates["percent"] = (100 * rates["matched"] / total).round(1) if total else 0
+    return rates.set_index("window_days")
+
+
+
+if __name__ == "__main__":
+    # A quick check of first_event_in_window against a brute force cross join
+    rng = np.random.default_rng(0)
+    start = np.datetime64("2022-01-01")
+    treatments = pd.DataFrame({
+        "patient_id": rng.integers(0, 200, 500),
+        "treatment_date": start + rng.integers(0, 100, 500).astype("timedelta64[D]"),
+    })
+    treatments.loc[::50, "treatment_date"] = pd.NaT
+    events = pd.DataFrame({
+        "patient_id": rng.integers(0, 200, 1000),
+        "event_date": start + rng.integers(0, 100, 1000).astype("timedelta64[D]"),
+    })
+
+    matches = first_event_in_window(treatments, events, widths=range(8))
+
+    pairs = treatments.reset_index().merge(events, on="patient_id")
+    distance = (pairs["event_date"] - pairs["treatment_date"]).dt.days.abs()
+    for w in range(8):
+        expected = pairs.loc[distance <= w].groupby("index")["event_date"].min().reindex(treatments.index)
+        assert matches[f"window_{w}"].equals(expected.astype("datetime64[ns]").rename(f"window_{w}")), w
+
+    rates = window_match_rates(treatments, events, widths=range(8))
+    assert rates["matched"].is_monotonic_increasing
+
+    print("OK")
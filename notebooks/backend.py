@@ -0,0 +1,425 @@
+import re
+from functools import lru_cache
+
+
+# The database behind the helpers' `dbconn`, so that the same helper calls can run against
+# the TPP SQL Server or against a local DuckDB file of synthetic tables (for developing and
+# benchmarking the helpers off the server).
+#
+# A dbconn of "duckdb:<path>" (or a path ending .duckdb) opens that DuckDB file; anything else
+# is an ODBC connection string for SQL Server, as before. The helpers write T-SQL; on DuckDB
+# each query is translated as it is executed (see DuckDBDialect), covering the T-SQL the
+# helpers and query_builder generate:
+#   - [bracketed] identifiers, N'...' strings
+#   - TOP n (including in subqueries and CTEs)
+#   - CAST/CONVERT types (nvarchar(max), datetime, bit, ...); CAST(... AS DATE) is the same in DuckDB
+#   - DATEDIFF, DATEADD, CHARINDEX, LEN, ISNULL, NCHAR, GETDATE
+#   - CROSS APPLY STRING_SPLIT(...) and LIKE patterns with [character classes]
+#   - TABLESAMPLE (n PERCENT), SELECT ... INTO, and the schema catalog's CHECKSUM_AGG(BINARY_CHECKSUM(*))
+# The translations only use SQL which DuckDB 0.3.2 (the version in requirements.txt) supports, as
+# well as later versions.
+#
+# e.g.
+#     python notebooks/backend.py --create ../output/local.duckdb
+#     dbconn = "duckdb:../output/local.duckdb"
+#     counts_of_distinct_values(dbconn, "Therapeutics", ["Region"])
+
+
+class TSQLDialect:
+    ''' SQL Server: the helpers' SQL is run as it is '''
+    name = "tsql"
+
+    def translate(self, sql, cursor=None):
+        return sql
+
+
+class DuckDBDialect:
+    ''' DuckDB: T-SQL is translated to DuckDB SQL. `cursor` is used to look up the columns of the table in
+    BINARY_CHECKSUM(*), which DuckDB can't apply to a whole row.
+    '''
+    name = "duckdb"
+
+    def translate(self, sql, cursor=None):
+        if cursor is not None:
+            sql = _checksum_star.sub(lambda m: f"binary_checksum({', '.join(_columns(cursor, m.group(1)))})", sql)
+        return _translate_duckdb(sql)
+
+
+def _columns(cursor, table):
+    # the columns of `table`, as T-SQL identifiers
+    cursor.execute(_translate_duckdb(f"select * from {table} limit 0"))
+    return ["[" + d[0] + "]" for d in cursor.description]
+
+
+# string literals are set aside while translating, so that nothing inside them is rewritten
+_literal = re.compile(r"'(?:[^']|'')*'")
+_placeholder = re.compile(r"\x00(\d+)\x00")
+
+_types = [
+    (re.compile(r"\bn?varchar\s*\(\s*(?:max|\d+)\s*\)|\bn?(?:var)?char\b(?!\s*\()|\bntext\b", re.I), "varchar"),
+    (re.compile(r"\b(?:datetime2|datetime|smalldatetime)(?:\s*\(\s*\d+\s*\))?", re.I), "timestamp"),
+    (re.compile(r"\bbit\b", re.I), "boolean"),
+]
+_top = re.compile(r"\bselect(\s+distinct)?\s+top\s*(?:\(\s*(\d+)\s*\)|(\d+))\s+", re.I)
+_like = re.compile(r"((?:\"[^\"]+\"|\[[^\]]+\]|[\w.])+)\s+(not\s+)?like\s+\x00(\d+)\x00", re.I)
+_tablesample = re.compile(r"\btablesample\s*(?:system\s*)?\(\s*([\d.]+)\s+percent\s*\)", re.I)
+_checksum_star = re.compile(r"binary_checksum\s*\(\s*\*\s*\)(?=.*?\bfrom\s+((?:\"[^\"]+\"|\[[^\]]+\]|[\w.])+))", re.I | re.S)
+_cross_apply = re.compile(r"\s*\bcross\s+apply\s+(?=string_split\s*\()", re.I)
+_select_into = re.compile(r"^\s*select\s+(.*?)\s+into\s+(\"[^\"]+\"|[#\w.]+)\s+(?=from\b)", re.I | re.S)
+
+
+def _call_end(sql, start):
+    ''' Index just after the parenthesis closing the one at `start`, and the arguments in between '''
+    depth, args, last = 0, [], start + 1
+    for i in range(start, len(sql)):
+        if sql[i] == "(":
+            depth += 1
+        elif sql[i] == ")":
+            depth -= 1
+            if depth == 0:
+                args.append(sql[last:i].strip())
+                return i + 1, args
+        elif sql[i] == "," and depth == 1:
+            args.append(sql[last:i].strip())
+            last = i + 1
+    raise ValueError(f"Unbalanced parentheses in: {sql}")
+
+
+def _rewrite_calls(sql, name, rewrite):
+    ''' Replace each call `name(...)` with rewrite(args), innermost calls first '''
+    pattern = re.compile(rf"\b{name}\s*\(", re.I)
+    position = 0
+    while True:
+        match = pattern.search(sql, position)
+        if not match:
+            return sql
+        end, args = _call_end(sql, match.end() - 1)
+        args = [_rewrite_calls(a, name, rewrite) for a in args]
+        replacement = rewrite(args, sql[end:])
+        if isinstance(replacement, tuple):
+            # the rewrite also consumed some of the text after the call (e.g. an alias)
+            replacement, consumed = replacement
+            end += consumed
+        sql = sql[:match.start()] + replacement + sql[end:]
+        position = match.start() + len(replacement)
+
+
+def _like_to_regex(pattern):
+    # T-SQL LIKE: % any characters, _ one character, [abc] / [^abc] / [a-z] character classes
+    out, i = [], 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "[":
+            end = pattern.index("]", i + 1)
+            out.append(pattern[i:end + 1])
+            i = end + 1
+            continue
+        out.append(".*" if ch == "%" else "." if ch == "_" else re.escape(ch))
+        i += 1
+    return "(?s)" + "".join(out)
+
+
+def _remove_top(sql):
+    # SELECT TOP n -> LIMIT n at the end of the same (sub)query
+    while True:
+        match = _top.search(sql)
+        if not match:
+            return sql
+        n = match.group(2) or match.group(3)
+        depth, end = 0, len(sql)
+        for i in range(match.end(), len(sql)):
+            if sql[i] == "(":
+                depth += 1
+            elif sql[i] == ")":
+                depth -= 1
+                if depth < 0:
+                    end = i
+                    break
+            elif sql[i] == ";" and depth == 0:
+                end = i
+                break
+        sql = (sql[:match.start()] + f"select{match.group(1) or ''} " + sql[match.end():end].rstrip()
+               + f" limit {n}" + sql[end:])
+
+
+@lru_cache(maxsize=1024)
+def _translate_duckdb(sql):
+    literals = []
+
+    def stash(match):
+        literals.append(match.group(0))
+        return f"\x00{len(literals) - 1}\x00"
+
+    sql = re.sub(r"\bN'", "'", sql)
+    sql = _literal.sub(stash, sql)
+
+    def like(match):
+        expression, negate, n = match.group(1), match.group(2), int(match.group(3))
+        pattern = literals[n][1:-1].replace("''", "'")
+        if "[" not in pattern:
+            return match.group(0)
+        literals.append("'" + _like_to_regex(pattern).replace("'", "''") + "'")
+        return f"{'not ' if negate else ''}regexp_full_match({expression}, \x00{len(literals) - 1}\x00)"
+
+    sql = _like.sub(like, sql)
+    sql = re.sub(r"\[([^\]]*)\]", lambda m: '"' + m.group(1).replace('"', '""') + '"', sql)
+    # SELECT ... INTO #temp FROM -> CREATE TABLE "#temp" AS SELECT ... FROM. DuckDB's temp tables are only seen
+    # by the cursor which created them (each cursor is its own connection), so this is an ordinary table,
+    # left in the file if it isn't dropped (and replaced if it was left by an earlier session)
+    sql = _select_into.sub(lambda m: f"drop table if exists {m.group(2)}; create table {m.group(2)} as select {m.group(1)} ", sql)
+    sql = _tablesample.sub(lambda m: f"tablesample {m.group(1)}% (bernoulli)", sql)
+    sql = _remove_top(sql)
+
+    sql = _rewrite_calls(sql, "convert", lambda a, rest: f"cast({a[1]} as {a[0]})")
+    for pattern, replacement in _types:
+        sql = re.sub(rf"(\bas\s+)(?:{pattern.pattern})", rf"\1{replacement}", sql, flags=re.I)
+
+    units = {"dd": "day", "d": "day", "mm": "month", "m": "month", "yy": "year", "yyyy": "year", "wk": "week", "ww": "week"}
+    unit = lambda u: units.get(u.lower(), u.lower())
+    sql = _rewrite_calls(sql, "datediff", lambda a, rest: f"date_diff('{unit(a[0])}', {a[1]}, {a[2]})")
+    sql = _rewrite_calls(sql, "dateadd", lambda a, rest: f"({a[2]} + ({a[1]}) * interval 1 {unit(a[0])})")
+    sql = _rewrite_calls(sql, "charindex", lambda a, rest: f"strpos({a[1]}, {a[0]})")
+    # LEN ignores trailing spaces
+    sql = _rewrite_calls(sql, "len", lambda a, rest: f"length(rtrim({a[0]}))")
+    sql = _rewrite_calls(sql, "isnull", lambda a, rest: f"coalesce({a[0]}, {a[1]})")
+    sql = _rewrite_calls(sql, "nchar", lambda a, rest: f"chr({a[0]})")
+    sql = _rewrite_calls(sql, "getdate", lambda a, rest: "current_timestamp")
+
+    # CHECKSUM_AGG(BINARY_CHECKSUM(columns)) -> md5 of the rows' text, in order so it doesn't depend on the scan
+    row = lambda a: "concat_ws('|', " + ", ".join(f"coalesce(cast({c} as varchar), '')" for c in a) + ")"
+    sql = _rewrite_calls(sql, "binary_checksum", lambda a, rest: row(a))
+    sql = _rewrite_calls(sql, "checksum_agg", lambda a, rest: f"md5(string_agg({a[0]}, ',' order by {a[0]}))")
+
+    # CROSS APPLY STRING_SPLIT(value, separator) alias -> alias.value replaced by unnest(string_split(value, separator)),
+    # so alias.value can only be used in the select list (as the helpers do)
+    split = {}
+
+    def string_split(args, rest):
+        alias = re.match(r"\s+(?:as\s+)?(\w+)", rest, re.I)
+        split[alias.group(1)] = f"unnest(string_split({args[0]}, {args[1]}))"
+        return "", alias.end()
+
+    sql = _cross_apply.sub("", sql)
+    sql = _rewrite_calls(sql, "string_split", string_split)
+    for alias, unnest in split.items():
+        sql = re.sub(rf"\b{alias}\.value\b", lambda m: unnest, sql)
+
+    return _placeholder.sub(lambda m: literals[int(m.group(1))], sql)
+
+
+class TranslatingCursor:
+    ''' A DB-API cursor which translates each query to the connection's dialect before running it '''
+    def __init__(self, cursor, dialect):
+        self._cursor = cursor
+        self._dialect = dialect
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(self._dialect.translate(sql, self._cursor), list(params or []))
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class TranslatingConnection:
+    ''' A DB-API connection whose cursors translate queries to `dialect` '''
+    def __init__(self, cnxn, dialect):
+        self._cnxn = cnxn
+        self.dialect = dialect
+        # pyodbc's per-query timeout; not supported, so ignored
+        self.timeout = 0
+
+    def cursor(self):
+        return TranslatingCursor(self._cnxn.cursor(), self.dialect)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cnxn, name)
+
+
+class SQLServerBackend:
+    ''' The TPP database: a pyodbc connection, T-SQL run as it is '''
+    name = "mssql"
+    dialect = TSQLDialect()
+
+    def connect(self, dbconn):
+        import pyodbc
+        return pyodbc.connect(dbconn)
+
+
+class DuckDBBackend:
+    ''' A local DuckDB file, with the helpers' T-SQL translated '''
+    name = "duckdb"
+    dialect = DuckDBDialect()
+
+    @staticmethod
+    def path(dbconn):
+        return dbconn[len("duckdb:"):] if dbconn.startswith("duckdb:") else dbconn
+
+    def connect(self, dbconn):
+        import duckdb
+        return TranslatingConnection(duckdb.connect(self.path(dbconn)), self.dialect)
+
+
+def get_backend(dbconn):
+    ''' The backend for a helper's `dbconn` '''
+    if dbconn.startswith("duckdb:") or dbconn.endswith(".duckdb"):
+        return DuckDBBackend()
+    return SQLServerBackend()
+
+
+def dialect(cnxn):
+    ''' The dialect of an open connection '''
+    return getattr(cnxn, "dialect", None) or TSQLDialect()
+
+
+def create_local_database(path, rows=100_000, seed=0):
+    ''' Create a DuckDB file with a synthetic Therapeutics table (with the columns the notebooks profile, including
+    some badly-formed dates, missing values and patients with several records) and its OpenSAFELYSchemaInformation
+    rows, for running the helpers locally. Returns the dbconn to pass to the helpers.
+    '''
+    import duckdb
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    interventions = np.array(["Molnupiravir", "Sotrovimab", "Casirivimab and imdevimab", "Paxlovid", "Remdesivir"])
+    risks = np.array(["Patients with a haematological disease", "Patients with a solid cancer", "Down's syndrome",
+                      "Patients with a renal disease", "immune deficiencies", "HIV or AIDS"])
+
+    def dates(start, days, missing=0.05, bad=0.01):
+        values = (pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, rows), unit="D")).strftime("%Y-%m-%d").to_numpy(object)
+        bad = rng.random(rows) < bad
+        values[bad] = rng.choice(["3", "unknown", "x2022", "1900-01-01", "22/13/2021"], bad.sum())
+        values[rng.random(rows) < missing] = None
+        return values
+
+    def risk_groups():
+        n = rng.integers(1, 3, rows)
+        first, second = rng.choice(risks, rows), rng.choice(risks, rows)
+        values = np.where(n == 1, first, np.char.add(np.char.add(first, " and "), second)).astype(object)
+        values[rng.random(rows) < 0.3] = None
+        return values
+
+    received = pd.Timestamp("2021-12-16") + pd.to_timedelta(rng.integers(0, 560, rows), unit="D")
+    df = pd.DataFrame({
+        "patient_id": rng.integers(0, int(rows * 0.9), rows),
+        "Intervention": rng.choice(interventions, rows, p=[0.35, 0.3, 0.05, 0.25, 0.05]),
+        "CurrentStatus": rng.choice(["Approved", "Treatment Complete", "Treatment Not Started", "Treatment Stopped"], rows),
+        "COVID_indication": rng.choice(["non_hospitalised", "hospitalised_with", "hospital_onset"], rows, p=[0.8, 0.15, 0.05]),
+        "Region": rng.choice(["East", "London", "Midlands", "North East and Yorkshire", "North West", "South East", "South West"], rows),
+        "Diagnosis": rng.choice(["Covid-19", "COVID-19"], rows),
+        "FormName": rng.choice(["Molnupiravir", "Sotrovimab", "nMAB"], rows),
+        "AgeAtReceivedDate": rng.integers(12, 100, rows),
+        "Count": 1,
+        "Received": received,
+        "TreatmentStartDate": received + pd.to_timedelta(rng.integers(-1, 5, rows), unit="D"),
+        "Der_LoadDate": pd.Timestamp("2023-06-28"),
+        "MOL1_onset_of_symptoms": dates("2021-12-10", 560),
+        "SOT02_onset_of_symptoms": dates("2021-12-10", 560),
+        "CASIM05_date_of_symptom_onset": dates("2021-12-10", 560, missing=0.8),
+        "MOL1_high_risk_cohort": risk_groups(),
+        "SOT02_risk_cohorts": risk_groups(),
+        "CASIM05_risk_cohort": risk_groups(),
+    })
+
+    con = duckdb.connect(path)
+    try:
+        con.register("therapeutics_df", df)
+        con.execute("drop table if exists Therapeutics")
+        con.execute("create table Therapeutics as select * from therapeutics_df")
+        schema = con.execute("""select 'Therapeutics' as TableName, column_name as ColumnName, data_type as ColumnType,
+                                       coalesce(character_maximum_length, 0) as MaxLength, is_nullable = 'YES' as IsNullable
+                                from information_schema.columns where table_name = 'Therapeutics'""").df()
+        con.register("schema_df", schema)
+        con.execute("drop table if exists OpenSAFELYSchemaInformation")
+        con.execute("create table OpenSAFELYSchemaInformation as select * from schema_df")
+    finally:
+        con.close()
+    return f"duckdb:{path}"
+
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Create a local DuckDB database of synthetic tables, and time the helpers against it")
+    parser.add_argument("--create", metavar="PATH", help="create (or replace) the database at PATH")
+    parser.add_argument("--rows", type=int, default=100_000, help="rows in the synthetic Therapeutics table")
+    parser.add_argument("--path", help="existing database to time the helpers against")
+    args = parser.parse_args()
+
+    # translations of the T-SQL the helpers generate, each of which is run on an in-memory database
+    import duckdb
+    import pandas as pd
+
+    cnxn = TranslatingConnection(duckdb.connect(), DuckDBDialect())
+    cnxn.execute("create table t (x integer, v varchar, a timestamp, b timestamp, c varchar)")
+    cnxn.execute("insert into t values (1, '1', '2022-01-01', '2022-01-03', 'a and b'), (2, 'x1', '2022-02-01', '2022-01-31', null)")
+    translate = DuckDBDialect().translate
+
+    def check(sql, expected, params=()):
+        assert translate(sql) == expected, translate(sql)
+        return cnxn.execute(sql, params).fetchall()
+
+    assert check("select top 1 [x] from [main].[t] order by [x]", 'select "x" from "main"."t" order by "x" limit 1') == [(1,)]
+    assert check("with a as (select top 10000 x from t) select count(*) from a",
+                 "with a as (select x from t limit 10000) select count(*) from a") == [(2,)]
+    assert check("select datediff(day, [a], [b]), charindex(?, cast([c] as nvarchar(max))) from t order by x",
+                 "select date_diff('day', \"a\", \"b\"), strpos(cast(\"c\" as varchar), ?) from t order by x", ["and"]) == [(2, 3), (-1, None)]
+    assert check("select v from t where v like '[0-9]' and v not like '%[^0-9]' and v like '%1%'",
+                 "select v from t where regexp_full_match(v, '(?s)[0-9]') and not regexp_full_match(v, '(?s).*[^0-9]') and v like '%1%'") == [("1",)]
+    assert check("select s.value from [t] cross apply string_split(replace([c], ?, nchar(31)), nchar(31)) s where [c] <> 'a [b]'",
+                 "select unnest(string_split(replace(\"c\", ?, chr(31)), chr(31))) from \"t\" where \"c\" <> 'a [b]'", [" and "]) == [("a",), ("b",)]
+    # SELECT INTO, twice to replace the table
+    for value in [1, 2]:
+        check("select [x], [v] into [#subset_1] from [t] where [x] = ?",
+              'drop table if exists "#subset_1"; create table "#subset_1" as select "x", "v" from "t" where "x" = ?', [value])
+        assert cnxn.execute("select x from [#subset_1]").fetchall() == [(value,)]
+    # the schema catalog's fingerprint changes with the table
+    fingerprint = "select count(*) as row_count, checksum_agg(binary_checksum(*)) as checksum from t"
+    before = cnxn.execute(fingerprint).fetchall()
+    assert before == cnxn.execute(fingerprint).fetchall()
+    cnxn.execute("update t set v = 'y' where x = 2")
+    assert cnxn.execute(fingerprint).fetchall() != before
+    # a TABLESAMPLE, and sums fetched as numbers rather than Decimals
+    from fetch import read
+    out = read(cnxn, cnxn.cursor(), "select sum([x]) as n from [t] TABLESAMPLE (100.0 PERCENT)")
+    assert out["n"].dtype.kind == "i" and out["n"][0] == 3
+
+    if not (args.create or args.path):
+        print("OK")
+        raise SystemExit
+
+    dbconn = create_local_database(args.create, rows=args.rows) if args.create else f"duckdb:{args.path}"
+
+    import sense_checking as sc
+    from results import session_results
+
+    table = "Therapeutics"
+    where = "COVID_indication='non_hospitalised'"
+    calls = [
+        ("get_schema", lambda: sc.get_schema(dbconn, table, {"": "", "_non_hospitalised": f"where {where}"}, render=False)),
+        ("counts_of_distinct_values", lambda: sc.counts_of_distinct_values(dbconn, table, ["Region", "Intervention", "Received"], threshold=50, where=where, render=False)),
+        ("counts_of_distinct_values pushdown", lambda: sc.counts_of_distinct_values(dbconn, table, ["Region", "Intervention", "Received"], threshold=50, where=where, pushdown=True, render=False)),
+        ("compare_two_values", lambda: sc.compare_two_values(dbconn, [table], ["Received", "TreatmentStartDate"], where=where, render=False)),
+        ("problem_dates pushdown", lambda: sc.problem_dates(dbconn, table, ["MOL1_onset_of_symptoms", "SOT02_onset_of_symptoms"], where=where, pushdown=True, render=False)),
+        ("identify_distinct_strings pushdown", lambda: sc.identify_distinct_strings(dbconn, table, ["MOL1_high_risk_cohort", "SOT02_risk_cohorts"], where=where, replacement="Patients with a ", split_string=" and ", pushdown=True, render=False)),
+        ("multiple_records", lambda: sc.multiple_records(dbconn, table, ["Intervention", "Region", "Received"], {1: ["Intervention", "Received"]}, where=where, render=False)),
+    ]
+    for name, call in calls:
+        start = time.perf_counter()
+        result = call()
+        assert result is not None and result.tables(), f"{name} returned no tables"
+        print(f"{name}: {time.perf_counter() - start:.2f}s")
+
+    # missing values are counted the same way with and without pushdown
+    missing = [
+        [b["text"] for b in sc.counts_of_distinct_values(dbconn, table, ["MOL1_onset_of_symptoms"], threshold=50, where=where,
+                                                          pushdown=pushdown, render=False).blocks if "missing values" in b["text"]]
+        for pushdown in [False, True]
+    ]
+    assert missing[0] == missing[1] and "(to the nearest 5)" in missing[0][0], missing
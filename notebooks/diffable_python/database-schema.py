@@ -62,6 +62,7 @@ from IPython.display import display, Markdown
 import sys
 sys.path.append('../lib/')
 from functions import *
+from schema_catalog import get_schema_catalog
 
 
 # +
@@ -72,8 +73,8 @@ dbconn = os.environ.get('FULL_DATABASE_URL', None).strip('"')
 # +
 ## Import schema data and date
 
-with closing_connection(dbconn) as cnxn:
-    table_schema = pd.read_sql("""select * from OpenSAFELYSchemaInformation""", cnxn)
+# loaded once per session and cached on disk, shared with the other schema helpers
+table_schema = get_schema_catalog(dbconn).table()
 
 today = date.today()
 # -
@@ -0,0 +1,194 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+
+
+# How query results get from the database into pandas.
+#
+# The "rows" path is pyodbc's: every cell becomes a Python object, and pandas then infers each
+# column's dtype from them (and dates come back as datetime.date objects). The "arrow" path fetches
+# results column by column into Arrow arrays with typed columns, and converts those to pandas in
+# bulk, with dates and datetimes as datetime64:
+#   - for SQL Server, with arrow-odbc (pip install arrow-odbc), which opens its own ODBC connection
+#     from the connection string. Queries which depend on the pyodbc connection's session (e.g.
+#     reading #temp tables) stay on the rows path.
+#   - for a local DuckDB database (see backend), from DuckDB's own Arrow result
+# The arrow path is used when it is available ("auto", the default), and the rows path otherwise.
+# Set NOTEBOOK_FETCH_PATH (or call set_fetch_path) to "rows" to always use pyodbc's.
+
+_fetch_path = os.environ.get("NOTEBOOK_FETCH_PATH", "auto")
+
+# connection string of each open pyodbc connection, keyed by id(connection), for arrow-odbc
+_connection_strings = {}
+
+
+def set_fetch_path(path):
+    ''' "auto" (the arrow path where available), "arrow" (the same, but fail if it isn't) or "rows" '''
+    global _fetch_path
+    if path not in ("auto", "arrow", "rows"):
+        raise ValueError(f"Unknown fetch path: {path}")
+    _fetch_path = path
+
+
+def register_connection(cnxn, dbconn):
+    ''' Note the connection string a connection was opened with, so its queries can be fetched with arrow-odbc '''
+    _connection_strings[id(cnxn)] = dbconn
+
+
+def forget_connection(cnxn):
+    _connection_strings.pop(id(cnxn), None)
+
+
+def _arrow_odbc_available():
+    try:
+        import arrow_odbc  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def fetch_path(cnxn, sql=""):
+    ''' The path results of `sql` on `cnxn` will be fetched by: "duckdb", "arrow-odbc" or "rows" '''
+    if _fetch_path == "rows":
+        return "rows"
+    if getattr(getattr(cnxn, "dialect", None), "name", None) == "duckdb":
+        return "duckdb"
+    if id(cnxn) in _connection_strings and "#" not in sql and _arrow_odbc_available():
+        return "arrow-odbc"
+    if _fetch_path == "arrow":
+        raise RuntimeError("The arrow fetch path isn't available for this connection (is arrow-odbc installed?)")
+    return "rows"
+
+
+def _to_pandas(table):
+    import pyarrow as pa
+    # decimals (e.g. DuckDB's HUGEINT sums, or SQL Server numerics) as numbers rather than Decimal objects, as the
+    # rows path gives: int64 if they are whole numbers which fit, and float64 otherwise
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            column = table.column(i)
+            try:
+                if field.type.scale != 0:
+                    raise pa.ArrowInvalid("not whole numbers")
+                column = column.cast(pa.int64())
+            except pa.ArrowInvalid:
+                column = column.cast(pa.float64(), safe=False)
+            table = table.set_column(i, field.name, column)
+    # dates as datetime64 rather than datetime.date objects
+    return table.to_pandas(date_as_object=False)
+
+
+def _odbc_parameter(value):
+    # arrow-odbc binds parameters as text
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def read_rows(cursor, sql, params=None, chunksize=None):
+    ''' Run `sql` on a DB-API cursor and fetch the results row by row into a dataframe
+    (or an iterator of dataframes of up to `chunksize` rows)
+    '''
+    cursor.execute(sql, list(params or []))
+    if chunksize is None:
+        return fetch_frame(cursor)
+    return _row_chunks(cursor, [d[0] for d in cursor.description], chunksize)
+
+
+def fetch_frame(cursor):
+    ''' The rest of the current result set of a cursor which has run a query, as a dataframe '''
+    columns = [d[0] for d in cursor.description]
+    return pd.DataFrame.from_records(cursor.fetchall(), columns=columns, coerce_float=True)
+
+
+def _row_chunks(cursor, columns, chunksize):
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+def read_arrow(cnxn, cursor, sql, params=None, chunksize=None):
+    ''' As read_rows, fetching the results as Arrow record batches (see above) '''
+    path = fetch_path(cnxn, sql)
+    if path == "duckdb":
+        cursor.execute(sql, list(params or []))
+        # (newer DuckDB versions rename these to_arrow_table/to_arrow_reader)
+        if chunksize is None:
+            return _to_pandas(getattr(cursor, "to_arrow_table", cursor.fetch_arrow_table)())
+        batches = getattr(cursor, "to_arrow_reader", cursor.fetch_record_batch)(chunksize)
+        return (_to_pandas(batch) for batch in batches)
+
+    from arrow_odbc import read_arrow_batches_from_odbc
+    reader = read_arrow_batches_from_odbc(
+        query=sql,
+        connection_string=_connection_strings[id(cnxn)],
+        parameters=[_odbc_parameter(p) for p in params or []],
+        batch_size=chunksize or 100_000,
+        query_timeout_sec=getattr(cnxn, "timeout", 0) or None,
+    )
+    if chunksize is None:
+        import pyarrow as pa
+        return _to_pandas(pa.Table.from_batches(list(reader), schema=reader.schema))
+    return (_to_pandas(batch) for batch in reader)
+
+
+def read(cnxn, cursor, sql, params=None, chunksize=None):
+    ''' Run `sql` with `params` bound and return the results as a dataframe (or an iterator of dataframes of up
+    to `chunksize` rows), by the fastest path available for the connection
+    '''
+    if fetch_path(cnxn, sql) == "rows":
+        return read_rows(cursor, sql, params, chunksize)
+    return read_arrow(cnxn, cursor, sql, params, chunksize)
+
+
+
+if __name__ == "__main__":
+    # Benchmark fetching a large grouped result from a local DuckDB database by each path
+    import time
+    import duckdb
+    import numpy as np
+    from backend import TranslatingConnection, DuckDBDialect
+
+    rng = np.random.default_rng(0)
+    n = 1_000_000
+    df = pd.DataFrame({
+        "patient_id": np.arange(n),
+        "Received": pd.Timestamp("2021-12-16") + pd.to_timedelta(rng.integers(0, 560 * 86400, n), unit="s"),
+        "Region": rng.choice(["East", "London", "Midlands", "North West"], n),
+        "AgeAtReceivedDate": rng.integers(12, 100, n),
+    })
+    con = duckdb.connect()
+    con.register("df", df)
+    con.execute("create table Therapeutics as select * from df")
+    cnxn = TranslatingConnection(con, DuckDBDialect())
+
+    sql = ("select [patient_id], cast([Received] as date) as ReceivedDate, [Received], [Region], [AgeAtReceivedDate], "
+           "count(*) as row_count from [Therapeutics] group by [patient_id], [Received], [Region], [AgeAtReceivedDate]")
+    results = {}
+    for path in ["rows", "auto"]:
+        set_fetch_path(path)
+        cursor = cnxn.cursor()
+        start = time.perf_counter()
+        results[path] = read(cnxn, cursor, sql)
+        seconds = time.perf_counter() - start
+        print(f"{fetch_path(cnxn, sql):>6} path: {n / seconds:,.0f} rows/sec ({seconds:.2f}s)")
+    set_fetch_path("auto")
+
+    rows, arrow = results["rows"], results["auto"]
+    # the arrow path keeps dates as datetime64; the rows path leaves them as datetime.date objects
+    assert arrow["ReceivedDate"].dtype.kind == "M" and rows["ReceivedDate"].dtype == object
+    pd.testing.assert_frame_equal(
+        rows.assign(ReceivedDate=pd.to_datetime(rows["ReceivedDate"])).sort_values("patient_id").reset_index(drop=True),
+        arrow.sort_values("patient_id").reset_index(drop=True),
+        check_dtype=False,
+    )
+    chunks = list(read(cnxn, cnxn.cursor(), sql, chunksize=300_000))
+    assert sum(len(c) for c in chunks) == n
+    print("OK")
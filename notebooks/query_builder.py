@@ -0,0 +1,550 @@
+import pandas as pd
+from collections import OrderedDict
+
+import fetch
+
+
+# Builds the SQL for the sense_checking helpers with quoted identifiers and bound
+# parameters, so that every call with the same query shape (table, columns and filter
+# columns/operators) sends SQL Server the same query text, whatever the filter values.
+# The server's plan cache is keyed by query text, so these share one cached plan across
+# columns, calls and notebooks. Within a connection each query text also keeps its own
+# cursor (see PreparedStatements), and pyodbc only prepares a statement again when a
+# cursor is given a different text.
+#
+# `where` can be either
+#   - a list of (column, op, value) filters, ANDed together, with values bound as
+#     parameters. `op` is one of "<", "<=", ">", ">=", "==", "!=", "contains", "in"
+#     (value is a list), or any of these prefixed with "not " (missing values never
+#     satisfy a comparison, so they do satisfy its negation), as in lib/cohort_engine.py
+#   - a string of raw SQL (with or without a leading "where"), used as it is and not
+#     parameterized, as the helpers have always accepted
+
+comparisons = {"<": "<", "<=": "<=", ">": ">", ">=": ">=", "==": "=", "!=": "<>"}
+
+
+class Query:
+    ''' SQL text with "?" placeholders, and the parameters to bind to them '''
+    def __init__(self, sql, params=()):
+        self.sql = sql
+        self.params = list(params)
+
+    def __repr__(self):
+        return f"Query({self.sql!r}, {self.params!r})"
+
+
+def quote_identifier(name):
+    ''' Quote a (possibly schema-qualified) table or column name, e.g. dbo.Therapeutics -> [dbo].[Therapeutics] '''
+    return ".".join("[" + part.strip().strip("[]").replace("]", "]]") + "]" for part in name.split("."))
+
+
+def where_clause(where, params):
+    ''' Return the where clause for `where` (a list of filters or a raw SQL string; see above),
+    appending any values to bind to `params`
+    '''
+    if not where:
+        return ""
+    if isinstance(where, str):
+        where = where.strip()
+        return where if where.lower().startswith("where ") else f"where {where}"
+
+    conditions = []
+    for column, op, value in where:
+        negate = op.startswith("not ")
+        op = op[4:] if negate else op
+        if op == "contains":
+            condition = f"charindex(?, cast({quote_identifier(column)} as nvarchar(max))) > 0"
+            params.append(value)
+        elif op == "in":
+            condition = f"{quote_identifier(column)} in ({', '.join('?' * len(value))})"
+            params.extend(value)
+        else:
+            condition = f"{quote_identifier(column)} {comparisons[op]} ?"
+            params.append(value.to_pydatetime() if isinstance(value, pd.Timestamp) else value)
+        if negate:
+            # a comparison with a missing value is unknown rather than false, so include them explicitly
+            condition = f"(not {condition} or {quote_identifier(column)} is null)"
+        conditions.append(condition)
+    return "where " + " and ".join(conditions)
+
+
+# Filtered subsets of tables copied into temp tables for a session (see subset_session), keyed by the
+# table and filter they hold: queries on the same table with the same filter read the subset instead
+_subsets = {}
+
+
+def _subset_key(table, where):
+    if isinstance(where, str):
+        where = " ".join(where.split())
+        where = where[6:] if where.lower().startswith("where ") else where
+    else:
+        where = repr([tuple(f) for f in where])
+    return quote_identifier(table).lower(), where
+
+
+def register_subset(table, where, subset, columns=None):
+    ''' Read temp table `subset` (with all the columns of `table`, or only `columns`) in place of `table` filtered on `where` '''
+    _subsets[_subset_key(table, where)] = (subset, None if columns is None else {c.lower() for c in columns})
+
+
+def forget_subset(table, where):
+    _subsets.pop(_subset_key(table, where), None)
+
+
+def subsets(table):
+    ''' Names of the registered subsets of `table`, which queries on it may read instead '''
+    return [subset for (name, _), (subset, _) in _subsets.items() if name == quote_identifier(table).lower()]
+
+
+def source(table, where, params, columns=()):
+    ''' The table to select `columns` from and the where clause to filter it with, appending any values to bind
+    to `params`: a registered subset and no where clause, if there is one of `table` filtered on `where` which
+    kept all of `columns`, and otherwise `table` and where_clause(where, params)
+    '''
+    if where:
+        subset, kept = _subsets.get(_subset_key(table, where), (None, None))
+        if subset is not None and (kept is None or {c.lower() for c in columns} <= kept):
+            return quote_identifier(subset), ""
+    return quote_identifier(table), where_clause(where, params)
+
+
+def describe_where(where):
+    ''' Readable version of `where`, for notes in the output and file names '''
+    if not where or isinstance(where, str):
+        return where or ""
+    return " AND ".join(f"{column} {op} {value!r}" for column, op, value in where)
+
+
+def group_count(table, columns, where=None):
+    ''' Query counting rows for each combination of values of `columns` in `table` '''
+    params = []
+    columns_str = ", ".join(quote_identifier(c) for c in columns)
+    table_sql, where_sql = source(table, where, params, columns)
+    sql = f"select {columns_str}, count(*) as row_count from {table_sql} {where_sql} group by {columns_str}"
+    return Query(" ".join(sql.split()), params)
+
+
+def _rounded(count):
+    # to the nearest 5, as suppress_and_round does (counts are whole numbers, so there are no ties to break)
+    return f"cast(5 * round({count} / 5.0, 0) as int)"
+
+
+def suppressed_group_count(table, columns, where=None, threshold=7):
+    ''' As group_count, but with disclosure control applied in the database: combinations of values with
+    `threshold` rows or fewer are left out, and the other counts are rounded to the nearest 5
+    '''
+    params = []
+    columns_str = ", ".join(quote_identifier(c) for c in columns)
+    table_sql, where_sql = source(table, where, params, columns)
+    sql = (f"select {columns_str}, {_rounded('count(*)')} as row_count from {table_sql} "
+           f"{where_sql} group by {columns_str} having count(*) > {int(threshold)}")
+    return Query(" ".join(sql.split()), params)
+
+
+def suppression_summary(table, columns, where=None, threshold=7):
+    ''' Query summarising what suppressed_group_count leaves out, in one row:
+    distinct_values: combinations of non-missing values (before suppression)
+    suppressed_values: how many of those have `threshold` rows or fewer
+    missing_rows: rows with a missing value in any of `columns`, rounded to the nearest 5 (0 if `threshold` or fewer)
+    missing_suppressed: 1 if there are between 1 and `threshold` such rows, else 0
+    total_rows: all rows, rounded to the nearest 5
+    '''
+    params = []
+    columns_str = ", ".join(quote_identifier(c) for c in columns)
+    missing = " or ".join(f"{quote_identifier(c)} is null" for c in columns)
+    missing_rows = f"coalesce(sum(case when {missing} then row_count end), 0)"
+    table_sql, where_sql = source(table, where, params, columns)
+    sql = f"""select count(case when not ({missing}) then 1 end) as distinct_values,
+                  count(case when not ({missing}) and row_count <= {int(threshold)} then 1 end) as suppressed_values,
+                  case when {missing_rows} > {int(threshold)} then {_rounded(missing_rows)} else 0 end as missing_rows,
+                  case when {missing_rows} between 1 and {int(threshold)} then 1 else 0 end as missing_suppressed,
+                  {_rounded('coalesce(sum(row_count), 0)')} as total_rows
+              from (select {columns_str}, count(*) as row_count from {table_sql}
+                    {where_sql} group by {columns_str}) g"""
+    return Query(" ".join(sql.split()), params)
+
+
+def frequency_counts(table, columns, where=None, threshold=7):
+    ''' Query counting how many combinations of non-missing values of `columns` there are with each row count
+    (e.g. how many patients appear once, twice, ...), with frequencies of `threshold` or fewer left out and
+    the others rounded to the nearest 5
+    '''
+    params = []
+    columns_str = ", ".join(quote_identifier(c) for c in columns)
+    not_missing = " and ".join(f"{quote_identifier(c)} is not null" for c in columns)
+    table_sql, where_sql = source(table, where, params, columns)
+    sql = f"""select row_count, {_rounded('count(*)')} as frequency
+              from (select count(*) as row_count from {table_sql}
+                    {where_sql} group by {columns_str} having {not_missing}) g
+              group by row_count having count(*) > {int(threshold)}"""
+    return Query(" ".join(sql.split()), params)
+
+
+def column_counts(table, column, suffix="", where=None):
+    ''' Query counting distinct and missing values of `column` in `table`, as used by get_schema '''
+    params = [table]
+    col = quote_identifier(column)
+    table_sql, where_sql = source(table, where, params, [column])
+    sql = (f"select cast(? as varchar(128)) as TableName, count(distinct {col}) as {quote_identifier('Distinct_Values' + suffix)}, "
+           f"sum(case when {col} is null then 1 else 0 end) as {quote_identifier('Missing_Values' + suffix)}, "
+           f"count(*) as total_rows from {table_sql} {where_sql}")
+    return Query(" ".join(sql.split()), params)
+
+
+def sample_column_counts(table, column, suffix="", rows=10000):
+    ''' As column_counts, over the first `rows` rows of `table` and without a filter (get_schema's fallback
+    for tables the filter doesn't apply to)
+    '''
+    col = quote_identifier(column)
+    missing = quote_identifier("Missing_Values" + suffix)
+    sql = (f"with a as (select top {int(rows)} {col}, case when {col} is null then 1 else 0 end as {missing} "
+           f"from {quote_identifier(table)}) "
+           f"select cast(? as varchar(128)) as TableName, count(distinct {col}) as {quote_identifier('Distinct_Values' + suffix)}, "
+           f"sum({missing}) as {missing}, count(*) as total_rows from a")
+    return Query(" ".join(sql.split()), [table])
+
+
+def problem_dates_query(table, columns, valid_years=("202", "21", "22"), where=None):
+    ''' Query classifying the distinct values of the date-like string `columns` in `table` as
+    problem_dates does, and returning only the problem values with their counts (summed over columns).
+    valid_years are matched as plain substrings.
+    '''
+    params = []
+    table_sql, where_sql = source(table, where, params, columns)
+    values = " union all ".join(
+        f"select coalesce(cast({quote_identifier(c)} as nvarchar(4000)), '2022-01-01') as value, count(*) as row_count "
+        f"from {table_sql} {where_sql} group by {quote_identifier(c)}"
+        for c in columns
+    )
+    years = " or ".join("v.value like ?" for _ in valid_years)
+    # the years come first in the query text, then each column's filter values for its own part of the union
+    params = [f"%{y}%" for y in valid_years] + params * len(columns)
+    # in the same order of precedence as problem_dates (a value which gets past "starts/ends non-numeric"
+    # starts and ends with a digit, so it can't have "limited numeric characters")
+    sql = f"""select value, problem, sum(row_count) as row_count from (
+                select v.value, v.row_count, case
+                    when v.value like '[0-9]' or v.value like '[0-9][0-9]' then 'entirely numeric'
+                    when v.value not like '%[0-9]%' then 'largely or entirely non-numeric'
+                    when v.value like '[^0-9]%' or v.value like '%[^0-9]' then 'starts/ends non-numeric'
+                    when not ({years}) then 'no valid year'
+                end as problem
+                from ({values}) v
+              ) p
+              where problem is not null
+              group by value, problem"""
+    return Query(" ".join(sql.split()), params)
+
+
+def token_counts_query(table, column, replacement="", split_string="", where=None):
+    ''' Query splitting the strings in `column` of `table` into tokens in the database, as TokenCounter does,
+    and returning each distinct token with the number of rows it appears in. Needs SQL Server 2016+ (STRING_SPLIT).
+    '''
+    params = []
+    value = f"cast({quote_identifier(column)} as nvarchar(max))"
+    if replacement:
+        value = f"replace({value}, ?, '')"
+        params.append(replacement)
+    where_params = []
+    table_sql, where_sql = source(table, where, where_params, [column])
+    if split_string:
+        # STRING_SPLIT only splits on a single character, so normalise the separator to one not found in text first
+        value = f"replace({value}, ?, nchar(31))"
+        params.append(split_string)
+        table_sql = f"{table_sql} cross apply string_split({value}, nchar(31)) s"
+        value = "s.value"
+    # the filter values come after the replacements in the query text
+    params += where_params
+    not_null = f"{'and' if where_sql else 'where'} {quote_identifier(column)} is not null"
+    sql = f"select token, count(*) as row_count from (select {value} as token from {table_sql} {where_sql} {not_null}) t group by token"
+    return Query(" ".join(sql.split()), params)
+
+
+class PreparedStatements:
+    ''' One cursor per query text on a connection, so repeated queries of the same shape reuse
+    the statement pyodbc has already prepared rather than preparing it again.
+
+    size (int): number of query texts to keep cursors for (least recently used are closed first)
+    '''
+    def __init__(self, cnxn, size=32):
+        self.cnxn = cnxn
+        self.size = size
+        self.cursors = OrderedDict()
+        self.prepared = 0
+
+    def cursor(self, sql):
+        if sql in self.cursors:
+            self.cursors.move_to_end(sql)
+            return self.cursors[sql]
+        if len(self.cursors) >= self.size:
+            _, cursor = self.cursors.popitem(last=False)
+            cursor.close()
+        self.prepared += 1
+        self.cursors[sql] = self.cnxn.cursor()
+        return self.cursors[sql]
+
+    def read(self, sql, params=None, chunksize=None):
+        ''' Run `sql` with `params` bound and return the results as a dataframe (like pd.read_sql), or
+        if chunksize is given, an iterator of dataframes of up to `chunksize` rows fetched from the cursor as
+        they are needed (read each iterator to the end before running the same query text again).
+        Results are fetched by the fastest path available for the connection (see fetch).
+        '''
+        return fetch.read(self.cnxn, self.cursor(sql), sql, params, chunksize)
+
+    def close(self):
+        for cursor in self.cursors.values():
+            cursor.close()
+        self.cursors.clear()
+
+
+class QueryBatch:
+    ''' Independent queries sent to the server together, as one batch of statements in one round trip, with
+    their results read back in order with cursor.nextset(). Helpers which run many small queries in turn
+    (e.g. one per column) otherwise wait for the network once per query.
+
+    queries (list): Query objects
+    max_params (int): most parameters to bind in one batch (SQL Server allows 2100); longer lists are
+                      sent as several batches
+
+    run() returns one result per query, in the same order: a dataframe, or the exception the query raised.
+    A statement which fails is retried on its own, so an error is always recorded against the query that
+    caused it, and the queries after it still get their results. Connections which can't return several
+    result sets from one batch (DuckDB, sqlite) run the queries one at a time through their prepared statements.
+    '''
+    def __init__(self, cnxn, queries=(), max_params=2000):
+        self.cnxn = cnxn
+        self.queries = list(queries)
+        self.max_params = max_params
+        self.round_trips = 0
+
+    def add(self, query):
+        ''' Add a query to the batch, returning its position in the results '''
+        self.queries.append(query)
+        return len(self.queries) - 1
+
+    def _batched(self):
+        if getattr(getattr(self.cnxn, "dialect", None), "name", "tsql") != "tsql":
+            return False
+        cursor = self.cnxn.cursor()
+        cursor.close()
+        return hasattr(cursor, "nextset")
+
+    def _run_one(self, query):
+        self.round_trips += 1
+        try:
+            return prepared_statements(self.cnxn).read(query.sql, query.params)
+        except Exception as e:
+            return e
+
+    def _run_batch(self, queries, results):
+        ''' Run `queries` as one batch, storing each result (by index) in `results`. Returns the indices of
+        queries still to run, if a statement failed part way through the batch.
+        '''
+        cursor = self.cnxn.cursor()
+        self.round_trips += 1
+        try:
+            try:
+                cursor.execute(";\n".join(q.sql for _, q in queries), [p for _, q in queries for p in q.params])
+            except Exception:
+                # the batch failed as a whole (e.g. one statement doesn't compile): run the queries
+                # on their own to find out which
+                for i, query in queries:
+                    results[i] = self._run_one(query)
+                return []
+            for k, (i, query) in enumerate(queries):
+                try:
+                    if k and not cursor.nextset():
+                        # the server stopped running the batch early: send the rest again
+                        return queries[k:]
+                    results[i] = fetch.fetch_frame(cursor)
+                except Exception as e:
+                    # statement k failed: record its error and send the rest again
+                    results[i] = e
+                    return queries[k + 1:]
+            return []
+        finally:
+            cursor.close()
+
+    def run(self):
+        results = [None] * len(self.queries)
+        if not self._batched():
+            return [self._run_one(query) for query in self.queries]
+        pending = list(enumerate(self.queries))
+        while pending:
+            # as many queries as fit within max_params (and always at least one)
+            n, params = 1, len(pending[0][1].params)
+            while n < len(pending) and params + len(pending[n][1].params) <= self.max_params:
+                params += len(pending[n][1].params)
+                n += 1
+            if n == 1:
+                i, query = pending[0]
+                results[i] = self._run_one(query)
+                pending = pending[1:]
+            else:
+                pending = self._run_batch(pending[:n], results) + pending[n:]
+        return results
+
+
+def read_batch(cnxn, queries):
+    ''' Run independent queries in as few round trips as the connection allows (see QueryBatch), returning one
+    dataframe, or the exception raised, for each query in order
+    '''
+    return QueryBatch(cnxn, queries).run()
+
+
+# prepared statements for each open connection, keyed by id(connection)
+_statements = {}
+
+
+def prepared_statements(cnxn):
+    ''' The PreparedStatements for an open connection '''
+    if id(cnxn) not in _statements or _statements[id(cnxn)].cnxn is not cnxn:
+        _statements[id(cnxn)] = PreparedStatements(cnxn)
+    return _statements[id(cnxn)]
+
+
+def close_statements(cnxn):
+    ''' Close the cursors kept for a connection, before the connection is closed '''
+    statements = _statements.pop(id(cnxn), None)
+    if statements is not None:
+        statements.close()
+
+
+
+if __name__ == "__main__":
+    # Benchmark against a local stand-in (sqlite, which also caches compiled statements by query
+    # text): count a column for each of a set of filter values, with the values written into the
+    # query text as the helpers used to, and with the values bound to one prepared query shape
+    import sqlite3
+    import time
+
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    n_rows, n_values, calls = 10_000, 200, 2_000
+    cnxn = sqlite3.connect(":memory:", cached_statements=100)
+    df = pd.DataFrame({"patient_id": rng.integers(0, 20_000, n_rows),
+                       "Intervention": rng.integers(0, n_values, n_rows).astype(str),
+                       "Region": rng.choice(["East", "London", "North"], n_rows)})
+    df.to_sql("Therapeutics", cnxn, index=False)
+    cnxn.execute("create index ix_intervention on Therapeutics (Intervention)")
+    values = [str(v) for v in rng.integers(0, n_values, calls)]
+
+    start = time.perf_counter()
+    literal = [pd.read_sql(f"select Region, count(*) as row_count from Therapeutics where Intervention='{v}' group by Region", cnxn)
+               for v in values]
+    literal_seconds = time.perf_counter() - start
+
+    statements = prepared_statements(cnxn)
+    start = time.perf_counter()
+    prepared = []
+    for v in values:
+        query = group_count("Therapeutics", ["Region"], where=[("Intervention", "==", v)])
+        prepared.append(statements.read(query.sql, query.params))
+    prepared_seconds = time.perf_counter() - start
+
+    for a, b in zip(literal, prepared):
+        pd.testing.assert_frame_equal(a, b, check_dtype=False)
+    print(f"{calls} calls over {n_values} filter values")
+    print(f"literal query text:  {1e6 * literal_seconds / calls:.0f}us per call, {len(set(values))} distinct query texts")
+    print(f"prepared statements: {1e6 * prepared_seconds / calls:.0f}us per call, {statements.prepared} distinct query text")
+
+    # missing values satisfy a negated filter, as in cohort_engine
+    cnxn.execute("insert into Therapeutics values (1, null, 'East')")
+    query = group_count("Therapeutics", ["Region"], where=[("Intervention", "not ==", "1")])
+    assert statements.read(query.sql, query.params)["row_count"].sum() == (df["Intervention"] != "1").sum() + 1
+
+    # suppression in the database: only counts over 7 are transferred, rounded as suppress_and_round does
+    columns = ["Intervention", "Region"]
+    query = group_count("Therapeutics", columns)
+    raw = statements.read(query.sql, query.params)
+    raw = raw.loc[raw["Intervention"].notna()]
+    query = suppressed_group_count("Therapeutics", columns)
+    shown = statements.read(query.sql, query.params).sort_values(columns).reset_index(drop=True)
+    query = suppression_summary("Therapeutics", columns)
+    summary = statements.read(query.sql, query.params).iloc[0]
+    kept = raw.loc[raw["row_count"] > 7].sort_values(columns).reset_index(drop=True)
+    assert (shown["row_count"] == (5 * (kept["row_count"] / 5).round()).astype(int)).all()
+    assert summary["distinct_values"] == len(raw) and summary["suppressed_values"] == len(raw) - len(kept)
+    assert summary["missing_rows"] == 0 and summary["missing_suppressed"] == 1
+    print(f"{len(shown)} of {len(raw)} rows of counts transferred with suppression in the database")
+    close_statements(cnxn)
+
+    # Batches: a stand-in for a SQL Server connection (on sqlite, which has no batches), where each call
+    # to the server waits for the network and a batch's result sets are read back with nextset()
+    latency = 0.02
+
+    class BatchCursor:
+        def __init__(self, cnxn):
+            self.cursor = cnxn.cursor()
+            self.results = []
+
+        def execute(self, sql, params=()):
+            time.sleep(latency)
+            params, self.results = list(params), []
+            for statement in sql.split(";\n"):
+                n = statement.count("?")
+                try:
+                    self.cursor.execute(statement, params[:n])
+                    self.results.append(([d[0] for d in self.cursor.description], self.cursor.fetchall()))
+                except sqlite3.Error as e:
+                    if not self.results:
+                        raise
+                    self.results.append(e)
+                params = params[n:]
+            self.nextset()
+
+        def nextset(self):
+            if not self.results:
+                return False
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            self.description = [(name,) for name in result[0]]
+            self.rows = result[1]
+            return True
+
+        def fetchall(self):
+            return self.rows
+
+        def close(self):
+            self.cursor.close()
+
+    class BatchConnection:
+        def __init__(self, cnxn):
+            self.cnxn = cnxn
+
+        def cursor(self):
+            return BatchCursor(self.cnxn)
+
+    server = BatchConnection(cnxn)
+    where = [("Intervention", "!=", "1")]
+    queries = [column_counts("Therapeutics", c, where=where) for c in df.columns] * 10
+    # a statement which fails when it runs (rather than when the batch is compiled) part way through
+    queries.insert(5, Query("select abs(-9223372036854775808) as n"))
+
+    start = time.perf_counter()
+    one_by_one = []
+    for query in queries:
+        time.sleep(latency)
+        try:
+            one_by_one.append(pd.read_sql(query.sql, cnxn, params=query.params))
+        except Exception as e:
+            one_by_one.append(e)
+    one_by_one_seconds = time.perf_counter() - start
+
+    batch = QueryBatch(server, queries)
+    start = time.perf_counter()
+    batched = batch.run()
+    batched_seconds = time.perf_counter() - start
+
+    assert [isinstance(r, Exception) for r in batched] == [isinstance(r, Exception) for r in one_by_one] == [i == 5 for i in range(len(queries))]
+    for a, b in zip(one_by_one, batched):
+        if not isinstance(a, Exception):
+            pd.testing.assert_frame_equal(a, b, check_dtype=False)
+    print(f"{len(queries)} queries one at a time: {len(queries)} round trips, {one_by_one_seconds:.2f}s")
+    print(f"{len(queries)} queries in a batch: {batch.round_trips} round trips, {batched_seconds:.2f}s")
+
+    # a statement which doesn't compile fails the whole batch, and is found by running the queries on their own
+    broken = QueryBatch(server, queries[:3] + [Query("select nothing from Therapeutics")])
+    assert [isinstance(r, Exception) for r in broken.run()] == [False, False, False, True]
+    print("OK")
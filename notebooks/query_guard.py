@@ -0,0 +1,291 @@
+import pandas as pd
+import logging
+import re
+import xml.etree.ElementTree as ET
+
+from run_budget import check_cancelled, current_section, query_timeout
+from query_builder import prepared_statements, read_batch, Query, subsets
+from results import record_note
+
+
+# Optional pre-flight check for the SQL generated by the sense_checking helpers.
+# When a guard is set with set_query_guard(), each guarded query's estimated execution
+# plan is fetched first (SET SHOWPLAN_XML ON, so the query itself is not run), its
+# estimated rows, cost and scan/sort operators are logged, and queries estimated to cost
+# more than the budget are refused, sampled or just warned about. With no guard set
+# (the default) queries run exactly as before.
+
+logger = logging.getLogger(__name__)
+
+showplan_ns = {"sp": "http://schemas.microsoft.com/sqlserver/2004/07/showplan"}
+scan_operators = ["Table Scan", "Clustered Index Scan", "Index Scan"]
+sort_operators = ["Sort", "Hash Match"]
+
+_guard = None
+
+
+class ExpensiveQueryError(Exception):
+    pass
+
+
+def get_estimated_plan(cnxn, sql, params=None):
+    ''' Return the estimated execution plan XML for `sql`, without running it '''
+    cursor = cnxn.cursor()
+    try:
+        cursor.execute("SET SHOWPLAN_XML ON")
+        try:
+            cursor.execute(sql, list(params or []))
+            return cursor.fetchone()[0]
+        finally:
+            cursor.execute("SET SHOWPLAN_XML OFF")
+    finally:
+        cursor.close()
+
+
+def parse_plan(plan_xml):
+    ''' Extract estimated rows, estimated cost and the scan/sort operators from a showplan XML document '''
+    root = ET.fromstring(plan_xml)
+    statements = root.findall(".//sp:StmtSimple", showplan_ns)
+    operators = []
+    for relop in root.findall(".//sp:RelOp", showplan_ns):
+        op = relop.get("PhysicalOp")
+        if op in scan_operators + sort_operators:
+            objects = relop.findall(".//sp:Object", showplan_ns)
+            operators.append({
+                "operator": op,
+                "object": objects[0].get("Table", "").strip("[]") if objects else "",
+                "estimated_rows": float(relop.get("EstimateRows", 0)),
+            })
+    return {
+        "estimated_rows": sum(float(s.get("StatementEstRows", 0)) for s in statements),
+        "estimated_cost": sum(float(s.get("StatementSubTreeCost", 0)) for s in statements),
+        "operators": operators,
+    }
+
+
+class QueryGuard:
+    ''' Checks each guarded query's estimated plan against a cost budget.
+
+    Inputs:
+    cost_budget (float): maximum estimated subtree cost (SQL Server's cost units)
+    action (str): for queries over budget, "warn" (log and run anyway), "refuse" (raise ExpensiveQueryError)
+                  or "sample" (run on a TABLESAMPLE of the table, scaled to the budget)
+    plan_source (function): takes (cnxn, sql, params) and returns plan XML; defaults to get_estimated_plan.
+                  Pass a CannedPlans to test without a database.
+    '''
+    def __init__(self, cost_budget, action="warn", plan_source=None, min_sample_percent=1):
+        if action not in ["warn", "refuse", "sample"]:
+            raise ValueError(f"Unknown action: {action}")
+        self.cost_budget = cost_budget
+        self.action = action
+        self.plan_source = plan_source or get_estimated_plan
+        self.min_sample_percent = min_sample_percent
+        self.log = []
+
+    def check(self, cnxn, sql, table=None, params=None):
+        ''' Return the SQL to run (possibly rewritten to sample `table`), or raise ExpensiveQueryError '''
+        plan = parse_plan(self.plan_source(cnxn, sql, params))
+        over_budget = plan["estimated_cost"] > self.cost_budget
+        entry = {"sql": " ".join(sql.split()), **plan, "over_budget": over_budget, "action": None}
+        self.log.append(entry)
+        logger.info("estimated cost %.2f, rows %.0f, operators %s",
+                    plan["estimated_cost"], plan["estimated_rows"], [o["operator"] for o in plan["operators"]])
+        if not over_budget:
+            return sql
+
+        entry["action"] = self.action
+        message = f"Estimated query cost {plan['estimated_cost']:.2f} is over the budget of {self.cost_budget}"
+        if self.action == "refuse":
+            raise ExpensiveQueryError(message)
+        if self.action == "sample" and table:
+            percent = max(100 * self.cost_budget / plan["estimated_cost"], self.min_sample_percent)
+            logger.warning("%s; sampling %.1f%% of %s", message, percent, table)
+            record_note(f"Some figures below are from a {percent:.1f}% sample of {table} (the full query's estimated "
+                        f"cost was over the budget), so counts are lower than for the whole table.")
+            return sample_source(sql, table, percent)
+        logger.warning(message)
+        return sql
+
+    def log_table(self):
+        ''' The plans checked so far as a dataframe '''
+        return pd.DataFrame(self.log)
+
+
+# words which can follow a table in a FROM/JOIN clause, so are not its alias
+clause_keywords = ["where", "group", "order", "having", "union", "except", "intersect", "join", "inner", "left",
+                   "right", "full", "outer", "cross", "on", "with", "option", "tablesample"]
+
+
+def sample_table(sql, table, percent):
+    ''' Rewrite references to `table` in FROM/JOIN clauses of `sql` to read a TABLESAMPLE of it '''
+    # the table name may be quoted, e.g. [Therapeutics], and may have an alias, which comes before TABLESAMPLE
+    name = re.escape(table.strip("[]"))
+    keywords = "|".join(clause_keywords)
+    pattern = re.compile(
+        rf"\b(from|join)\s+(\[{name}\]|{name}\b)(\s+(as\s+)?(?!(?:{keywords})\b)(\[\w+\]|\w+))?", re.IGNORECASE
+    )
+
+    def sample(m):
+        if re.match(r"\s+tablesample\b", sql[m.end():], re.IGNORECASE):
+            return m.group(0)
+        return f"{m.group(0)} TABLESAMPLE ({percent:.1f} PERCENT)"
+
+    return pattern.sub(sample, sql)
+
+
+def sample_source(sql, table, percent):
+    ''' As sample_table, also sampling any subsets of `table` which the query reads instead (see subset_session) '''
+    for name in [table] + subsets(table):
+        sql = sample_table(sql, name, percent)
+    return sql
+
+
+class CannedPlans:
+    ''' A local stand-in for get_estimated_plan, returning canned plan XML for queries matching regex patterns.
+
+    plans (list): list of (pattern, plan_xml) tuples; the first pattern found in the query is used
+    default (str): plan XML for queries matching no pattern
+    '''
+    def __init__(self, plans, default=None):
+        self.plans = [(re.compile(p, re.IGNORECASE | re.DOTALL), xml) for p, xml in plans]
+        self.default = default or canned_plan(1, 0.01)
+        self.queries = []
+
+    def __call__(self, cnxn, sql, params=None):
+        self.queries.append(sql)
+        for pattern, xml in self.plans:
+            if pattern.search(sql):
+                return xml
+        return self.default
+
+
+def canned_plan(estimated_rows, estimated_cost, operators=(), table="Therapeutics"):
+    ''' Minimal showplan XML with the given estimates and physical operators, for use with CannedPlans '''
+    relops = "".join(
+        f'<RelOp PhysicalOp="{op}" EstimateRows="{estimated_rows}" EstimatedTotalSubtreeCost="{estimated_cost}">'
+        f'<Object Table="[{table}]" /></RelOp>'
+        for op in operators
+    )
+    return (
+        f'<ShowPlanXML xmlns="{showplan_ns["sp"]}"><BatchSequence><Batch><Statements>'
+        f'<StmtSimple StatementEstRows="{estimated_rows}" StatementSubTreeCost="{estimated_cost}">'
+        f'<QueryPlan>{relops}</QueryPlan></StmtSimple>'
+        f'</Statements></Batch></BatchSequence></ShowPlanXML>'
+    )
+
+
+def set_query_guard(guard):
+    ''' Use `guard` (a QueryGuard, or None to switch off) for all guarded queries '''
+    global _guard
+    _guard = guard
+
+
+def guarded_read_sql(sql, cnxn, table=None, params=None, chunksize=None):
+    ''' Run `sql` (with any `params` bound, through the connection's prepared statements) and return
+    the results as a dataframe (or an iterator of dataframes of up to `chunksize` rows), after checking the query's estimated plan if a guard is set, and within
+    the current run budget section (see run_budget) if there is one
+    '''
+    check_cancelled()
+    if _guard is not None:
+        sql = _guard.check(cnxn, sql, table=table, params=params)
+    section = current_section()
+    if section is not None and section.mode == "sample" and table:
+        sql = sample_source(sql, table, section.sample_percent)
+    timeout = query_timeout()
+    if timeout:
+        cnxn.timeout = timeout
+    return prepared_statements(cnxn).read(sql, params, chunksize=chunksize)
+
+
+def guarded_read_batch(queries, cnxn, table=None):
+    ''' As guarded_read_sql, for a list of independent Query objects sent together in as few round trips as the
+    connection allows (see query_builder.QueryBatch). Returns one result per query, in order: a dataframe,
+    or the exception it raised (including the guard refusing it), so callers can fall back query by query.
+    The query timeout applies to each batch as a whole.
+    '''
+    check_cancelled()
+    results = [None] * len(queries)
+    checked = []
+    section = current_section()
+    for i, query in enumerate(queries):
+        sql = query.sql
+        try:
+            if _guard is not None:
+                sql = _guard.check(cnxn, sql, table=table, params=query.params)
+        except ExpensiveQueryError as e:
+            results[i] = e
+            continue
+        if section is not None and section.mode == "sample" and table:
+            sql = sample_source(sql, table, section.sample_percent)
+        checked.append((i, Query(sql, query.params)))
+    timeout = query_timeout()
+    if timeout:
+        cnxn.timeout = timeout
+    for (i, _), result in zip(checked, read_batch(cnxn, [query for _, query in checked])):
+        results[i] = result
+    return results
+
+
+def raise_errors(results):
+    ''' The results of guarded_read_batch, raising the first error if any query failed '''
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+
+if __name__ == "__main__":
+    # A quick test of QueryGuard with canned plans
+    plans = CannedPlans([
+        ("count\\(distinct", canned_plan(1e8, 500, ["Clustered Index Scan", "Sort"])),
+    ])
+
+    sql = "select count(distinct Region) as n from Therapeutics where Region is not null"
+    assert QueryGuard(1000, plan_source=plans).check(None, sql) == sql
+
+    guard = QueryGuard(100, action="refuse", plan_source=plans)
+    try:
+        guard.check(None, sql)
+        raise AssertionError("expected ExpensiveQueryError")
+    except ExpensiveQueryError:
+        pass
+    assert guard.log[0]["operators"][0] == {"operator": "Clustered Index Scan", "object": "Therapeutics", "estimated_rows": 1e8}
+
+    sampled = QueryGuard(100, action="sample", plan_source=plans).check(None, sql, table="Therapeutics")
+    assert sampled == "select count(distinct Region) as n from Therapeutics TABLESAMPLE (20.0 PERCENT) where Region is not null"
+
+    quoted = sample_table("select [Region], count(*) as row_count from [Therapeutics] group by [Region]", "Therapeutics", 10)
+    assert "from [Therapeutics] TABLESAMPLE (10.0 PERCENT) group by" in quoted
+    assert sample_table(quoted, "Therapeutics", 10) == quoted
+
+    # an alias comes before TABLESAMPLE, as in compare_two_values
+    aliased = sample_table("select t1.[a] as [a], t2.[b] as [b], count(*) as row_count from [Therapeutics] t1 "
+                           "LEFT JOIN [Patients] t2 ON t1.[patient_id] = t2.[patient_id] group by t1.[a], t2.[b]", "Therapeutics", 10)
+    assert "from [Therapeutics] t1 TABLESAMPLE (10.0 PERCENT) LEFT JOIN [Patients] t2 ON" in aliased
+    assert sample_table(aliased, "Therapeutics", 10) == aliased
+    aliased = sample_table("select count(*) from Therapeutics as t where t.Region is not null", "Therapeutics", 10)
+    assert aliased == "select count(*) from Therapeutics as t TABLESAMPLE (10.0 PERCENT) where t.Region is not null"
+
+    # a session's subset of the table is sampled in its place
+    from query_builder import register_subset, forget_subset
+    register_subset("Therapeutics", "Region = 'East'", "#subset_1")
+    assert sample_source("select count(*) from [#subset_1]", "Therapeutics", 10) == \
+        "select count(*) from [#subset_1] TABLESAMPLE (10.0 PERCENT)"
+    forget_subset("Therapeutics", "Region = 'East'")
+
+    # sampled figures are noted in the helper's result
+    from results import Result, _recording
+    result = Result("helper")
+    _recording.append(result)
+    QueryGuard(100, action="sample", plan_source=plans).check(None, sql, table="Therapeutics")
+    QueryGuard(100, action="sample", plan_source=plans).check(None, sql, table="Therapeutics")
+    _recording.pop()
+    assert [b["text"] for b in result.blocks] == ["**Note:** Some figures below are from a 20.0% sample of Therapeutics "
+                                                   "(the full query's estimated cost was over the budget), so counts are "
+                                                   "lower than for the whole table."]
+
+    cheap = "select Region, count(*) as row_count from Therapeutics group by Region"
+    assert QueryGuard(100, action="refuse", plan_source=plans).check(None, cheap) == cheap
+
+    print("OK")
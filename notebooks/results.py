@@ -0,0 +1,323 @@
+import functools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Structured results for the sense_checking helpers, so that a report can be re-rendered
+# (or reworded) from stored results without re-running any queries.
+#
+# Each helper decorated with @reported returns a Result: the markdown and tables it
+# produced, in order, plus any scalar values and suppression metadata it recorded.
+# Within a helper, display() and Markdown() from this module record into the Result
+# rather than displaying directly. By default the Result is rendered as soon as the
+# helper finishes, so the notebooks' output is unchanged; pass render=False to only
+# compute it.
+#
+# e.g. in a notebook:
+#     from results import session_results, save_results
+#     ...
+#     save_results(session_results(), "../output/therapeutics_results")
+# and later, with no database:
+#     python notebooks/results.py ../output/therapeutics_results --html therapeutics.html
+
+# results produced by reported helpers in this session
+_session = []
+# results currently being recorded into, innermost last
+_recording = []
+# results of a previous run; sections which haven't changed since are not shown in full
+_baseline = None
+# notes about the next helper call, made before its result was started (see run_budget)
+_deferred_notes = []
+# partial results of failed helper calls which may be re-run (see run_budget), kept rather than displayed
+_held_failures = None
+
+
+class Markdown:
+    ''' Markdown text, displayed as IPython's Markdown would be (without importing IPython) '''
+    def __init__(self, data):
+        self.data = data
+
+    def _repr_markdown_(self):
+        return self.data
+
+
+class Result:
+    ''' Output of one call to a sense_checking helper.
+
+    name (str): name of the helper
+    params (dict): arguments the helper was called with
+    blocks (list): {"type": "markdown", "text": ...} or {"type": "table", "table": DataFrame} in display order
+    values (dict): scalar values, e.g. total rows
+    suppressed (dict): number of low-count values suppressed, by table/column
+    '''
+    def __init__(self, name, params=None):
+        self.name = name
+        self.params = params or {}
+        self.blocks = []
+        self.values = {}
+        self.suppressed = {}
+        self.rendered = False
+
+    def markdown(self, text):
+        self.blocks.append({"type": "markdown", "text": text})
+
+    def table(self, df):
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        self.blocks.append({"type": "table", "table": df})
+
+    def add(self, obj):
+        ''' Record an object as display() would show it '''
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            self.table(obj)
+        elif hasattr(obj, "_repr_markdown_"):
+            self.markdown(obj._repr_markdown_())
+        else:
+            self.markdown(str(obj))
+
+    def tables(self):
+        return [b["table"] for b in self.blocks if b["type"] == "table"]
+
+    def render(self):
+        ''' Display the result in a notebook, as the helper used to '''
+        from utilities2 import display
+        for block in self.blocks:
+            display(Markdown(block["text"]) if block["type"] == "markdown" else block["table"])
+        self.rendered = True
+        return self
+
+    def _ipython_display_(self):
+        # a helper's result is usually rendered when the helper finishes; don't show it twice
+        # when it is also the last value in a cell
+        if not self.rendered:
+            self.render()
+
+    def to_markdown(self):
+        ''' The result as markdown, with tables as HTML '''
+        return "\n\n".join(
+            b["text"] if b["type"] == "markdown" else b["table"].to_html()
+            for b in self.blocks
+        )
+
+    def to_dict(self, table_files=None):
+        ''' JSON-serializable form, with tables replaced by the names in `table_files` (if given) '''
+        blocks = []
+        for n, block in enumerate(self.blocks):
+            if block["type"] == "table":
+                blocks.append({"type": "table", "file": table_files[n] if table_files else None})
+            else:
+                blocks.append(dict(block))
+        return {"name": self.name, "params": jsonable(self.params), "blocks": blocks,
+                "values": jsonable(self.values), "suppressed": jsonable(self.suppressed)}
+
+
+def jsonable(obj):
+    return json.loads(json.dumps(obj, default=lambda o: o.item() if isinstance(o, np.generic) else str(o)))
+
+
+def _to_parquet(df, path):
+    try:
+        df.to_parquet(path)
+    except Exception:
+        df = df.copy()
+        # parquet needs string column names (e.g. quantiles have (column, quantile) names)
+        df.columns = [" ".join(map(str, c)) if isinstance(c, tuple) else str(c) for c in df.columns]
+        # after round_and_suppress, count columns mix numbers with "1-7"; store those as strings
+        for c in df.columns[df.dtypes == object]:
+            df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+        df.to_parquet(path)
+
+
+def display(*objs, **kwargs):
+    ''' Record objects into the result of the helper being run, or display them if no helper is running '''
+    if not _recording:
+        from utilities2 import display as notebook_display
+        return notebook_display(*objs, **kwargs)
+    for obj in objs:
+        _recording[-1].add(obj)
+
+
+def current_result():
+    ''' The Result being recorded by the helper currently running, or None '''
+    return _recording[-1] if _recording else None
+
+
+def record_value(name, value):
+    ''' Record a scalar value in the result of the helper being run (if any) '''
+    if _recording:
+        _recording[-1].values[name] = value
+
+
+def _note(text):
+    return Markdown(f"**Note:** {text}")
+
+
+def record_note(text):
+    ''' Add a note to the result of the helper being run (once), or display it if no helper is running '''
+    note = _note(text)
+    if _recording and {"type": "markdown", "text": note.data} in _recording[-1].blocks:
+        return
+    display(note)
+
+
+def defer_note(text):
+    ''' Add a note to the start of the next helper's result '''
+    _deferred_notes.append(text)
+
+
+def hold_failures():
+    ''' Keep the partial results of helpers which fail, rather than displaying them, until release_failures '''
+    global _held_failures
+    _held_failures = []
+
+
+def release_failures(render=True):
+    ''' Stop keeping failed helpers' partial results, and display those kept if `render` (i.e. unless the
+    helper is being re-run)
+    '''
+    global _held_failures
+    held, _held_failures = _held_failures or [], None
+    if render:
+        for result in held:
+            result.render()
+
+
+def flush_notes(name):
+    ''' Record any deferred notes which no helper's result has taken (e.g. because the helper was skipped)
+    in a result of their own for `name`, and render it
+    '''
+    if not _deferred_notes:
+        return None
+    result = Result(name)
+    for text in _deferred_notes:
+        result.markdown(_note(text).data)
+    _deferred_notes.clear()
+    _session.append(result)
+    return result.render()
+
+
+def record_suppressed(name, count):
+    ''' Record how many low-count values were suppressed from a table in the result of the helper being run (if any) '''
+    if _recording:
+        _recording[-1].suppressed[name] = int(count)
+
+
+def reported(func):
+    ''' Decorator making a helper return a Result of everything it displays.
+    The helper takes an extra keyword argument, render (default True), to display the result when it finishes.
+    '''
+
+    @functools.wraps(func)
+    def wrapper(*args, render=True, **kwargs):
+        names = func.__code__.co_varnames[:func.__code__.co_argcount]
+        params = {k: v for k, v in zip(names, args) if k != "dbconn"}
+        params.update({k: v for k, v in kwargs.items() if k != "dbconn"})
+        result = Result(func.__name__, params)
+        for text in _deferred_notes:
+            result.markdown(_note(text).data)
+        _deferred_notes.clear()
+        _recording.append(result)
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            # show whatever the helper got through before failing, as it would have been displayed,
+            # unless it may be re-run (and its output shown then)
+            if render and _held_failures is not None:
+                _held_failures.append(result)
+            elif render:
+                result.render()
+            raise
+        finally:
+            _recording.pop()
+        _session.append(result)
+        if render:
+            if _baseline is not None and _unchanged(result):
+                from utilities2 import display as notebook_display
+                notebook_display(Markdown(f"*`{result.name}`: unchanged since the previous run.*"))
+                result.rendered = True
+            else:
+                result.render()
+        return result
+
+    return wrapper
+
+
+def _unchanged(result):
+    from results_diff import unchanged
+    return unchanged(_baseline, result)
+
+
+def set_baseline(previous):
+    ''' Only show helpers' results in full if they have changed since `previous` (a directory saved with
+    save_results, or a list of results), or None to show everything
+    '''
+    global _baseline
+    _baseline = load_results(previous) if isinstance(previous, str) else previous
+
+
+def session_results():
+    ''' All results produced by reported helpers in this session, in order '''
+    return list(_session)
+
+
+def save_results(results, path):
+    ''' Save results to directory `path`: results.json, and one parquet file per table '''
+    os.makedirs(path, exist_ok=True)
+    manifest = []
+    for i, result in enumerate(results):
+        table_files = {}
+        for n, block in enumerate(result.blocks):
+            if block["type"] == "table":
+                table_files[n] = f"{i:03d}_{result.name}_{n:03d}.parquet"
+                _to_parquet(block["table"], os.path.join(path, table_files[n]))
+        manifest.append(result.to_dict(table_files))
+    with open(os.path.join(path, "results.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_results(path):
+    ''' Load results saved with save_results '''
+    with open(os.path.join(path, "results.json")) as f:
+        manifest = json.load(f)
+    results = []
+    for item in manifest:
+        result = Result(item["name"], item["params"])
+        result.values = item["values"]
+        result.suppressed = item["suppressed"]
+        for block in item["blocks"]:
+            if block["type"] == "table":
+                result.table(pd.read_parquet(os.path.join(path, block["file"])))
+            else:
+                result.markdown(block["text"])
+        results.append(result)
+    return results
+
+
+def to_markdown(results):
+    return "\n\n".join(r.to_markdown() for r in results) + "\n"
+
+
+def to_html(results):
+    import mistune
+    return mistune.markdown(to_markdown(results), escape=False)
+
+
+
+if __name__ == "__main__":
+    # Re-render saved results, without a database
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render results saved with save_results as markdown or HTML")
+    parser.add_argument("path", help="directory of saved results")
+    parser.add_argument("--html", help="write HTML to this file (default: print markdown)")
+    args = parser.parse_args()
+
+    results = load_results(args.path)
+    if args.html:
+        with open(args.html, "w") as f:
+            f.write(to_html(results))
+    else:
+        print(to_markdown(results))
@@ -0,0 +1,204 @@
+import hashlib
+import json
+
+import pandas as pd
+
+from results import Result, load_results, jsonable
+
+
+# What changed between two runs of the profiling notebooks, from their saved results
+# (see results.save_results). Results are matched by helper name and arguments, then:
+#   - scalar values, suppression counts and markdown text are compared directly
+#   - each table is hashed as a whole first, and only tables whose hashes differ are
+#     compared row by row: rows are keyed by a hash of their index (or first column),
+#     joined on that key, and reported as added, removed, or changed (with the old and
+#     new values of the columns that changed)
+# diff_results returns a Result, so the "what changed" section can be displayed, saved
+# and re-rendered like any other.
+#
+# e.g. in a notebook, after the helpers have run:
+#     from results_diff import diff_results
+#     diff_results(load_results("../output/previous_results"), session_results())
+# or, before running them, results.set_baseline("../output/previous_results") to show only
+# a one-line note for each helper whose results haven't changed.
+
+max_rows_shown = 20
+
+
+def result_key(result):
+    ''' Identify a result across runs by its helper and arguments '''
+    params = json.dumps(jsonable(result.params), sort_keys=True)
+    return result.name, hashlib.sha1(params.encode("utf8")).hexdigest()[:12]
+
+
+def _describe(result):
+    params = ", ".join(f"{k}={v!r}" for k, v in result.params.items())
+    return f"`{result.name}({params})`"
+
+
+def _normalise(df):
+    # tables as they are after a round trip through save_results/load_results
+    df = df.copy()
+    df.columns = [" ".join(map(str, c)) if isinstance(c, tuple) else str(c) for c in df.columns]
+    for c in df.columns[df.dtypes == object]:
+        # counts after round_and_suppress are object columns, saved as numbers unless they include "1-7"
+        try:
+            df[c] = pd.to_numeric(df[c])
+        except (ValueError, TypeError):
+            df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+    if isinstance(df.index, pd.RangeIndex) and len(df.columns) > 1:
+        # rows are identified by their first column (e.g. the value, token or column name)
+        df = df.set_index(df.columns[0])
+    return df
+
+
+def _row_hashes(df):
+    # key: hash of the index (plus its occurrence number, in case of duplicates); value: hash of the row
+    index = df.index.to_frame(index=False).astype(str)
+    index["occurrence"] = index.groupby(list(index.columns)).cumcount()
+    keys = pd.util.hash_pandas_object(index, index=False).to_numpy()
+    values = pd.util.hash_pandas_object(df.reset_index(drop=True), index=False).to_numpy()
+    return pd.Series(values, index=keys)
+
+
+def table_hash(df):
+    return int(pd.util.hash_pandas_object(_normalise(df).reset_index(), index=False).sum())
+
+
+def diff_tables(before, after):
+    ''' Compare two tables row by row.
+    Returns: (number of rows added, number removed, DataFrame of changed cells with columns row, column, before, after)
+    '''
+    before, after = _normalise(before), _normalise(after)
+    old, new = _row_hashes(before), _row_hashes(after)
+
+    joined = pd.DataFrame({"before": old}).join(pd.DataFrame({"after": new}), how="outer")
+    added = joined["before"].isna().sum()
+    removed = joined["after"].isna().sum()
+    changed_keys = joined.index[joined["before"].notna() & joined["after"].notna() & (joined["before"] != joined["after"])]
+
+    cells = []
+    if len(changed_keys):
+        old_rows = pd.Series(range(len(old)), index=old.index)[changed_keys]
+        new_rows = pd.Series(range(len(new)), index=new.index)[changed_keys]
+        for i, j in zip(old_rows, new_rows):
+            for column in after.columns:
+                a = before[column].iloc[i] if column in before.columns else None
+                b = after[column].iloc[j]
+                if not (a == b or (pd.isna(a) and pd.isna(b))):
+                    cells.append({"row": str(after.index[j]), "column": column, "before": a, "after": b})
+    return int(added), int(removed), pd.DataFrame(cells, columns=["row", "column", "before", "after"])
+
+
+def diff_result(before, after):
+    ''' Differences between two results of the same helper call, as a list of markdown lines and tables
+    (both empty if nothing changed)
+    '''
+    lines, tables = [], []
+    # compare values as they are saved
+    old_values, new_values = jsonable(before.values), jsonable(after.values)
+    for name in sorted(set(old_values) | set(new_values)):
+        a, b = old_values.get(name), new_values.get(name)
+        if a != b:
+            lines.append(f"- {name}: {a} → {b}")
+    for name in sorted(set(before.suppressed) | set(after.suppressed)):
+        a, b = before.suppressed.get(name, 0), after.suppressed.get(name, 0)
+        if a != b:
+            lines.append(f"- values suppressed in {name}: {a} → {b}")
+
+    old_text = [b["text"] for b in before.blocks if b["type"] == "markdown"]
+    new_text = [b["text"] for b in after.blocks if b["type"] == "markdown"]
+    for a, b in zip(old_text, new_text):
+        if a != b:
+            lines.append(f"- {a.strip()} → {b.strip()}")
+    if len(old_text) != len(new_text):
+        lines.append(f"- {len(new_text) - len(old_text):+d} lines of text")
+
+    old_tables, new_tables = before.tables(), after.tables()
+    for n, (a, b) in enumerate(zip(old_tables, new_tables)):
+        if table_hash(a) == table_hash(b):
+            continue
+        added, removed, cells = diff_tables(a, b)
+        lines.append(f"- table {n + 1}: {added} rows added, {removed} removed, "
+                     f"{cells['row'].nunique()} changed")
+        if len(cells):
+            tables.append(cells.head(max_rows_shown))
+    if len(old_tables) != len(new_tables):
+        lines.append(f"- {len(new_tables) - len(old_tables):+d} tables")
+    return lines, tables
+
+
+def diff_results(previous, current):
+    ''' Compare the results of this run with the results of a previous run (e.g. from load_results),
+    and return a Result listing only what changed
+    '''
+    if isinstance(previous, str):
+        previous = load_results(previous)
+    old = {}
+    for result in previous:
+        old.setdefault(result_key(result), []).append(result)
+
+    report = Result("diff_results")
+    report.markdown("## Changes since the previous run")
+    n_unchanged = 0
+    for result in current:
+        matches = old.get(result_key(result))
+        if not matches:
+            report.markdown(f"**{_describe(result)}**: new")
+            continue
+        lines, tables = diff_result(matches.pop(0), result)
+        if not lines:
+            n_unchanged += 1
+            continue
+        report.markdown(f"**{_describe(result)}**\n\n" + "\n".join(lines))
+        for table in tables:
+            report.table(table)
+    for results in old.values():
+        for result in results:
+            report.markdown(f"**{_describe(result)}**: no longer run")
+
+    report.values = {"unchanged": n_unchanged, "compared": len(current)}
+    report.markdown(f"{n_unchanged} of {len(current)} sections unchanged.")
+    return report
+
+
+def unchanged(previous, result):
+    ''' Whether `result` is the same as its counterpart in `previous` (a list of results) '''
+    for candidate in previous:
+        if result_key(candidate) == result_key(result):
+            return diff_result(candidate, result) == ([], [])
+    return False
+
+
+
+if __name__ == "__main__":
+    # A quick check with two runs' worth of results
+    def make(counts, total):
+        result = Result("counts_of_distinct_values", {"table": "Therapeutics", "columns": ["Region"]})
+        result.values = {"total_rows": total}
+        result.markdown(f"There were **{len(counts)}** different non-missing values")
+        result.table(pd.DataFrame({"Region": list(counts), "row_count": list(counts.values())}))
+        return result
+
+    schema = Result("get_schema", {"table": "Therapeutics"})
+    schema.table(pd.DataFrame({"TableName": ["Therapeutics"] * 2, "ColumnName": ["Region", "Count"],
+                               "Missing_Values": [10, "1-7"]}).set_index(["TableName", "ColumnName"]))
+
+    previous = [schema, make({"East": 100, "London": 50, "North": 10}, 160)]
+    current = [schema, make({"East": 105, "London": 50, "South": 10}, 165)]
+    report = diff_results(previous, current)
+
+    assert report.values == {"unchanged": 1, "compared": 2}
+    changes = report.tables()[0]
+    assert changes.to_dict("records") == [{"row": "East", "column": "row_count", "before": 100, "after": 105}]
+    assert "- table 1: 1 rows added, 1 removed, 1 changed" in report.blocks[1]["text"]
+    assert unchanged(previous, schema) and not unchanged(previous, current[1])
+
+    # results are unchanged by a round trip through save_results/load_results
+    import tempfile
+    from results import save_results
+    with tempfile.TemporaryDirectory() as path:
+        save_results(current, path)
+        assert diff_results(path, current).values == {"unchanged": 2, "compared": 2}
+    print(report.to_markdown())
+    print("OK")
@@ -0,0 +1,292 @@
+import functools
+import math
+import os
+import threading
+import time
+
+from results import defer_note, flush_notes, hold_failures, release_failures
+
+
+# Timeouts and a time budget for notebook runs, so that one runaway query can't stall a
+# nightly run for a day.
+#   - per-query timeout: set_query_timeout(seconds) (or NOTEBOOK_QUERY_TIMEOUT) is applied
+#     to every connection's pyodbc query timeout, so the driver cancels long queries
+#   - run budget: set_run_budget(RunBudget(seconds, sections=n)) (or NOTEBOOK_TIME_BUDGET)
+#     shares the time left between the helper calls still to run. Each @budgeted helper
+#     call gets (time left) / (calls left); a call whose share is short is run on a
+#     TABLESAMPLE of its table, or skipped, and a call whose query times out is retried
+#     once on a sample. Every degraded section gets a note in the notebook output.
+#   - cancellation: cancel() (e.g. from a signal handler or another thread) makes the next
+#     query in any helper raise RunCancelled, and the remaining helpers are skipped.
+# With none of these set, helpers run exactly as before.
+
+# pyodbc SQLSTATEs for a query/connection timeout
+timeout_states = ("HYT00", "HYT01")
+
+_query_timeout = int(os.environ.get("NOTEBOOK_QUERY_TIMEOUT", 0))
+_budget = None
+_section = None
+_cancelled = threading.Event()
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class SectionTimeout(Exception):
+    pass
+
+
+def is_timeout(exc):
+    ''' Whether `exc` is a query timeout (from the driver or from a section running out of time) '''
+    if isinstance(exc, SectionTimeout):
+        return True
+    return bool(getattr(exc, "args", None)) and exc.args[0] in timeout_states
+
+
+class Section:
+    ''' One helper call's share of the run budget '''
+    def __init__(self, name, allocated, mode="full", sample_percent=None):
+        self.name = name
+        self.allocated = allocated
+        self.mode = mode
+        self.sample_percent = sample_percent
+        self.started = time.monotonic()
+
+    def remaining(self):
+        return self.allocated - (time.monotonic() - self.started)
+
+
+class RunBudget:
+    ''' A time budget for a whole notebook run, shared between the helper calls still to run.
+
+    Inputs:
+    seconds (float): total time for the run, counted from when the budget is created
+    sections (int): number of @budgeted helper calls expected in the run (calls beyond this share
+                    whatever time is left)
+    sample_below (float): run a section on a sample if its share of the time is less than this many seconds
+    skip_below (float): skip a section if its share of the time is less than this many seconds
+    sample_percent (float): percentage of the table to sample in sampled sections
+    '''
+    def __init__(self, seconds, sections=1, sample_below=60, skip_below=5, sample_percent=10):
+        self.seconds = seconds
+        self.sections = sections
+        self.sample_below = sample_below
+        self.skip_below = skip_below
+        self.sample_percent = sample_percent
+        self.started = time.monotonic()
+        self.completed = 0
+        self.notes = []
+
+    def remaining(self):
+        return self.seconds - (time.monotonic() - self.started)
+
+    def pending(self):
+        return max(self.sections - self.completed, 1)
+
+    def allocate(self, name):
+        ''' Start a Section for `name` with an equal share of the remaining time '''
+        allocated = self.remaining() / self.pending()
+        if allocated < self.skip_below:
+            return Section(name, allocated, mode="skip")
+        if allocated < self.sample_below:
+            return Section(name, allocated, mode="sample", sample_percent=self.sample_percent)
+        return Section(name, allocated)
+
+
+def set_query_timeout(seconds):
+    ''' Cancel any single query taking longer than `seconds` (0 or None for no timeout) '''
+    global _query_timeout
+    _query_timeout = int(seconds or 0)
+
+
+def set_run_budget(budget):
+    ''' Use `budget` (a RunBudget, or None to switch off) for the rest of the run, which is a new run
+    if an earlier one was cancelled
+    '''
+    global _budget
+    _budget = budget
+    reset()
+
+
+def get_run_budget():
+    return _budget
+
+
+def current_section():
+    return _section
+
+
+def cancel():
+    ''' Ask running and pending helpers to stop at their next query '''
+    _cancelled.set()
+
+
+def reset():
+    ''' Let helpers run again after the run was cancelled '''
+    _cancelled.clear()
+
+
+def check_cancelled():
+    ''' Raise if the run has been cancelled or the current section is out of time '''
+    if _cancelled.is_set():
+        raise RunCancelled("Run cancelled")
+    if _section is not None and _section.remaining() <= 0:
+        raise SectionTimeout(f"{_section.name} ran out of time ({_section.allocated:.0f}s)")
+
+
+def query_timeout():
+    ''' Timeout (whole seconds, 0 for none) for the next query: the per-query timeout, or the
+    time left in the current section if that is shorter
+    '''
+    timeouts = [_query_timeout] if _query_timeout else []
+    if _section is not None:
+        timeouts.append(max(math.ceil(_section.remaining()), 1))
+    return min(timeouts) if timeouts else 0
+
+
+def _note(text):
+    # notes go into the helper's Result (see results), so they are kept when it is re-rendered
+    if _budget is not None:
+        _budget.notes.append(text)
+    defer_note(text)
+
+
+def budgeted(func):
+    ''' Decorator running each call to a helper as one section of the run budget, if one is set '''
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _section
+        if _budget is None and not _cancelled.is_set():
+            return func(*args, **kwargs)
+
+        name = func.__name__
+        if _cancelled.is_set():
+            _note(f"`{name}` was skipped because the run was cancelled.")
+            flush_notes(name)
+            return None
+
+        section = _budget.allocate(name)
+        try:
+            if section.mode == "skip":
+                _note(f"`{name}` was skipped because the run's time budget was nearly used up "
+                      f"({max(_budget.remaining(), 0):.0f}s left).")
+                return None
+            if section.mode == "sample":
+                _note(f"`{name}` was run on a {section.sample_percent}% sample of the table because the run's "
+                      f"time budget was running short ({section.allocated:.0f}s available).")
+
+            _section = section
+            # a helper which times out is re-run, so its partial output is only shown if it isn't
+            hold_failures()
+            try:
+                return func(*args, **kwargs)
+            except RunCancelled:
+                _note(f"`{name}` was stopped because the run was cancelled.")
+                return None
+            except Exception as exc:
+                if not is_timeout(exc):
+                    raise
+                if section.mode == "sample" or section.remaining() <= _budget.skip_below:
+                    _note(f"`{name}` was skipped because it timed out ({section.allocated:.0f}s available).")
+                    return None
+                # retry once on a sample, in the time left in this section
+                section.mode = "sample"
+                section.sample_percent = _budget.sample_percent
+                _note(f"`{name}` timed out on the full table and was re-run on a {section.sample_percent}% sample.")
+                release_failures(render=False)
+                try:
+                    return func(*args, **kwargs)
+                except RunCancelled:
+                    _note(f"`{name}` was stopped because the run was cancelled.")
+                    return None
+                except Exception as exc:
+                    if not is_timeout(exc):
+                        raise
+                    _note(f"`{name}` was skipped because it timed out, including on a sample.")
+                    return None
+            finally:
+                release_failures()
+                _section = None
+        finally:
+            _budget.completed += 1
+            # notes which no Result took, e.g. for a skipped helper
+            flush_notes(name)
+
+    return wrapper
+
+
+if "NOTEBOOK_TIME_BUDGET" in os.environ:
+    set_run_budget(RunBudget(float(os.environ["NOTEBOOK_TIME_BUDGET"]),
+                             sections=int(os.environ.get("NOTEBOOK_TIME_BUDGET_SECTIONS", 1))))
+
+
+
+if __name__ == "__main__":
+    # A quick test of the budget with helpers that take a while, or time out
+    class FakeTimeout(Exception):
+        pass
+
+    calls = []
+
+    @budgeted
+    def helper(seconds=0, times_out=False):
+        section = current_section()
+        calls.append(section.mode)
+        if times_out and section.mode == "full":
+            raise FakeTimeout("HYT00", "Query timeout expired")
+        time.sleep(seconds)
+        return section.mode
+
+    set_run_budget(RunBudget(3, sections=3, sample_below=0.5, skip_below=0.2))
+    assert helper(times_out=True) == "sample"
+    assert calls == ["full", "sample"]
+    assert helper(seconds=2.9) == "full"
+    # under 0.2s left for the last section
+    assert helper() is None
+    assert len(get_run_budget().notes) == 2
+
+    set_query_timeout(30)
+    assert query_timeout() == 30
+    cancel()
+    assert helper() is None
+    # a new run isn't cancelled
+    set_run_budget(RunBudget(600, sections=1))
+    assert helper() == "full"
+
+    # notes are kept in the helpers' results
+    from results import reported, session_results
+
+    @budgeted
+    @reported
+    def reported_helper():
+        calls.append(current_section().mode)
+
+    set_run_budget(RunBudget(3, sections=2, sample_below=5, skip_below=0.2))
+    reported_helper(render=False)
+    cancel()
+    reported_helper()
+    reset()
+    sampled, skipped = session_results()[-2:]
+    assert "was run on a 10% sample" in sampled.blocks[0]["text"]
+    assert "was skipped because the run was cancelled" in skipped.blocks[0]["text"]
+
+    # a helper which times out and is re-run on a sample only shows the re-run's output
+    import results
+    from results import display, Markdown
+    rendered = []
+    results.Result.render = lambda self: rendered.append(self) or self
+
+    @budgeted
+    @reported
+    def timing_out_helper():
+        display(Markdown(f"on {current_section().mode}"))
+        if current_section().mode == "full":
+            raise FakeTimeout("HYT00", "Query timeout expired")
+
+    set_run_budget(RunBudget(600, sections=1))
+    timing_out_helper()
+    assert len(rendered) == 1 and rendered[0].blocks[-1]["text"] == "on sample"
+    assert "re-run on a 10% sample" in rendered[0].blocks[0]["text"]
+    print("OK")
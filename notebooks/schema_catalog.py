@@ -0,0 +1,112 @@
+import pandas as pd
+import os
+import hashlib
+import json
+import time
+
+from utilities2 import closing_connection
+
+
+# catalogs loaded in this session, keyed by connection string
+_catalogs = {}
+
+
+class SchemaCatalog:
+    ''' The OpenSAFELYSchemaInformation table, loaded once per session and cached on disk.
+
+    The disk cache is trusted for `ttl` seconds. After that a cheap fingerprint query (row count and
+    checksum of the schema table) is run, and the table is only re-read if the fingerprint has changed.
+
+    Inputs:
+    dbconn (str): database connection details
+    ttl (int): seconds to trust the disk cache without checking for changes
+    cache_dir (str): directory for the disk cache (default $SCHEMA_CACHE_DIR, or ~/.cache/opensafely_schema)
+
+    The cache is the table as parquet and its fingerprint as json, rather than a pickle, so that a file
+    left in the cache directory can't run code when it is loaded.
+    '''
+    fingerprint_sql = """select count(*) as row_count, checksum_agg(binary_checksum(*)) as checksum
+                         from OpenSAFELYSchemaInformation"""
+
+    def __init__(self, dbconn, ttl=24*60*60, cache_dir=None):
+        self.dbconn = dbconn
+        self.ttl = ttl
+        self.cache_dir = cache_dir or os.environ.get(
+            "SCHEMA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "opensafely_schema")
+        )
+        # name the cache files by a hash of the connection string, so credentials aren't written to disk
+        key = hashlib.sha256(dbconn.encode("utf8")).hexdigest()[:16]
+        self.cache_path = os.path.join(self.cache_dir, f"opensafely_schema_{key}.parquet")
+        self.info_path = os.path.join(self.cache_dir, f"opensafely_schema_{key}.json")
+        self.schema = None
+
+    def fingerprint(self):
+        with closing_connection(self.dbconn) as cnxn:
+            return pd.read_sql(self.fingerprint_sql, cnxn).iloc[0].tolist()
+
+    def load(self):
+        ''' Load the schema table from the disk cache if it is fresh or unchanged, otherwise from the database '''
+        fingerprint = None
+        if os.path.exists(self.info_path) and os.path.exists(self.cache_path):
+            with open(self.info_path) as f:
+                cached = json.load(f)
+            if time.time() - cached["loaded_at"] < self.ttl:
+                self.schema = pd.read_parquet(self.cache_path)
+                return self.schema
+            fingerprint = self.fingerprint()
+            if fingerprint == cached["fingerprint"]:
+                self.schema = pd.read_parquet(self.cache_path)
+                self._save(fingerprint, schema=False)
+                return self.schema
+        return self.reload(fingerprint)
+
+    def reload(self, fingerprint=None):
+        ''' Read the schema table from the database and update the disk cache. `fingerprint` is the
+        table's fingerprint, if it has just been checked.
+        '''
+        if fingerprint is None:
+            fingerprint = self.fingerprint()
+        with closing_connection(self.dbconn) as cnxn:
+            self.schema = pd.read_sql("""select * from OpenSAFELYSchemaInformation""", cnxn)
+        self._save(fingerprint)
+        return self.schema
+
+    def _save(self, fingerprint, schema=True):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            if schema:
+                self.schema.to_parquet(self.cache_path)
+            with open(self.info_path, "w") as f:
+                # (numpy scalars in the fingerprint as plain numbers)
+                json.dump({"loaded_at": time.time(), "fingerprint": fingerprint}, f,
+                          default=lambda o: o.item() if hasattr(o, "item") else str(o))
+        except OSError:
+            # the cache is only an optimisation
+            pass
+
+    def table(self):
+        ''' The whole schema table '''
+        if self.schema is None:
+            self.load()
+        return self.schema
+
+    def columns(self, table, supplementary_table_separator=None,
+                fields=("TableName", "ColumnName", "ColumnType", "MaxLength", "IsNullable")):
+        ''' Schema rows for `table`, and for its supplementary tables (e.g. `table_der`) if a separator is given '''
+        schema = self.table()
+        match = schema["TableName"] == table
+        if supplementary_table_separator:
+            match |= schema["TableName"].str.startswith(f"{table}{supplementary_table_separator}")
+        return schema.loc[match, list(fields)].reset_index(drop=True)
+
+    def column_types(self, table):
+        ''' Dict of {column name: column type} for `table` '''
+        out = self.columns(table)
+        return dict(zip(out["ColumnName"], out["ColumnType"]))
+
+
+def get_schema_catalog(dbconn, **kwargs):
+    ''' Return the session's SchemaCatalog for this connection, creating it if needed '''
+    if dbconn not in _catalogs:
+        _catalogs[dbconn] = SchemaCatalog(dbconn, **kwargs)
+    return _catalogs[dbconn]
@@ -1,14 +1,25 @@
 import pandas as pd
 import numpy as np
 import os
+import re
+from collections import Counter
+from itertools import chain, product
 from datetime import date, datetime
-from IPython.display import display, Markdown
 
 import sys
 sys.path.append('../lib/')
-from utilities2 import closing_connection, simple_sql, suppress_and_round, round_and_suppress, add_percentage_column
-
-
+from utilities2 import closing_connection, simple_sql, suppressed_sql, suppress_and_round, round_and_suppress, add_percentage_column
+from results import display, Markdown, reported, record_value, record_suppressed
+from schema_catalog import get_schema_catalog
+from profiling import instrument
+from query_guard import guarded_read_sql, guarded_read_batch, raise_errors
+from query_builder import column_counts, sample_column_counts, group_count, where_clause, source, describe_where, quote_identifier, problem_dates_query, token_counts_query, frequency_counts
+from run_budget import budgeted
+
+
+@instrument
+@budgeted
+@reported
 def get_schema(dbconn, table, where, supplementary_table_separator=None, export=False):
     '''Import schema (filtered on 'where') and calculate counts of distinct values and nulls for each column.
     Includes all supplementary tables if specified (additional tables related to the given table with specified separator e.g. `table_der`)
@@ -22,15 +33,8 @@ def get_schema(dbconn, table, where, supplementary_table_separator=None, export=
     export (bool): save to csv
     '''
     
-    # extract schema for specified table from schema table
-    with closing_connection(dbconn) as cnxn:
-        table_schema = pd.read_sql("""select * from OpenSAFELYSchemaInformation""", cnxn)
-        if supplementary_table_separator:
-            schema = pd.read_sql(f"select TableName, ColumnName, ColumnType, MaxLength, IsNullable \
-                                  from OpenSAFELYSchemaInformation where TableName = '{table}' OR TableName LIKE '{table}{supplementary_table_separator}%'", cnxn)
-        else:
-            schema = pd.read_sql(f"select TableName, ColumnName, ColumnType, MaxLength, IsNullable \
-                                  from OpenSAFELYSchemaInformation where TableName = '{table}'", cnxn)
+    # extract schema for specified table from the (cached) schema table
+    schema = get_schema_catalog(dbconn).columns(table, supplementary_table_separator)
    
     # identify tables
     tables = schema["TableName"].unique()
@@ -45,31 +49,17 @@ def get_schema(dbconn, table, where, supplementary_table_separator=None, export=
     # extract counts of distinct values and nulls for each column and for each 'where' clause
     with closing_connection(dbconn) as cnxn:
         for t in tables:
-            for c in schema.loc[schema["TableName"]==t]["ColumnName"]:
-                
-                for w in where:
-                    try: # where looking at supplementary tables, where clause may not work
-                        counts = pd.read_sql(f"""select '{t}' as TableName, count(distinct {c}) as Distinct_Values{w},
-                                            sum(case when {c} is NULL THEN 1 ELSE 0 END) AS Missing_Values{w},
-                                            count(*) as total_rows
-                                            from {t}
-                                            {where[w]}
-                                            """,
-                                        cnxn)
-                    except: ## if where clause fails, select top 10000 rows as a sample
-                        counts = pd.read_sql(f"""with a as (select top 10000 {c}, 
-                                                case when {c} is NULL THEN 1 ELSE 0 END AS Missing_Values{w},
-                                                count(*) as total_rows
-                                                from {t})
-                                            select '{t}' as TableName,
-                                                count(distinct {c}) as Distinct_Values{w},
-                                                sum(Missing_Values{w}) AS Missing_Values{w}
-                                                from a
-                                            """, 
-                                         cnxn)                                            
-
-                    counts = counts.rename(index={0:c})                    
-                    value_counts[t][w] = value_counts[t][w].append(counts)
+            # the counts for every column and 'where' clause of the table, in one batch of queries
+            columns = list(schema.loc[schema["TableName"]==t]["ColumnName"])
+            batch = guarded_read_batch([column_counts(t, c, suffix=w, where=where[w]) for c in columns for w in where], cnxn, table=t)
+            for (c, w), counts in zip(product(columns, where), batch):
+                if isinstance(counts, Exception): # where looking at supplementary tables, where clause may not work
+                    ## if where clause fails (or the query guard refuses it), select top 10000 rows as a sample
+                    query = sample_column_counts(t, c, suffix=w)
+                    counts = guarded_read_sql(query.sql, cnxn, params=query.params)
+
+                counts = counts.rename(index={0:c})                    
+                value_counts[t][w] = value_counts[t][w].append(counts)
 
             # compile into one output table per table containing schema + counts
             out = schema.copy().loc[schema["TableName"]==t] 
@@ -78,7 +68,8 @@ def get_schema(dbconn, table, where, supplementary_table_separator=None, export=
                 out_counts = value_counts[t][w].reset_index().rename(columns={"index":"ColumnName"})
                 # Round total_rows to nearest 5
                 total_rows = int(5 * round(out_counts["total_rows"][0] / 5))
-                display(Markdown(f"Total rows in {t} {where[w]}: {int(total_rows)}"))
+                record_value(f"total_rows_{t}{w}", total_rows)
+                display(Markdown(f"Total rows in {t} {describe_where(where[w])}: {int(total_rows)}"))
                 out_counts = out_counts.drop(columns=["total_rows"])
                 round_and_suppress(out_counts, f"Missing_Values{w}")
                 add_percentage_column(out_counts, f"Missing_Values_Percentage{w}", f"Missing_Values{w}", total_rows)
@@ -98,52 +89,68 @@ def get_schema(dbconn, table, where, supplementary_table_separator=None, export=
                 out.to_csv(f"schema_{t}{where_string}.csv", index=False)
 
     
+@instrument
+@budgeted
+@reported
 def counts_of_distinct_values(dbconn, table, columns, threshold=1, where=None, include_counts=True, 
-                              sort_values=False, frequency_count=False):
+                              sort_values=False, frequency_count=False, pushdown=False):
     ''' Return distinct values of a column. 
     Also (optionally) return how many times each value appears, unless there are more distinct values than threshold given, then return no. of values, max and min. 
     Optionally filter using a where clause.
     Row counts are rounded to nearest 5 and any values which appear <=7 times not shown.
+    If pushdown is True, the rounding and suppression are done in the database, so only the values shown are fetched.
     '''
         
     for col in columns:
         display(Markdown(f"### Summary of values in '{col}'"))
         if where:
-            display(Markdown(f" **filtered on {where}**"))
-        
+            display(Markdown(f" **filtered on {describe_where(where)}**"))
+
         # Extract data
-        out = simple_sql(dbconn, table, col, where)
+        if pushdown:
+            # already suppressed and rounded, with counts of what was left out in the summary
+            out, summary = suppressed_sql(dbconn, table, col, where)
+        else:
+            out = simple_sql(dbconn, table, col, where)
             
         
-        # convert datetimes to dates
+        # convert datetimes to dates (as datetime64 at midnight, rather than date objects)
         try:
-            out[col] = out[col].dt.date
+            out[col] = out[col].dt.normalize()
         except:
             pass
         
         # count nulls
-        try:
-            missing = out.copy().loc[pd.isnull(out[col])]["row_count"].reset_index(drop=True)[0]
-        except:
-            missing = 0
         missing_rounded = ""
-        if missing >7: # round to nearest 5
-            missing = int(5*(missing/5).round(0)) 
-            missing_rounded = " (to the nearest 5)"
-        elif missing >0 and missing <=7:
-            missing = "1-7"
+        if pushdown:
+            # already suppressed or rounded in the database
+            missing = "1-7" if summary["missing_suppressed"] else int(summary["missing_rows"])
+            if missing != "1-7" and missing > 7:
+                missing_rounded = " (to the nearest 5)"
+        else:
+            try:
+                missing = out.copy().loc[pd.isnull(out[col])]["row_count"].reset_index(drop=True)[0]
+            except:
+                missing = 0
+            if missing >7: # round to nearest 5
+                missing = int(5*(missing/5).round(0)) 
+                missing_rounded = " (to the nearest 5)"
+            elif missing >0 and missing <=7:
+                missing = "1-7"
         
             
         # now exclude nulls
         no_nulls = out.loc[~pd.isnull(out[col])]
-        if len(no_nulls)==0:
+        value_count = int(summary["distinct_values"]) if pushdown else len(no_nulls[col])
+        if value_count==0:
             display(Markdown("There were no non-null values."))
             continue
-        else:
-            value_count = len(no_nulls[col])
             
         # suppress and round
         no_nulls, suppressed = suppress_and_round(no_nulls) 
+        n_suppressed = int(summary["suppressed_values"]) if pushdown else suppressed.shape[0]
+        record_value(f"{col}_distinct_values", value_count)
+        record_suppressed(col, n_suppressed)
         
            
         
@@ -155,12 +162,18 @@ def counts_of_distinct_values(dbconn, table, columns, threshold=1, where=None, i
             # If all counts are <=7 and therefore suppressed:
             if (len(no_nulls) == 0) or (frequency_count==True):
                 # find frequency of each count
-                counts = out.groupby('row_count').count()
-                counts = (5*((counts/5).round(0))).astype(int)
-                counts = counts.reset_index()
-                counts = counts.rename(columns={col:"Frequency (to nearest 5)", "row_count":f"No.of rows per {col}"})
-                # suppress unusual counts
-                counts = counts.loc[counts["Frequency (to nearest 5)"]>5]
+                if pushdown:
+                    query = frequency_counts(table, [col], where)
+                    with closing_connection(dbconn) as cnxn:
+                        counts = guarded_read_sql(query.sql, cnxn, table=table, params=query.params)
+                    counts = counts.rename(columns={"frequency":"Frequency (to nearest 5)", "row_count":f"No.of rows per {col}"})
+                else:
+                    counts = out.groupby('row_count').count()
+                    counts = (5*((counts/5).round(0))).astype(int)
+                    counts = counts.reset_index()
+                    counts = counts.rename(columns={col:"Frequency (to nearest 5)", "row_count":f"No.of rows per {col}"})
+                    # suppress unusual counts
+                    counts = counts.loc[counts["Frequency (to nearest 5)"]>5]
                 display(counts, Markdown("Note: counts with frequencies <=7 are not shown"))    
                 
             else:
@@ -176,12 +189,12 @@ def counts_of_distinct_values(dbconn, table, columns, threshold=1, where=None, i
                 # export table to csv
                 where_string = ""
                 if where:
-                    where_string = where.replace(" ", "_")
+                    where_string = describe_where(where).replace(" ", "_")
                 no_nulls.to_csv(f"distinct_values_{table}_{col}_{where_string}.csv", index=False)
 
                 # also list how many values were suppressed (if any)
-                if suppressed.shape[0] > 0:
-                    display(Markdown(f"There were {suppressed.shape[0]} value(s) with <=7 occurrences (each), not shown above."))
+                if n_suppressed > 0:
+                    display(Markdown(f"There were {n_suppressed} value(s) with <=7 occurrences (each), not shown above."))
         
         
         else: # if lots of values, display a sensible summary of the range and the most common value
@@ -191,15 +204,22 @@ def counts_of_distinct_values(dbconn, table, columns, threshold=1, where=None, i
                 minv, maxv = no_nulls[col].min(), no_nulls[col].max()
             except: # if that fails, convert to strings
                 minv, maxv = no_nulls[col].astype(str).min(), no_nulls[col].astype(str).max()   
+            if isinstance(minv, pd.Timestamp):
+                minv, maxv = minv.date(), maxv.date()
             
             display(Markdown(f"There were **{value_count}** different values, between '{minv}' and '{maxv}' (after removing uncommon values)"),
                    Markdown(f"and **{missing}** missing values{missing_rounded}."))
             # find most common value (excluding nulls)
             max_count = no_nulls['row_count'].max()
             most_common = no_nulls.loc[no_nulls["row_count"]==max_count][col].reset_index(drop=True)[0] # return one value, even if 2 or more are tied
+            if isinstance(most_common, pd.Timestamp):
+                most_common = most_common.date()
             display(Markdown(f"The most common value was '{most_common}' with **{max_count}** occurrences (rounded to the nearest 5)"))
     
 
+@instrument
+@budgeted
+@reported
 def compare_two_values(dbconn, tables, columns, join_on=None, threshold=1, where=None, include_counts=True):
     ''' Compare two columns (e.g ints, dates) based on their values
     Optionally filter using a where clause. 
@@ -210,7 +230,7 @@ def compare_two_values(dbconn, tables, columns, join_on=None, threshold=1, where
     tables (list): table name(s) to query
     columns (list): name of 2 columns
     join_on (str): name of column to join tables if multiple tables are supplied 
-    where (str): where clause e.g. "field_x in('value_1', 'value_2')"
+    where (str or list): where clause e.g. "field_x in('value_1', 'value_2')", or list of filters e.g. [("field_x", "in", ["value_1", "value_2"])]
     include_counts (bool): return list of fields without counts if False
     
     Returns: For field_1, field_2 in 'columns', counts how many rows in which each of the following are true: field_1 < field_2,  field_1 == field_2, field_1 > field_2.
@@ -220,28 +240,26 @@ def compare_two_values(dbconn, tables, columns, join_on=None, threshold=1, where
         print("Reduce number of tables/columns to 2 each")
         return
     
-    columns_str = ",".join(columns)
-    table_str = ",".join(tables)
-    
     display(Markdown(f"### Comparison of column values"))
-    
-    where_clause = ""
+
     if where:
-        where_clause = f"where {where}"
-        display(Markdown(f" **filtered on {where}**"))
-        
+        display(Markdown(f" **filtered on {describe_where(where)}**"))
+
     with closing_connection(dbconn) as cnxn:
         # extract all combinations of dates with counts of their occurrences
         if len(tables)==1:
-            out = pd.read_sql(f"select {columns_str}, count(*) as row_count from {table_str} {where_clause} group by {columns_str}", cnxn)
+            query = group_count(tables[0], columns, where)
+            out = guarded_read_sql(query.sql, cnxn, table=tables[0], params=query.params)
         elif len(tables)==2:
             if join_on == None:
                 display("Must supply 'join_on' field for multiple tables")
                 return
-            out = pd.read_sql(f"""select t1.{columns[0]} as {columns[0]}, t2.{columns[1]} as {columns[1]}, count(*) as row_count 
-                          from {tables[0]} t1 LEFT JOIN {tables[1]} t2 ON t1.{join_on} = t2.{join_on}
-                          {where_clause} group by {columns_str}
-                          """, cnxn)
+            a, b, key = (quote_identifier(c) for c in columns + [join_on])
+            params = []
+            out = guarded_read_sql(f"""select t1.{a} as {a}, t2.{b} as {b}, count(*) as row_count
+                          from {quote_identifier(tables[0])} t1 LEFT JOIN {quote_identifier(tables[1])} t2 ON t1.{key} = t2.{key}
+                          {where_clause(where, params)} group by t1.{a}, t2.{b}
+                          """, cnxn, table=tables[0], params=params)
         else:
             display("Too many tables")
             return
@@ -305,6 +323,7 @@ def compare_two_values(dbconn, tables, columns, join_on=None, threshold=1, where
     
     # suppress and round row counts
     compared[["row_count"]], suppressed = suppress_and_round(compared[["row_count"]])
+    record_suppressed("comparison", suppressed.shape[0])
     compared["row_count"] = compared["row_count"].fillna(0).astype(int)
     
     # calculate percentages
@@ -314,6 +333,9 @@ def compare_two_values(dbconn, tables, columns, join_on=None, threshold=1, where
     display(compared_q1q3)
 
     
+@instrument
+@budgeted
+@reported
 def multiple_records(dbconn, table, columns, combinations, where, key_field="patient_id"):
     '''
     For items (e.g. patient_id) appearing multiple times in the data, count how many have multiple different values for each of the given columns or none of the given columns,
@@ -324,7 +346,7 @@ def multiple_records(dbconn, table, columns, combinations, where, key_field="pat
     table (str): table name to query
     columns (list): list of fields (strings) in which to count multiple different values appearing for the same key_field value
     combinations (dict): dict of lists where each list has two strings which are looked at together e.g. to identify where a patient has a different value for both of each field.
-    where (str): where clause e.g. "field_x in('value_1', 'value_2')
+    where (str or list): where clause e.g. "field_x in('value_1', 'value_2'), or list of filters (see query_builder)
     key_field (str): field to count multiple records (e.g. "patient_id")"
     '''
     
@@ -332,46 +354,46 @@ def multiple_records(dbconn, table, columns, combinations, where, key_field="pat
     counts = {}
     sums = {}
     for n, c in enumerate(columns):
-        counts[n] = f"count(distinct {c}) as {c}"
-        sums[n] = f"sum(case when {c}>1 then 1 else 0 end) as {c}"
+        counts[n] = f"count(distinct {quote_identifier(c)}) as {quote_identifier(c)}"
+        sums[n] = f"sum(case when {quote_identifier(c)}>1 then 1 else 0 end) as {quote_identifier(c)}"
 
     text_1 = ", ".join(counts.values())
     text_2 = ", ".join(sums.values())
-    text_3 = "<2 AND ".join(columns)
+    text_3 = "<2 AND ".join(quote_identifier(c) for c in columns)
 
     combos = {}
     for n, c in enumerate(combinations):
-        text = ">1 AND ".join(combinations[c])
+        text = ">1 AND ".join(quote_identifier(f) for f in combinations[c])
         name = "_AND_".join(combinations[c])
-        text = text + ">1 then 1 else 0 end) AS " + name
+        text = text + ">1 then 1 else 0 end) AS " + quote_identifier(name)
         combos[n] = text
 
     text_4 =  ", SUM(CASE WHEN ".join(combos.values())
 
-    where_clause = ""
-    if where:
-        where_clause = f"where {where}"
-    
-
+    key = quote_identifier(key_field)
+    params = []
+    # a session's subset only supplies the patients with multiple records (a); their values are counted over all
+    # of their records in the table (b)
+    table_sql, where_sql = source(table, where, params, [key_field])
     sql = f'''with a as (
-        select 
-        {key_field} 
-        from {table}
-        {where_clause}
+        select
+        {key}
+        from {table_sql}
+        {where_sql}
         group by 
-        {key_field} 
+        {key} 
         having count(*)>1),
 
     b as (
-        select {key_field} ,
+        select {key} ,
         {text_1}
-         from {table}
-        where {key_field} in (Select {key_field} from a)
-        group by {key_field} 
+         from {quote_identifier(table)}
+        where {key} in (Select {key} from a)
+        group by {key} 
         )
 
     select
-        count(*) as {key_field}s_with_multiple_records,
+        count(*) as {quote_identifier(f"{key_field}s_with_multiple_records")},
         {text_2},
         sum(case when {text_3} <2 then 1 else 0 end) as none_of_these,
         sum(case when {text_4}
@@ -380,56 +402,113 @@ def multiple_records(dbconn, table, columns, combinations, where, key_field="pat
 
 
     with closing_connection(dbconn) as cnxn:
-        out = pd.read_sql(sql, cnxn)
-    
+        out = guarded_read_sql(sql, cnxn, table=table, params=params)
+
     df, suppressed = suppress_and_round(df=out.transpose(), field=0)
+    record_suppressed(f"{key_field}s_with_multiple_records", suppressed.shape[0])
     display(Markdown("## Patients appearing multiple times, and the fields in which they have different values in each appearance"))
     if where:
-        display(Markdown(f" **filtered on {where}**"))
+        display(Markdown(f" **filtered on {describe_where(where)}**"))
     display(df.rename(columns={0:"Patient count"}).sort_values(by="Patient count", ascending=False))
     display(Markdown("#### Fields with counts <=7:"),
                      Markdown(", ".join(suppressed.index)))
     
     
-def identify_distinct_strings(dbconn, table, columns, where=None, replacement="", split_string='', merge_all=True):
+class TokenCounter:
+    ''' Distinct tokens in a set of strings, with the number of rows each appears in, updated a batch at a time.
+
+    Inputs:
+    replacement (str): substring to remove from each string before splitting
+    split_string (str): substring to split each string on (e.g " and " or ", "), or "" not to split
+    '''
+    def __init__(self, replacement="", split_string=""):
+        self.replacement = replacement
+        self.split_string = split_string
+        self.counts = Counter()
+
+    def update(self, values, counts=None):
+        ''' Add a batch of strings (with the number of rows each represents, or 1 each) '''
+        values = pd.Series(values).reset_index(drop=True)
+        counts = np.ones(len(values)) if counts is None else np.asarray(counts, dtype=float)
+        present = values.notna().to_numpy()
+        # remove the replacement and split each string in one step, then count the tokens by hashing
+        # them to integer codes, weighting each by the rows its string represents
+        strings = (str(v).replace(self.replacement, "") for v in values[present].tolist())
+        split = [v.split(self.split_string) if self.split_string else [v] for v in strings]
+        lengths = np.fromiter(map(len, split), dtype=np.int64, count=len(split))
+        tokens = np.array(list(chain.from_iterable(split)), dtype=object)
+        codes, distinct = pd.factorize(tokens)
+        totals = np.bincount(codes, weights=np.repeat(counts[present], lengths), minlength=len(distinct))
+        self.counts.update(dict(zip(distinct, totals)))
+        return self
+
+    def result(self):
+        ''' Distinct tokens in order, with their row counts '''
+        out = pd.DataFrame(sorted(self.counts.items()), columns=["token", "row_count"])
+        out["row_count"] = out["row_count"].astype(int)
+        return out
+
+
+@instrument
+@budgeted
+@reported
+def identify_distinct_strings(dbconn, table, columns, where=None, replacement="", split_string='', merge_all=True, chunksize=None, pushdown=False):
     '''
-    List all the different string values in a specified column or columns. 
+    List all the different string values in a specified column or columns, with how many rows each appears in.
     Allows splitting up of multiple values within cells e.g. comma-separated
     Can also optionally combine all values across each of the columns supplied.
-    
+    Row counts are rounded to nearest 5 and counts 1-7 shown as "1-7".
+
     Inputs:
     dbconn (str): database connection details
     table (str): table name to query
-    columns (list): list of fields in table (strings) 
+    columns (list): list of fields in table (strings)
+    where (str or list): where clause, or list of filters (see query_builder)
     replacement (str): substring to remove if present in any of the columns specified
-    split_string (str): string to use to split strings (e.g " and " or ", ") 
+    split_string (str): string to use to split strings (e.g " and " or ", ")
     merge_all (bool): if True, combine distinct strings from all supplied columns, otherwise keep separate
+    chunksize (int): if given, stream each column's distinct values from the cursor this many rows at a time
+    pushdown (bool): split the strings and count the tokens in the database (STRING_SPLIT), and only fetch the distinct tokens
     '''
-    cols = ','.join(columns)
-    out = simple_sql(dbconn, table, cols, where=where)
-    
-    results3 = pd.Series(dtype=str)
-    for c in columns:
-        results = out[[c]].loc[pd.notnull(out[c])]
-
-        results = results[c].str.replace(replacement,"")
-        results = results.str.split(split_string, expand=True).drop_duplicates()
-        results2 = pd.Series(dtype=str)
-        for col in results.columns:
-            results2 = results2.append(results[col].drop_duplicates())
-        if merge_all == False:
-            # display results for each column seperately
-            display(results2.drop_duplicates().sort_values())
-
+    merged = TokenCounter(replacement, split_string)
+    with closing_connection(dbconn) as cnxn:
+        if pushdown:
+            queries = [token_counts_query(table, c, replacement, split_string, where) for c in columns]
         else:
-            results3 = results3.append(results2, ignore_index=True).drop_duplicates()
+            queries = [group_count(table, [c], where) for c in columns]
+        if pushdown or chunksize is None:
+            # every column's counts in one batch of queries
+            batch = raise_errors(guarded_read_batch(queries, cnxn, table=table))
+        for i, (c, query) in enumerate(zip(columns, queries)):
+            counter = TokenCounter(replacement, split_string)
+            if pushdown:
+                out = batch[i]
+                counter.counts.update(dict(zip(out["token"], out["row_count"])))
+            else:
+                if chunksize is None:
+                    out = batch[i]
+                else:
+                    out = guarded_read_sql(query.sql, cnxn, table=table, params=query.params, chunksize=chunksize)
+                for chunk in ([out] if chunksize is None else out):
+                    counter.update(chunk[c], chunk["row_count"])
 
-    if merge_all == True:    
-        display(results3.sort_values().reset_index(drop=True))
-        
+            if merge_all == False:
+                # display results for each column seperately
+                results = counter.result()
+                round_and_suppress(results, "row_count")
+                display(results.drop(columns=["row_count"]).rename(columns={"token": c, "n": "row_count"}))
+            else:
+                merged.counts.update(counter.counts)
+
+    if merge_all == True:
+        results = merged.result()
+        round_and_suppress(results, "row_count")
+        display(results.drop(columns=["row_count"]).rename(columns={"n": "row_count"}))
 
-    
 
+@instrument
+@budgeted
+@reported
 def count_substrings(dbconn, table, columns, where=None, substrings=[], merge_all=True):
     '''
     Count the number of occurrences of substring within specified columns. 
@@ -467,69 +546,125 @@ def count_substrings(dbconn, table, columns, where=None, substrings=[], merge_al
      
     
     
-def problem_dates(dbconn, table, columns, where=None, valid_years=['202','21','22'], return_summary_only=False):
+def date_problem_pattern(valid_years=['202','21','22']):
+    ''' Compiled pattern which classifies a date-like string in one match: the name of the group
+    which matches is the problem (in order of precedence), or there is no match if it looks like a date.
+
+    The rules, which apply in this order:
+    - comprises only a one or two-digit number: "entirely numeric"
+    - no numeric characters: "largely or entirely non-numeric"
+    - starts or ends with something other than a number: "starts/ends non-numeric"
+    - doesn't contain a year: "no valid year"
+    (one or two numeric characters surrounded by non-numeric characters would be "limited numeric
+    characters", but any such value already starts or ends with something other than a number)
+    '''
+    years = "|".join(valid_years)
+    return re.compile(
+        r"(?P<entirely_numeric>\d\d?)"
+        r"|(?P<largely_or_entirely_non_numeric>\D*)"
+        r"|(?P<starts_ends_non_numeric>\D.*|.*\D)"
+        rf"|(?P<no_valid_year>(?!.*(?:{years})).*)",
+        re.DOTALL,
+    )
+
+
+problem_names = {
+    "entirely_numeric": "entirely numeric",
+    "largely_or_entirely_non_numeric": "largely or entirely non-numeric",
+    "starts_ends_non_numeric": "starts/ends non-numeric",
+    "no_valid_year": "no valid year",
+}
+
+
+def classify_dates(values, valid_years=['202','21','22']):
+    ''' Problem with each of `values` (date-like strings) as problem_dates describes it, or None if it looks like a date '''
+    fullmatch = date_problem_pattern(valid_years).fullmatch
+    return [problem_names[m.lastgroup] if m else None for m in map(fullmatch, values)]
+
+
+@instrument
+@budgeted
+@reported
+def problem_dates(dbconn, table, columns, where=None, valid_years=['202','21','22'], return_summary_only=False, pushdown=False):
     '''
     Takes list of columns in df_in which are date-like strings and indentifies values not resembling dates (e.g. ints, non-numeric strings).
-    
+
     Inputs:
     dbconn (str): database connection details
     table (str): table name to query
-    columns (list): list of fields (strings) 
+    columns (list): list of fields (strings)
+    where (str or list): where clause, or list of filters (see query_builder)
     valid_years (list): list of 2-4-digit years/part-year strings expected in the results e.g. ['21','22','202']
+    pushdown (bool): classify the values in the database and only fetch the problem values, rather than fetching all distinct values
     '''
-    # convert lists to strings
-    cols = ','.join(columns)
-    valid_years = '|'.join(valid_years)  
-
-    # extract data
-    df_in = simple_sql(dbconn, table, cols, where=None)
-    
-    # set up a df for results
-    results = pd.DataFrame(columns=["value", "problem", "row_count"])
-    
-    for n, col in enumerate(columns):
-        df = df_in[[col, "row_count"]].copy().fillna("2022-01-01").groupby(col).sum().reset_index()
-        df = df.rename(columns={col:"value", "row_count":f"row_count_{str(n)}"})
-        
-        # contains one or two numeric characters either in isolation or surrounded by non-numeric characters
-        df.loc[df["value"].str.contains('^\D*\d?\d?\D*$', regex=True) , "problem"] = "limited numeric characters"      
-        
-        # doesn't contain a year
-        df.loc[~df["value"].str.contains(valid_years, regex=True), "problem"] = "no valid year"
-
-        # starts or ends with something other than a number
-        df.loc[df["value"].str.contains('^[^\d]|[^\d]$', regex=True), "problem"] = "starts/ends non-numeric" 
-       
-        # entirely non-numeric
-        df.loc[~df["value"].str.contains('\d', regex=True), "problem"] = "largely or entirely non-numeric"
-        
-        # starts AND ends with something other than a number
-        df.loc[df["value"].str.contains('^[^\d]*[^\d]$', regex=True), "problem"] = "largely or entirely non-numeric" 
+    if pushdown:
+        query = problem_dates_query(table, columns, valid_years=valid_years, where=where)
+        with closing_connection(dbconn) as cnxn:
+            results = guarded_read_sql(query.sql, cnxn, table=table, params=query.params)
+    else:
+        # distinct values of each column with their counts, summed over the columns
+        results = pd.concat([
+            simple_sql(dbconn, table, col, where=where).rename(columns={col: "value"}).fillna({"value": "2022-01-01"})
+            for col in columns
+        ])
+        results = results.groupby("value", as_index=False)["row_count"].sum()
+        results["problem"] = classify_dates(results["value"].astype(str), valid_years)
+        results = results.loc[results["problem"].notna()]
 
-        # comprises only a one or two-digit number
-        df.loc[df["value"].str.contains('^\d\d?$', regex=True), "problem"] = "entirely numeric"
+    results = results.set_index(["problem", "value"])[["row_count"]]
 
-        temp = df.loc[~pd.isnull(df["problem"])]
-        results = results.merge(temp, on=["value", "problem"], how="outer")
-    
-    results = results.set_index(["problem", "value"])
-    results["row_count"] = results.fillna(0).astype(int).sum(axis=1)
-    
-    
     display(Markdown("### Problem dates across all date-like string fields"))
     if where:
-        display(Markdown(f" **filtered on {where}**"))
+        display(Markdown(f" **filtered on {describe_where(where)}**"))
+    record_value("problem_values", len(results))
     display(Markdown(f"In total there were **{len(results)}** different problematic date-like values"))
-    
+
     # display counts by type of problem
-    summary = results.reset_index().groupby("problem")[["row_count"]].agg({"count","sum"})
-    summary.columns = summary.columns.droplevel()
-    summary = summary[["count","sum"]].rename(columns={"count":"no_of_different_values", "sum":"row_count"})
-    summary,_ = round_and_suppress(summary, field="row_count")
-    
+    summary = results.groupby("problem")["row_count"].agg(["count","sum"])
+    summary = summary.rename(columns={"count":"no_of_different_values", "sum":"row_count"})
+    round_and_suppress(summary, field="row_count")
+    display(summary.drop(columns=["row_count"]).rename(columns={"n":"row_count"}))
+
     if return_summary_only:
         return
-    
+
     else:
-        results, _ = round_and_suppress(results[["row_count"]], field="row_count")
-        display(results.sort_index())
+        round_and_suppress(results, field="row_count")
+        display(results.drop(columns=["row_count"]).rename(columns={"n":"row_count"}).sort_index())
+
+
+
+if __name__ == "__main__":
+    # A quick check of classify_dates against the rules applied one at a time, then timing on 2M values
+    import time
+
+    rng = np.random.default_rng(0)
+    alphabet = np.array(list("0123456789-/ aJn"))
+    values = ["".join(rng.choice(alphabet, rng.integers(0, 12))) for _ in range(50_000)]
+    values += ["2022-01-01", "21/1/2021", "1", "12", "x", "", "1x", "x1", "5 5", "20201", "0000-00-00"]
+
+    df = pd.DataFrame({"value": values})
+    df.loc[df["value"].str.contains(r'^\D*\d?\d?\D*$', regex=True), "problem"] = "limited numeric characters"
+    df.loc[~df["value"].str.contains('202|21|22', regex=True), "problem"] = "no valid year"
+    df.loc[df["value"].str.contains(r'^[^\d]|[^\d]$', regex=True), "problem"] = "starts/ends non-numeric"
+    df.loc[~df["value"].str.contains(r'\d', regex=True), "problem"] = "largely or entirely non-numeric"
+    df.loc[df["value"].str.contains(r'^[^\d]*[^\d]$', regex=True), "problem"] = "largely or entirely non-numeric"
+    df.loc[df["value"].str.contains(r'^\d\d?$', regex=True), "problem"] = "entirely numeric"
+    assert classify_dates(values) == [p if isinstance(p, str) else None for p in df["problem"]]
+
+    dates = (np.datetime64("2020-01-01") + rng.integers(0, 1500, 2_000_000)).astype(str).tolist()
+    start = time.perf_counter()
+    classify_dates(dates)
+    print(f"classified {len(dates):,} values in {time.perf_counter() - start:.1f}s")
+
+    # TokenCounter gives the same distinct tokens as splitting each string in turn, streamed or not
+    risks = ["Patients with a " + " and ".join(rng.choice(["Down's syndrome", "HIV or AIDS", "solid cancer", "sickle cell disease"],
+                                                           rng.integers(1, 4), replace=False))
+             for _ in range(1000)] + [None]
+    expected = Counter(t for r in risks if r for t in r.replace("Patients with a ", "").split(" and "))
+    counter = TokenCounter("Patients with a ", " and ")
+    for i in range(0, len(risks), 300):
+        counter.update(risks[i:i + 300])
+    assert dict(counter.counts) == dict(expected)
+    assert counter.result()["token"].is_monotonic_increasing
+    print("OK")
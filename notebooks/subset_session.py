@@ -0,0 +1,161 @@
+import itertools
+
+from backend import get_backend
+from fetch import register_connection, forget_connection
+from query_builder import quote_identifier, where_clause, register_subset, forget_subset, close_statements
+from run_budget import check_cancelled, query_timeout
+
+
+# A session in which a filtered subset of a table is copied into a #temp table once, and the
+# helpers' queries on the same table with the same filter read the (much smaller) temp table,
+# rather than scanning and filtering the whole table again for every column and every helper:
+#
+#     where = "COVID_indication IN ('hospitalised_with','hospital_onset')"
+#     with SubsetSession(dbconn) as session:
+#         session.materialize("Therapeutics", where, columns=["Intervention", "Region", "COVID_indication"])
+#         counts_of_distinct_values(dbconn, "Therapeutics", ["Intervention", "Region"], where=where)
+#
+# Temp tables only exist on the connection which created them, so while a session is open the
+# helpers' connections to its dbconn (utilities2.closing_connection) are the session's own
+# connection, which is closed, dropping the temp tables, when the session closes. Queries needing a
+# column the subset left out read the full table as before. One session can be open at a time.
+
+_session = None
+
+# temp table names are unique for the life of the kernel
+_names = itertools.count(1)
+
+
+class SubsetSession:
+    ''' One connection to `dbconn`, kept open with filtered subsets of its tables in temp tables '''
+
+    def __init__(self, dbconn):
+        self.dbconn = dbconn
+        self.cnxn = None
+        # temp table name: (table, where) it holds
+        self.subsets = {}
+
+    def open(self):
+        global _session
+        if _session is not None:
+            raise RuntimeError(f"A subset session is already open for {_session.dbconn}")
+        self.cnxn = get_backend(self.dbconn).connect(self.dbconn)
+        register_connection(self.cnxn, self.dbconn)
+        _session = self
+        return self
+
+    def materialize(self, table, where, columns=None, index="patient_id"):
+        ''' Copy the rows of `table` matching `where` into a temp table, to be read by later queries on `table`
+        filtered on `where` in this session. Returns the temp table's name.
+
+        where (str or list): raw where clause, or list of filters (see query_builder), as given to the helpers
+        columns (list): the columns to copy (default all); `index` is always included
+        index (str): column to index the temp table on, or None
+        '''
+        check_cancelled()
+        if columns is not None and index and index not in columns:
+            columns = [index] + list(columns)
+        name = f"#subset_{next(_names)}"
+        params = []
+        columns_str = "*" if columns is None else ", ".join(quote_identifier(c) for c in columns)
+        self.cnxn.timeout = query_timeout()
+        cursor = self.cnxn.cursor()
+        try:
+            cursor.execute(f"select {columns_str} into {quote_identifier(name)} "
+                           f"from {quote_identifier(table)} {where_clause(where, params)}", params)
+            if index:
+                cursor.execute(f"create index {quote_identifier('ix_' + name[1:])} on {quote_identifier(name)} ({quote_identifier(index)})")
+        finally:
+            cursor.close()
+        self.subsets[name] = (table, where)
+        register_subset(table, where, name, columns)
+        return name
+
+    def close(self):
+        ''' Drop the temp tables and close the connection '''
+        global _session
+        try:
+            for table, where in self.subsets.values():
+                forget_subset(table, where)
+            close_statements(self.cnxn)
+            cursor = self.cnxn.cursor()
+            for name in self.subsets:
+                cursor.execute(f"drop table if exists {quote_identifier(name)}")
+            cursor.close()
+        finally:
+            self.subsets = {}
+            forget_connection(self.cnxn)
+            self.cnxn.close()
+            _session = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def session_connection(dbconn):
+    ''' The open session's connection, if there is a session open for `dbconn` '''
+    if _session is not None and _session.dbconn == dbconn:
+        return _session.cnxn
+    return None
+
+
+
+if __name__ == "__main__":
+    # Compare profiling a filtered subset of a local DuckDB database with and without a session
+    import os
+    import tempfile
+    import time
+
+    import pandas as pd
+
+    from backend import create_local_database
+    from sense_checking import multiple_records
+    from query_builder import group_count, suppression_summary, column_counts
+    from query_guard import guarded_read_batch, raise_errors
+    from utilities2 import closing_connection
+    # (the session as utilities2 sees it, rather than this script's copy)
+    from subset_session import SubsetSession
+
+    path = os.path.join(tempfile.mkdtemp(), "local.duckdb")
+    dbconn = create_local_database(path, rows=1_000_000)
+    where = "COVID_indication IN ('hospitalised_with','hospital_onset')"
+    columns = ["Intervention", "Region", "CurrentStatus", "FormName", "AgeAtReceivedDate", "MOL1_high_risk_cohort"]
+
+    def profile():
+        queries = [q for c in columns for q in (group_count("Therapeutics", [c], where),
+                                                suppression_summary("Therapeutics", [c], where),
+                                                column_counts("Therapeutics", c, where=where))]
+        with closing_connection(dbconn) as cnxn:
+            return raise_errors(guarded_read_batch(queries, cnxn, table="Therapeutics")), queries
+
+    def records():
+        return multiple_records(dbconn, "Therapeutics", columns[:3], {1: columns[:2]}, where=where, render=False).tables()[0]
+
+    profile()
+    expected_records = records()
+    start = time.perf_counter()
+    expected, _ = profile()
+    table_seconds = time.perf_counter() - start
+
+    with SubsetSession(dbconn) as session:
+        start = time.perf_counter()
+        name = session.materialize("Therapeutics", where, columns=columns)
+        copy_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        got, queries = profile()
+        session_seconds = time.perf_counter() - start
+        assert all(name in q.sql for q in queries)
+        # a column the subset left out is read from the full table
+        assert name not in group_count("Therapeutics", ["Diagnosis"], where).sql
+        pd.testing.assert_frame_equal(records(), expected_records)
+    assert name not in group_count("Therapeutics", columns, where).sql
+
+    for a, b in zip(expected, got):
+        pd.testing.assert_frame_equal(a.sort_values(list(a.columns)).reset_index(drop=True),
+                                      b.sort_values(list(b.columns)).reset_index(drop=True), check_dtype=False)
+    print(f"{len(queries)} queries on the filtered table: {table_seconds:.2f}s")
+    print(f"{len(queries)} queries on a temp table of the subset: {session_seconds:.2f}s, after {copy_seconds:.2f}s copying it")
+    print("OK")
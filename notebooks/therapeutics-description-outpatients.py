@@ -110,12 +110,12 @@ thresholds = [50, 50, 1]
 
 for c, i, t in zip(columns, interventions, thresholds):
     counts_of_distinct_values(dbconn, table, columns=[c], threshold=t, where="COVID_indication='non_hospitalised'")
-    counts_of_distinct_values(dbconn, table, columns=[c], threshold=t, where=f"COVID_indication='non_hospitalised' AND Intervention='{i}'")
+    counts_of_distinct_values(dbconn, table, columns=[c], threshold=t, where=[("COVID_indication", "==", "non_hospitalised"), ("Intervention", "==", i)])
 
 columns = ["MOL1_high_risk_cohort", "SOT02_risk_cohorts", "CASIM05_risk_cohort"]
 
 for c, i in zip(columns, interventions):
-    counts_of_distinct_values(dbconn, table, columns=[c], threshold=50, where=f"COVID_indication='non_hospitalised' AND Intervention='{i}'")
+    counts_of_distinct_values(dbconn, table, columns=[c], threshold=50, where=[("COVID_indication", "==", "non_hospitalised"), ("Intervention", "==", i)])
 
 # -
 
@@ -128,7 +128,7 @@ replacement = "Patients with a "
 split_string = ' and '
 merge_all = True
 
-identify_distinct_strings(dbconn, table, columns, where=f"COVID_indication='non_hospitalised'", replacement=replacement, split_string=split_string, merge_all=merge_all)
+identify_distinct_strings(dbconn, table, columns, where=f"COVID_indication='non_hospitalised'", replacement=replacement, split_string=split_string, merge_all=merge_all, pushdown=True)
 
 # -
 
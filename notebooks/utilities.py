@@ -1,6 +1,11 @@
 import numpy as np
 import pandas as pd
 
+import sys
+sys.path.append('../lib/')
+from profiling import instrument
+
+@instrument
 def redact_small_numbers(df, n, rate_column):
     """Takes counts df as input and suppresses low numbers.  Sequentially redacts
     low numbers from numerator and denominator until count of redcted values >=n.
@@ -1,20 +1,55 @@
 import pandas as pd
 import numpy as np
-import pyodbc
 import os
 from contextlib import contextmanager
 
+import sys
+sys.path.append('../lib/')
+from profiling import instrument
+from run_budget import query_timeout
+from query_guard import guarded_read_sql, guarded_read_batch, raise_errors
+from backend import get_backend
+from fetch import register_connection, forget_connection
+from subset_session import session_connection
+from query_builder import group_count, suppressed_group_count, suppression_summary, close_statements
+
 
 # use this to open connection
+# (pyodbc is imported on first use so that importing these helpers stays cheap)
+# dbconn is an ODBC connection string, or "duckdb:<path>" for a local database (see backend)
+# (while a subset session is open for dbconn, its connection is used instead, and left open; see subset_session)
 @contextmanager
 def closing_connection(dbconn):
-    cnxn = pyodbc.connect(dbconn)
+    cnxn = session_connection(dbconn)
+    if cnxn is not None:
+        cnxn.timeout = query_timeout()
+        yield cnxn
+        return
+    cnxn = get_backend(dbconn).connect(dbconn)
+    register_connection(cnxn, dbconn)
+    # per-query timeout (0, the default, means no timeout)
+    cnxn.timeout = query_timeout()
     try:
         yield cnxn
     finally:
+        close_statements(cnxn)
+        forget_connection(cnxn)
         cnxn.close()
 
 
+def display(*objs, **kwargs):
+    '''IPython's display, imported on first use rather than when the helpers are imported'''
+    from IPython.display import display as ipython_display
+    ipython_display(*objs, **kwargs)
+
+
+def Markdown(data):
+    '''IPython's Markdown, imported on first use rather than when the helpers are imported'''
+    from IPython.display import Markdown as IPythonMarkdown
+    return IPythonMarkdown(data)
+
+
+@instrument
 def suppress_and_round(df, field="row_count", keep=False):
     ''' In dataframe df with a row_count column, extract values with a row_count <=7 into a separate table, and round remaining values to neareast 5.
     Return df with low values suppressed and all remaining values rounded. Or if keep==True, retain the low value items in the table (but will appear with zero counts)
@@ -30,6 +65,7 @@ def suppress_and_round(df, field="row_count", keep=False):
     return df, suppressed
 
 
+@instrument
 def round_and_suppress(df, field):
     """Another function to apply disclosure control to a column in a dataframe.
 
@@ -40,6 +76,7 @@ def round_and_suppress(df, field):
     df.loc[df[field] > 7, "n"] = (5 * (df[field] / 5).astype(float).round()).astype(int)
     
 
+@instrument
 def add_percentage_column(df, new_field, field, denominator):
     """Add a percentage column called `new_field`, found by dividing `field` by `denominator`.
 
@@ -53,17 +90,32 @@ def add_percentage_column(df, new_field, field, denominator):
     df[new_field] = df[new_field].astype(str).replace("nan", "")
 
 
+@instrument
 def  simple_sql(dbconn, table, col, where):
-    ''' extract data from sql'''
-    where_clause = ""
-    if where:
-        where_clause = f"where {where}"
-    
+    ''' extract data from sql
+    col (str): column name, or comma-separated column names
+    where (str or list): raw where clause, or list of (column, op, value) filters (see query_builder)
+    '''
+    query = group_count(table, col.split(","), where)
     with closing_connection(dbconn) as cnxn:
-        out = pd.read_sql(f"select {col}, count(*) as row_count from {table} {where_clause} group by {col}", cnxn)
+        out = guarded_read_sql(query.sql, cnxn, table=table, params=query.params)
     return out
 
 
+@instrument
+def suppressed_sql(dbconn, table, col, where, threshold=7):
+    ''' As simple_sql, with suppression and rounding done in the database, so that only the rows which can be
+    displayed are transferred (and no counts of `threshold` or fewer leave the server).
+    Returns: (dataframe of values with row counts rounded to the nearest 5,
+              Series summarising what was left out, see query_builder.suppression_summary)
+    '''
+    query = suppressed_group_count(table, col.split(","), where, threshold=threshold)
+    summary = suppression_summary(table, col.split(","), where, threshold=threshold)
+    with closing_connection(dbconn) as cnxn:
+        out, summary = raise_errors(guarded_read_batch([query, summary], cnxn, table=table))
+    return out, summary.iloc[0]
+
+
 
 if __name__ == "__main__":
     # A quick test of round_and_suppress
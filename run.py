@@ -1,38 +1,57 @@
 """A cross-platform script to build and start a notebook, open a web
 browser on the correct port, and handle shutdowns gracefully
 
+
+Pass --fast-start to skip rebuilding the image when its inputs haven't
+changed, and to reuse a container already running for this workspace.
+
 """
+import argparse
+import hashlib
+import http.client
 import os
 import signal
 import subprocess
-import socket
 import sys
 import time
+import urllib.error
 import urllib.request
 import webbrowser
 
 tag = "datalab-notebook"
 current_dir = os.getcwd()
 target_dir = "/home/app/notebook"
+workspace_label = "datalab-notebook.workspace"
+
+# files which determine the content of the image: the Dockerfile and the files it COPYs
+# (config/jupyter_notebook_config.py is mounted when the container runs, so isn't one)
+image_inputs = ["Dockerfile", "requirements.txt", "config/kernel.json"]
 
 
-def await_jupyter_http(port):
-    """Wait up to 10 seconds for Jupyter to be available
+def await_jupyter_http(port, timeout=10):
+    """Wait up to `timeout` seconds for Jupyter to be available, retrying
+    with exponential backoff on any connection error
     """
     print(f"Waiting for Jupyter to be ready on port {port}")
-    timeout = 10
-    increment = 0.1
-    counter = 0
     url = f"http://localhost:{port}"
-    while counter < (timeout / increment):
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
         try:
-            with urllib.request.urlopen(url, timeout=timeout):
+            with urllib.request.urlopen(url, timeout=max(deadline - time.monotonic(), 0.1)):
                 return
-        except ConnectionResetError:
-            counter += 1
-            time.sleep(increment)
-        except socket.timeout:
+        except urllib.error.HTTPError:
+            # the server responded, so Jupyter is up
+            return
+        except (OSError, http.client.HTTPException):
+            # connection refused/reset, timeouts and dropped connections
+            # while the server is still starting
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
             break
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1)
 
     raise SystemError(f"Unable to reach Jupyter at {url}")
 
@@ -54,16 +73,73 @@ def stream_subprocess_output(cmd):
             raise subprocess.CalledProcessError(cmd=cmd, returncode=p.returncode)
 
 
-def docker_build(tag):
+def image_hash():
+    """Return a hash of the contents of the files the image is built from
+    """
+    sha = hashlib.sha256()
+    for path in image_inputs:
+        sha.update(path.encode("utf8") + b"\0")
+        with open(path, "rb") as f:
+            sha.update(f.read())
+        sha.update(b"\0")
+    return sha.hexdigest()[:16]
+
+
+def docker_image_exists(tag):
+    """Return True if an image with the given tag has already been built
+    """
+    completed_process = subprocess.run(
+        ["docker", "image", "inspect", tag], capture_output=True
+    )
+    return completed_process.returncode == 0
+
+
+def docker_build(tag, extra_tags=()):
     """Build container for Dockerfile in current directory
     """
     print(
         "Building docker image. This may take some time (particularly on the first run)..."
     )
-    buildcmd = ["docker", "build", "-t", tag, "-f", "Dockerfile", "."]
+    buildcmd = ["docker", "build", "-t", tag]
+    for extra_tag in extra_tags:
+        buildcmd += ["-t", extra_tag]
+    buildcmd += ["-f", "Dockerfile", "."]
     stream_subprocess_output(buildcmd)
 
 
+def docker_running_container(tag):
+    """Return the id of a container already running `tag` for the current
+    workspace, or None
+    """
+    completed_process = subprocess.run(
+        [
+            "docker",
+            "ps",
+            "--quiet",
+            "--filter",
+            f"ancestor={tag}",
+            "--filter",
+            f"label={workspace_label}={current_dir}",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    container_ids = completed_process.stdout.decode("utf8").split()
+    return container_ids[0] if container_ids else None
+
+
+def install_stop_handler(container_id):
+    """Install signal handler to stop the container on Ctrl+C
+    """
+
+    def stop_handler(sig, frame):
+        print("Stopping docker...")
+        subprocess.run(["docker", "kill", container_id], check=True)
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop_handler)
+
+
 def docker_run(tag):
     """Run docker in background, and install signal handler to stop it
     again
@@ -78,17 +154,13 @@ def docker_run(tag):
         "--mount",
         f"source={current_dir},dst={target_dir},type=bind",
         "--publish-all",
+        "--label",
+        f"{workspace_label}={current_dir}",
         tag,
     ]
     completed_process = subprocess.run(runcmd, check=True, capture_output=True)
     container_id = completed_process.stdout.decode("utf8").strip()
-
-    def stop_handler(sig, frame):
-        print("Stopping docker...")
-        subprocess.run(["docker", "kill", container_id], check=True)
-        sys.exit(0)
-
-    signal.signal(signal.SIGINT, stop_handler)
+    install_stop_handler(container_id)
 
     return container_id
 
@@ -104,9 +176,39 @@ def docker_port(container_id):
     return port
 
 
+def fast_start():
+    """Start a container, only building the image if no image exists for the
+    current content of its inputs, and reusing a container already running
+    for this workspace. Return the container id
+    """
+    hashed_tag = f"{tag}:{image_hash()}"
+    if docker_image_exists(hashed_tag):
+        print(f"Image {hashed_tag} is up to date, skipping build")
+    else:
+        docker_build(hashed_tag, extra_tags=[tag])
+
+    container_id = docker_running_container(hashed_tag)
+    if container_id:
+        print(f"Reusing running container {container_id[:12]}")
+        install_stop_handler(container_id)
+        return container_id
+    return docker_run(hashed_tag)
+
+
 def main():
-    docker_build(tag)
-    container_id = docker_run(tag)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--fast-start",
+        action="store_true",
+        help="skip the build if the image is up to date, and reuse a running container",
+    )
+    args = parser.parse_args()
+
+    if args.fast_start:
+        container_id = fast_start()
+    else:
+        docker_build(tag)
+        container_id = docker_run(tag)
     port = docker_port(container_id)
     await_jupyter_http(port)
     webbrowser.open(f"http://localhost:{port}", new=2)  # Open in a new tab
@@ -3,6 +3,10 @@
 # A python warning filter.  For this one, see #20
 WARNING_FILTER="ignore:KernelManager._kernel_spec_manager_changed:DeprecationWarning"
 
+# Check the notebook helpers still import quickly, without pulling in
+# matplotlib/pyodbc/IPython until they are needed
+python lib/check_import_time.py || exit 1
+
 # This awkward testing of exit codes is to get around the case where
 # no tests are found, which has exit code of 5 in pytest, but we don't
 # want to treat as a failure